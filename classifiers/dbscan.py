@@ -18,7 +18,7 @@ def classify_charts(conf: Dict, itemIds: List[int], endep: int,
         ms = ModelsSet(data_source_name)
         stats = ms.trends_stats.get_stats_per_itemId(itemIds=itemIds)
         chart_stats.update(stats)
-        charts.update(ms.history.get_charts(list(stats.keys()), startep, endep))
+        charts.update(ms.aligned_history.get_charts(list(stats.keys()), startep, endep))
         
 
     if len(charts) > 1:
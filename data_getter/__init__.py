@@ -2,6 +2,9 @@ def get_data_getter(data_source_config):
     if data_source_config['type'] == 'csv':
         from data_getter.csv_getter import CsvGetter
         return CsvGetter(data_source_config)
+    if data_source_config['type'] == 'parquet':
+        from data_getter.parquet_getter import ParquetGetter
+        return ParquetGetter(data_source_config)
     if data_source_config['type'] == 'zabbix':
         from data_getter.zabbix_getter import ZabbixGetter
         return ZabbixGetter(data_source_config)
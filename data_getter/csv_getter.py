@@ -1,12 +1,81 @@
 """
 class to get data from CSV files
 """
-import os, json, csv, gzip
+import os
+import threading
 
 from data_getter.data_getter import DataGetter
-from typing import Dict, List
+from data_getter.item_index import ItemIndex, get_item_index, item_bounds
+from typing import Dict, List, Tuple
+import numpy as np
 import pandas as pd # type: ignore
 
+
+class CsvTable:
+    """
+    parsed CSV file sorted by (itemid, clock).
+    rows of an item and clock range are found by binary search on
+    keys = (item rank << 32) | clock.
+    """
+    def __init__(self, df: pd.DataFrame, mtime: Tuple[int, int]):
+        self.mtime = mtime
+        # itemIds in the order they first appear in the file
+        self.item_order = pd.unique(df['itemid'].to_numpy())
+        order = np.lexsort((df['clock'].to_numpy(), df['itemid'].to_numpy()))
+        self.columns = {col: df[col].to_numpy()[order] for col in df.columns}
+        itemids = self.columns['itemid']
+        self.itemIds, ranks = np.unique(itemids, return_inverse=True)
+        self.keys = (ranks.astype(np.int64) << 32) | self.columns['clock']
+
+    def select(self, startep: int, endep: int, itemIds: List[int] = []) -> pd.DataFrame:
+        if len(self.itemIds) == 0:
+            return pd.DataFrame({col: values[:0] for col, values in self.columns.items()})
+        if len(itemIds) > 0:
+            wanted = np.unique(np.asarray(itemIds, dtype=np.int64))
+            ranks = np.searchsorted(self.itemIds, wanted)
+            ranks = ranks[(ranks < len(self.itemIds)) & (self.itemIds[np.minimum(ranks, len(self.itemIds) - 1)] == wanted)]
+        else:
+            ranks = np.arange(len(self.itemIds))
+        ranks = ranks.astype(np.int64) << 32
+        # clocks are unsigned 32 bit
+        lo = np.searchsorted(self.keys, ranks | min(max(startep, 0), 0xffffffff), side='left')
+        hi = np.searchsorted(self.keys, ranks | min(max(endep, 0), 0xffffffff), side='right')
+        lengths = np.maximum(hi - lo, 0)
+        # row positions of every [lo, hi) range
+        rows = np.repeat(lo - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return pd.DataFrame({col: values[rows] for col, values in self.columns.items()})
+
+
+# parsed files shared by every CsvGetter. path -> CsvTable
+_tables: Dict[str, CsvTable] = {}
+_tables_lock = threading.Lock()
+
+def _get_table(path: str, fields: List[str], fillna: bool) -> CsvTable:
+    """ the parsed file at path. parsed again when its mtime or size changes. """
+    stat = os.stat(path)
+    mtime = (stat.st_mtime_ns, stat.st_size)
+    with _tables_lock:
+        table = _tables.get(path)
+        if table is not None and table.mtime == mtime:
+            return table
+
+        df = pd.read_csv(path, header=0)
+        if len(df) == 0:
+            df = pd.DataFrame(columns=fields)
+        df.columns = fields
+        # remove repeated header rows
+        df = df[df['clock'] != 'clock']
+        if fillna:
+            df = df.fillna(0)
+        df = df.assign(itemid=pd.to_numeric(df['itemid'], errors='coerce'),
+                       clock=pd.to_numeric(df['clock'], errors='coerce'))
+        df = df.dropna(subset=['itemid', 'clock'])
+        df = df.astype({col: ('int64' if col in ['itemid', 'clock'] else 'float64') for col in fields})
+        table = CsvTable(df, mtime)
+        _tables[path] = table
+        return table
+
+
 class CsvGetter(DataGetter):
     fields = ['itemid', 'clock', 'value']
     fields_full = ['itemid', 'clock', 'value_min', 'value_avg', 'value_max']
@@ -21,155 +90,69 @@ class CsvGetter(DataGetter):
     def check_conn(self) -> bool:
         # check if the data_dir exists
         return os.path.exists(self.data_dir)
-    
-    def get_history_data(self, startep: int, endep: int, itemIds: List[int] = []) -> pd.DataFrame:
-        df = pd.read_csv(os.path.join(self.data_dir, self.history_filename), header=0)
-        if len(df) == 0:
-            return pd.DataFrame(columns=self.fields)
-        df.columns = self.fields
-
-        # remove rows with str values
-        df = df[df['clock'] != 'clock']
 
-        # convert itemid to int
-        df['itemid'] = df['itemid'].astype(int)
-        # convert clock to int
-        df['clock'] = df['clock'].astype(int)
-        # convert value to float
-        df['value'] = df['value'].astype(float)
-
-        # filter by time
-        # Ensure 'clock' column is numeric and drop invalid rows
-        df['clock'] = pd.to_numeric(df['clock'], errors='coerce')
-        df = df.dropna(subset=['clock'])
-        df['clock'] = df['clock'].astype(int)
-
-        # Filter by time
-        # Ensure 'clock' column is numeric and drop invalid rows
-        df['clock'] = pd.to_numeric(df['clock'], errors='coerce')
-        df = df.dropna(subset=['clock'])
-        df['clock'] = df['clock'].astype(int)
-
-        # Filter by time
-        # Ensure 'clock' column is numeric and drop invalid rows
-        df['clock'] = pd.to_numeric(df['clock'], errors='coerce')
-        df = df.dropna(subset=['clock'])
-        df['clock'] = df['clock'].astype(int)
-
-        # Filter by time
-        df = df[(df['clock'] >= startep)]
-        df = df[(df['clock'] <= endep)]
+    def _history_table(self) -> CsvTable:
+        return _get_table(os.path.join(self.data_dir, self.history_filename), self.fields, False)
 
-        # filter by itemIds
-        if len(itemIds) > 0:
-            df = df[df['itemid'].isin(itemIds)]
+    def _trends_table(self) -> CsvTable:
+        return _get_table(os.path.join(self.data_dir, self.trends_filename), self.fields_full, True)
+    
+    def _empty(self, fields: List[str]) -> pd.DataFrame:
+        return pd.DataFrame({col: pd.Series(dtype='int64' if col in ['itemid', 'clock'] else 'float64') 
+                             for col in fields})
 
-        # sort by itemid, clock
-        df = df.sort_values(['itemid', 'clock'])
-        return df
+    def get_history_data(self, startep: int, endep: int, itemIds: List[int] = []) -> pd.DataFrame:
+        if len(itemIds) > 0 and not self._item_index().has_data('history', startep, endep, itemIds):
+            return self._empty(self.fields)
+        # sorted by itemid, clock
+        return self._history_table().select(startep, endep, itemIds)
     
     def get_trends_data(self, startep: int, endep: int, itemIds: List[int] = []) -> pd.DataFrame:
         df = self.get_trends_full_data(startep, endep, itemIds)
         # convert value_avg to value
         df['value'] = df['value_avg']
-        # sort by itemid, clock
-        df = df.sort_values(['itemid', 'clock'])
         return df[self.fields]
     
     
     def get_trends_full_data(self, startep: int, endep: int, itemIds: List[int] = []) -> pd.DataFrame:
-        df = pd.read_csv(os.path.join(self.data_dir, self.trends_filename))
-        if len(df) == 0:
-            return pd.DataFrame(columns=self.fields_full)
-        df.columns = self.fields_full
-        # remove rows including string 'clock' at clock
-        df = df[df['clock'] != 'clock']
-        df.fillna(0, inplace=True)
-        # convert itemid to int
-        df['itemid'] = df['itemid'].astype(int)
-        # convert clock to int
-        df['clock'] = df['clock'].astype(int)
-        # convert value_avg to float
-        df['value_avg'] = df['value_avg'].astype(float)
-        # convert value_min to float
-        df['value_min'] = df['value_min'].astype(float)
-        # convert value_max to float
-        df['value_max'] = df['value_max'].astype(float)
-
-        df['clock'] = pd.to_numeric(df['clock'], errors='coerce')
-        df = df.dropna(subset=['clock'])
-        df['clock'] = df['clock'].astype(int)
-        
-        # filter by time
-        df = df[(df['clock'] >= startep) & (df['clock'] <= endep)]
-
-        # filter by itemIds
-        if len(itemIds) > 0:
-            df = df[df['itemid'].isin(itemIds)]
-
-        # sort by itemid, clock
-        df = df.sort_values(['itemid', 'clock'])
-        return df
+        if len(itemIds) > 0 and not self._item_index().has_data('trends', startep, endep, itemIds):
+            return self._empty(self.fields_full)
+        # sorted by itemid, clock
+        return self._trends_table().select(startep, endep, itemIds)
     
+    def _item_index(self) -> ItemIndex:
+        files = {'items': self.items_filename, 'history': self.history_filename, 'trends': self.trends_filename}
+        return get_item_index(self.data_dir, files, {
+            'history': lambda: self._item_bounds(self._history_table()),
+            'trends': lambda: self._item_bounds(self._trends_table()),
+        })
+
+    def _item_bounds(self, table: CsvTable) -> pd.DataFrame:
+        bounds = item_bounds(table.columns['itemid'], table.columns['clock'])
+        # order of first appearance in the file
+        return bounds.set_index('itemid').reindex(table.item_order).reset_index()
+
     def get_itemIds(self, item_names: List[str] = [], 
                     host_names: List[str] = [], 
                     group_names: List[str] = [],
                     max_itemIds = 0,
                     itemIds: List[int] = []) -> List[int]:
-        df = pd.read_csv(os.path.join(self.data_dir, self.history_filename))
-        results = df['itemid'].unique().tolist()     
+        results = self._item_index().get_itemIds('history')
 
         # filter by itemIds
         if len(itemIds) > 0 and len(results) > 0:
+            itemIds = set(itemIds)
             results = [itemid for itemid in results if itemid in itemIds]
         
         if max_itemIds > 0:
             results = results[:max_itemIds]
         return results
 
-
-    def classify_by_groups(self, itemIds: List[int], group_names: List[str]) -> Dict[str, List[int]]:
-        items = {}
-        with gzip.open(os.path.join(self.data_dir, self.items_filename), 'rt') as f:
-            csvreader = csv.DictReader(f)
-            for row in csvreader:
-                if int(row['itemid']) not in itemIds:
-                    continue
-                items[row['itemid']] = {
-                    'group_name': row['group_name'],
-                    'hostid': row['hostid']
-                }
-
-        groups = {}
-        for group_name in group_names:
-            groups[group_name] = [int(itemid) for itemid, item in items.items() if item['group_name'] == group_name]
-
-        return groups
-    
-    
     def get_items_details(self, itemIds: List[int]) -> pd.DataFrame:
-        # open items.csv.gz into dataframe
-        df = pd.read_csv(os.path.join(self.data_dir, self.items_filename), compression='gzip')
-        df.columns = ['group_name', 'hostid', 'host_name', 'itemid', 'item_name']
-        # filter by itemIds
-        if len(itemIds) > 0:
-            df = df[df['itemid'].isin(itemIds)]
-
-        return df
-    
+        return self._item_index().get_items_details(itemIds)
 
     def get_item_host_dict(self, itemIds: List[int]=[]) -> Dict[int, int]:
-        items = {}
-        # open items.csv.gz
-        with gzip.open(os.path.join(self.data_dir, self.items_filename), 'rt') as f:
-            csvreader = csv.DictReader(f)
-            for row in csvreader:
-                itemId = int(row['itemid'])
-                if itemId not in itemIds:
-                    continue
-                items[itemId] = int(row['hostid'])
-        return items
-    
+        return self._item_index().get_item_host_dict(itemIds)
 
     def get_group_map(self, itemIds: List[int], group_names: List[str]) -> Dict[int, str]:
         if len(itemIds) == 0:
@@ -177,43 +160,8 @@ class CsvGetter(DataGetter):
         
         if len(group_names) == 0:
             return {}
+        return self._item_index().get_group_map(itemIds, group_names)
 
-        df = pd.read_csv(os.path.join(self.data_dir, self.items_filename), compression='gzip')
-        #group_name,hostid,host_name,itemid,item_name
-        df.columns = ['group_name', 'hostid', 'host_name', 'itemid', 'item_name']
-
-        group_map = {}
-        for row in df.itertuples():
-            itemId = int(row.itemid)
-            if itemId not in itemIds:
-                continue
-            group_name = row.group_name
-            if group_name not in group_names:
-                continue
-            group_map[itemId] = group_name
-
-        return group_map
-
-
-    
     # funtion to classify items by host groups
     def classify_by_groups(self, itemIds: List[int], group_names: List[str]) -> dict:
-        items = {}
-        with gzip.open(os.path.join(self.data_dir, self.items_filename), 'rt') as f:
-            csvreader = csv.DictReader(f)
-            for row in csvreader:
-                if int(row['itemid']) not in itemIds:
-                    continue
-                items[row['itemid']] = {
-                    'group_name': row['group_name'],
-                    'hostid': row['hostid']
-                }
-
-        groups = {}
-        if len(group_names) == 0:
-            groups['all'] = [int(itemid) for itemid, item in items.items()]
-        for group_name in group_names:
-            groups[group_name] = [int(itemid) for itemid, item in items.items() if item['group_name'][:len(group_name)] == group_name]
-
-        return groups
-        
\ No newline at end of file
+        return self._item_index().classify_by_groups(itemIds, group_names)
@@ -1,10 +1,36 @@
 """
 Super class to get data from different sources
 """
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Iterator
 from abc import abstractmethod
+import asyncio
+import numpy as np
 import pandas as pd # type: ignore
 
+from utils import normalizer
+
+aggregate_fields = ['itemid', 'sum', 'sqr_sum', 'cnt']
+aggregate_dtypes = {'itemid': 'int64', 'sum': 'float64', 'sqr_sum': 'float64', 'cnt': 'int64'}
+
+def aggregate_values(chunks: Iterator[pd.DataFrame]) -> pd.DataFrame:
+    """ sum, sqr_sum and cnt of value per itemid, added up over chunks of itemid, clock, value """
+    parts = []
+    for data in chunks:
+        if len(data) == 0:
+            continue
+        values = data['value'].to_numpy(dtype=np.float64)
+        parts.append(pd.DataFrame({
+            'itemid': data['itemid'].to_numpy(dtype=np.int64),
+            'sum': values,
+            'sqr_sum': np.square(values),
+            'cnt': (~np.isnan(values)).astype(np.int64),
+        }).groupby('itemid').sum())
+    if len(parts) == 0:
+        return pd.DataFrame({f: pd.Series(dtype=t) for f, t in aggregate_dtypes.items()})
+    if len(parts) > 1:
+        return pd.concat(parts).groupby('itemid').sum().reset_index()
+    return parts[0].reset_index()
+
 class DataGetter:
     def __init__(self, data_source_config):
         self.data_source_config = data_source_config
@@ -48,7 +74,72 @@ class DataGetter:
     # get itemid, clock, value_min, value_avg, value_max
     def get_trends_full_data(self, startep: int, endep: int, itemIds: List[int] = []) -> pd.DataFrame:
         pass
+
+    # functions to stream data from the data source in chunks of at most chunksize rows.
+    # Rows are not ordered across chunks.
+    # Data sources which cannot stream yield the whole result at once.
+    def iter_history_data(self, startep: int, endep: int, itemIds: List[int] = [], 
+                          chunksize: int = 0) -> Iterator[pd.DataFrame]:
+        yield self.get_history_data(startep, endep, itemIds)
+
+    def iter_trends_data(self, startep: int, endep: int, itemIds: List[int] = [], 
+                         chunksize: int = 0) -> Iterator[pd.DataFrame]:
+        yield self.get_trends_data(startep, endep, itemIds)
     
+    # functions to get per item partial aggregates over startep <= clock <= endep,
+    # so only one row per item crosses the network.
+    # Returns pandas dataframe with columns: itemid, sum, sqr_sum, cnt
+    # Data sources without a query engine aggregate the streamed data.
+    def get_history_aggregates(self, startep: int, endep: int, itemIds: List[int] = []) -> pd.DataFrame:
+        return aggregate_values(self.iter_history_data(startep, endep, itemIds))
+
+    def get_trends_aggregates(self, startep: int, endep: int, itemIds: List[int] = []) -> pd.DataFrame:
+        return aggregate_values(self.iter_trends_data(startep, endep, itemIds))
+
+    # function to get history aggregated on the unitsecs grid.
+    # value is the mean of the values of base clock - unitsecs < clock <= base clock.
+    # Returns pandas dataframe with columns: itemid, clock (base clock), value
+    # Data sources without a query engine aggregate the streamed data.
+    def get_history_buckets(self, startep: int, endep: int, unitsecs: int, 
+                            itemIds: List[int] = []) -> pd.DataFrame:
+        parts = []
+        for data in self.iter_history_data(startep, endep, itemIds):
+            if len(data) == 0:
+                continue
+            values = data['value'].to_numpy(dtype=np.float64)
+            parts.append(pd.DataFrame({
+                'itemid': data['itemid'].to_numpy(dtype=np.int64),
+                'clock': normalizer.get_bucket_clocks(data['clock'].to_numpy(dtype=np.int64), unitsecs),
+                'sum': values,
+                'cnt': (~np.isnan(values)).astype(np.int64),
+            }).groupby(['itemid', 'clock']).sum())
+        if len(parts) == 0:
+            return pd.DataFrame({'itemid': pd.Series(dtype='int64'), 'clock': pd.Series(dtype='int64'), 
+                                 'value': pd.Series(dtype='float64')})
+        df = pd.concat(parts).groupby(['itemid', 'clock']).sum().reset_index()
+        df['value'] = df['sum'] / df['cnt']
+        return df[['itemid', 'clock', 'value']]
+
+    # async counterparts of the fetch functions.
+    # By default the blocking function runs in a worker thread. 
+    # Data sources with an async client override them.
+    async def aget_history_data(self, startep: int, endep: int, itemIds: List[int] = []) -> pd.DataFrame:
+        return await asyncio.to_thread(self.get_history_data, startep, endep, itemIds)
+
+    async def aget_trends_data(self, startep: int, endep: int, itemIds: List[int] = []) -> pd.DataFrame:
+        return await asyncio.to_thread(self.get_trends_data, startep, endep, itemIds)
+
+    async def aget_trends_full_data(self, startep: int, endep: int, itemIds: List[int] = []) -> pd.DataFrame:
+        return await asyncio.to_thread(self.get_trends_full_data, startep, endep, itemIds)
+
+    async def aget_items_details(self, itemIds: List[int]) -> pd.DataFrame:
+        return await asyncio.to_thread(self.get_items_details, itemIds)
+    
+    # function to get all itemIds meeting a filter of item_conds / item_diff_conds.
+    # data sources without item filters match nothing.
+    def get_cond_itemIds(self, item_cond: str) -> List[int]:
+        return []
+
     # funtion to classify items by host groups
     def classify_by_groups(self, itemIds: List[int], group_names: List[str]) -> dict:
         return {}
@@ -0,0 +1,165 @@
+"""
+item index of an offline dataset (csv or parquet data source)
+
+Kept next to the data as item_index.json and rebuilt when one of the
+dataset files changes (mtime or size), including each file of a dataset
+directory such as the parquet day files. It holds
+    items:   the items file (group_name, hostid, host_name, itemid, item_name)
+    history: per item row count and clock bounds, in order of first appearance
+    trends:  same for the trends
+so that item lookups never parse the history or trends files and reads
+of items without data in a time range are skipped.
+"""
+import os
+import json
+import threading
+import logging
+from typing import Callable, Dict, List
+
+import numpy as np
+import pandas as pd # type: ignore
+
+
+def log(msg, level=logging.INFO):
+    msg = f"[data_getter/item_index.py] {msg}"
+    logging.log(level, msg)
+
+
+index_filename = 'item_index.json'
+items_fields = ['group_name', 'hostid', 'host_name', 'itemid', 'item_name']
+bounds_fields = ['itemid', 'rows', 'min_clock', 'max_clock']
+
+
+def item_bounds(itemids: np.ndarray, clocks: np.ndarray) -> pd.DataFrame:
+    """ row count and clock bounds per item in order of first appearance """
+    df = pd.DataFrame({'itemid': itemids, 'clock': clocks})
+    bounds = df.groupby('itemid', sort=False)['clock'].agg(['size', 'min', 'max']).reset_index()
+    bounds.columns = bounds_fields
+    return bounds.astype('int64')
+
+
+class ItemIndex:
+    def __init__(self, sources: Dict[str, List[int]], items: pd.DataFrame, bounds: Dict[str, pd.DataFrame]):
+        # file name -> [mtime_ns, size] the index was built from. see _stat.
+        self.sources = sources
+        self.items = items
+        self.bounds = bounds
+        # items file rows by itemid. the last row of an itemid wins like the former row by row readers.
+        last = items.drop_duplicates('itemid', keep='last')
+        self.item_order = pd.unique(items['itemid'].to_numpy())
+        self.last = last.set_index('itemid').reindex(self.item_order)
+
+    def to_json(self) -> Dict:
+        return {
+            'sources': self.sources,
+            'items': {col: self.items[col].tolist() for col in items_fields},
+            'bounds': {kind: {col: b[col].tolist() for col in bounds_fields} for kind, b in self.bounds.items()},
+        }
+
+    @classmethod
+    def from_json(cls, data: Dict) -> 'ItemIndex':
+        items = pd.DataFrame(data['items'], columns=items_fields)
+        bounds = {kind: pd.DataFrame(b, columns=bounds_fields).astype('int64') for kind, b in data['bounds'].items()}
+        return cls(data['sources'], items, bounds)
+
+    def get_itemIds(self, kind: str) -> List[int]:
+        return [int(itemId) for itemId in self.bounds[kind]['itemid']]
+
+    def has_data(self, kind: str, startep: int, endep: int, itemIds: List[int]) -> bool:
+        """ whether any of itemIds has rows of kind within startep <= clock <= endep """
+        b = self.bounds[kind]
+        b = b[b['itemid'].isin(itemIds)]
+        return bool(((b['min_clock'] <= endep) & (b['max_clock'] >= startep)).any())
+
+    def get_items_details(self, itemIds: List[int]) -> pd.DataFrame:
+        if len(itemIds) > 0:
+            return self.items[self.items['itemid'].isin(itemIds)]
+        return self.items
+
+    def _selected(self, itemIds: List[int]) -> pd.DataFrame:
+        return self.last[self.last.index.isin(itemIds)]
+
+    def get_item_host_dict(self, itemIds: List[int]) -> Dict[int, int]:
+        return {int(itemId): int(hostId) for itemId, hostId in self._selected(itemIds)['hostid'].items()}
+
+    def get_group_map(self, itemIds: List[int], group_names: List[str]) -> Dict[int, str]:
+        items = self.items[self.items['itemid'].isin(itemIds) & self.items['group_name'].isin(group_names)]
+        group_map = {}
+        for itemId, group_name in zip(items['itemid'], items['group_name']):
+            group_map[int(itemId)] = group_name
+        return group_map
+
+    def classify_by_groups(self, itemIds: List[int], group_names: List[str]) -> Dict[str, List[int]]:
+        items = self._selected(itemIds)
+        groups = {}
+        if len(group_names) == 0:
+            groups['all'] = [int(itemId) for itemId in items.index]
+        for group_name in group_names:
+            # sub groups belong to the group
+            matched = items['group_name'].astype(str).str.startswith(group_name)
+            groups[group_name] = [int(itemId) for itemId in items.index[matched.to_numpy()]]
+        return groups
+
+
+def _stat(path: str) -> List:
+    """ [mtime_ns, size] of a file. [[name, mtime_ns, size], ...] of the files of a directory. """
+    if not os.path.exists(path):
+        return []
+    if os.path.isdir(path):
+        # files rewritten in place do not change the mtime of their directory
+        return [[file_name] + _stat(os.path.join(path, file_name)) for file_name in sorted(os.listdir(path))
+                if os.path.isfile(os.path.join(path, file_name))]
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+# indexes shared by every getter. data_dir -> ItemIndex
+_indexes: Dict[str, ItemIndex] = {}
+_indexes_lock = threading.Lock()
+
+def get_item_index(data_dir: str, files: Dict[str, str],
+                   build_bounds: Dict[str, Callable[[], pd.DataFrame]]) -> ItemIndex:
+    """
+    the item index of data_dir.
+    files maps 'items' and each kind of build_bounds to its file name in data_dir.
+    The index is read from item_index.json, or built and written there
+    when missing or older than the files.
+    """
+    sources = {name: _stat(os.path.join(data_dir, file_name)) for name, file_name in files.items()}
+    with _indexes_lock:
+        index = _indexes.get(data_dir)
+        if index is not None and index.sources == sources:
+            return index
+
+        path = os.path.join(data_dir, index_filename)
+        index = None
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    data = json.load(f)
+                if data.get('sources') == sources:
+                    index = ItemIndex.from_json(data)
+            except (ValueError, KeyError) as e:
+                log(f"ignoring broken {path}: {e}", logging.WARNING)
+
+        if index is None:
+            items_path = os.path.join(data_dir, files['items'])
+            if os.path.exists(items_path):
+                items = pd.read_csv(items_path, compression='gzip')
+                items.columns = items_fields
+            else:
+                items = pd.DataFrame({col: pd.Series(dtype='int64' if col in ['hostid', 'itemid'] else object)
+                                      for col in items_fields})
+            bounds = {kind: (build() if len(sources.get(kind, [])) > 0 else 
+                             pd.DataFrame({col: pd.Series(dtype='int64') for col in bounds_fields}))
+                      for kind, build in build_bounds.items()}
+            index = ItemIndex(sources, items, bounds)
+            try:
+                with open(path, 'w') as f:
+                    json.dump(index.to_json(), f)
+            except OSError as e:
+                # read only datasets keep the index in memory only
+                log(f"cannot write {path}: {e}", logging.WARNING)
+
+        _indexes[data_dir] = index
+        return index
@@ -14,15 +14,29 @@ example:
         group2:
             3: host3
 """
-from typing import Dict, List
+from typing import Dict, List, Iterator
 import requests
+import requests.adapters
+import io
 import os
+import re
+import json
+import time
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 
 from data_getter.data_getter import DataGetter
 import utils.config_loader as config_loader
 from models.models_set import ModelsSet
 
+
+def log(msg, level=logging.INFO):
+    msg = f"[data_getter/logan_getter.py] {msg}"
+    logging.log(level, msg)
+
+
 class LoganGetter(DataGetter):
     history_fields = ['itemid', 'clock', 'value']
     loggroups_fields = ['itemid', 'count', 'score', 'text']
@@ -42,6 +56,8 @@ class LoganGetter(DataGetter):
         self.trends_interval = config_loader.conf['trends_interval']
         self.trends_retention = config_loader.conf['trends_retention']
         self.startep = self.endep - self.trends_interval * self.trends_retention
+        # readers may run in worker threads (aget_* functions)
+        self.import_lock = threading.Lock()
         
         self.hosts = {}
         for g in self.groups.values():
@@ -52,6 +68,20 @@ class LoganGetter(DataGetter):
             'Content-Type': 'application/json',
             'Accept': 'application/json'
         }
+        # hosts are fetched at the same time over one keep-alive session
+        self.fetch_workers = data_source_config.get('fetch_workers', 8)
+        # seconds to download all files of a host
+        self.fetch_timeout = data_source_config.get('fetch_timeout', 30)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.fetch_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # only import history rows after the latest clock imported per host,
+        # asking the server with conditional GETs and optionally since=<clock> or a byte Range
+        # from the bytes received last time, which tell an appended file from a rewritten one
+        self.history_delta = data_source_config.get('history_delta', True)
+        self.history_since_param = data_source_config.get('history_since_param', '')
+        self.history_range = data_source_config.get('history_range', False)
 
         self.data_dir = data_source_config['data_dir']
         # ensure data_dir exists
@@ -59,12 +89,13 @@ class LoganGetter(DataGetter):
             os.makedirs(self.data_dir)
         
         self.itemid_hostid_map = {}
+        self.max_clock = 0
         self._load_loggroups_data()
         
 
     def check_conn(self) -> bool:
         try:
-            response = requests.get(self.base_url, headers=self.headers)
+            response = self.session.get(self.base_url, headers=self.headers, timeout=self.fetch_timeout)
             if response.status_code == 200:
                 return True
         except Exception as e:
@@ -74,6 +105,10 @@ class LoganGetter(DataGetter):
 
     def initialize(self):
         self.ms.initialize()
+        for hostid in self.hosts:
+            path = self._history_state_path(hostid)
+            if os.path.exists(path):
+                os.remove(path)
     
 
     def _map_itemIds(self, hostId: int, itemIds: List[int]) -> List[int]:
@@ -95,14 +130,51 @@ class LoganGetter(DataGetter):
       
    
 
+    def _http_get(self, url: str, deadline: float, headers: Dict = None, params: Dict = None) -> requests.Response:
+        """ GET url with the whole body received before deadline (time.monotonic()), or raise requests.Timeout """
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise requests.Timeout(f"no time left to get {url}")
+        response = self.session.get(url, headers=headers or self.headers, params=params,
+                                    timeout=remaining, stream=True)
+        # the read timeout applies to each socket read, so a server sending slowly is cut off by a timer
+        expired = threading.Event()
+        def expire():
+            expired.set()
+            try:
+                response.raw.shutdown()
+            except (AttributeError, ValueError, RuntimeError):
+                # released to the pool already, or urllib3 without shutdown()
+                pass
+        timer = threading.Timer(max(0.0, deadline - time.monotonic()), expire)
+        timer.start()
+        try:
+            response.content
+        except Exception:
+            if not expired.is_set():
+                raise
+        finally:
+            timer.cancel()
+            response.close()
+        if expired.is_set():
+            raise requests.Timeout(f"{url} not received within {self.fetch_timeout} seconds")
+        return response
+
     def _get_data_by_http(self, hostid: int, file_name: str, 
                           columns: List[str],
-                          write_to_csv = False) -> pd.DataFrame:
+                          write_to_csv = False, deadline: float = None) -> pd.DataFrame:
         url = f"{self.base_url}/{self.hosts[hostid]}/{file_name}"
         csv_path = f"{self.data_dir}/{self.hosts[hostid]}_{file_name}"
-        response = requests.get(url, headers=self.headers)
+        if deadline is None:
+            deadline = time.monotonic() + self.fetch_timeout
+        try:
+            response = self._http_get(url, deadline)
+        except requests.RequestException as e:
+            log(f"failed to get {url}: {e}", logging.WARNING)
+            return pd.DataFrame(columns=columns)
         if response.status_code == 200:
-            df = pd.read_csv(url)
+            # parse the body already downloaded
+            df = pd.read_csv(io.BytesIO(response.content))
             df.columns = columns
             # save to file
             if write_to_csv:
@@ -153,15 +225,145 @@ class LoganGetter(DataGetter):
                 groups.append(group_name)
         return groups
 
-    def _import_host_data(self, hostid: int):
-        lgdf = self._get_data_by_http(hostid, 'logGroups.csv', self.loggroups_fields, True)
+    def _fetch_host_data(self, hostid: int) -> Dict[str, pd.DataFrame]:
+        """ download the files of hostid within fetch_timeout. runs in the fetch threads, so it must not touch shared state.
+        a host that fails is skipped in this import and the others are imported. """
+        deadline = time.monotonic() + self.fetch_timeout
+        try:
+            return self._fetch_host_files(hostid, deadline)
+        except Exception as e:
+            log(f"skipped {self.hosts[hostid]}: {e}", logging.WARNING)
+            return {}
+
+    def _fetch_host_files(self, hostid: int, deadline: float) -> Dict[str, pd.DataFrame]:
+        lgdf = self._get_data_by_http(hostid, 'logGroups.csv', self.loggroups_fields, True, deadline)
 
         # filter by minimal_group_size
         if len(lgdf) > 0:
             lgdf = lgdf[lgdf['count'] >= self.minimal_group_size]
 
         if len(lgdf) == 0:
-            return
+            return {}
+
+        self._get_data_by_http(hostid, 'logGroups_last.csv', self.last_loggroups_fields, True, deadline)
+
+        # get metrics data
+        if not self.history_delta:
+            df = self._get_data_by_http(hostid, 'history.csv', self.history_fields, False, deadline)
+            return {'loggroups': lgdf, 'history': df}
+        df, state = self._get_history_delta(hostid, self._load_history_state(hostid, self.max_clock), deadline)
+        return {'loggroups': lgdf, 'history': df, 'state': state}
+
+    def _history_state_path(self, hostid: int) -> str:
+        return f"{self.data_dir}/{self.hosts[hostid]}_history_state.json"
+
+    def _new_history_state(self) -> Dict:
+        # watermark: latest clock imported. offset: bytes of complete lines of history.csv received
+        # tail: hex of the last bytes received, compared with the file to tell appends from rewrites
+        return {'etag': '', 'last_modified': '', 'watermark': 0, 'offset': 0, 'tail': ''}
+
+    def _load_history_state(self, hostid: int, max_clock: int) -> Dict:
+        path = self._history_state_path(hostid)
+        state = self._new_history_state()
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    state.update(json.load(f))
+            except ValueError as e:
+                log(f"ignoring broken {path}: {e}", logging.WARNING)
+        # the local history was removed or truncated since. import everything again.
+        if state['watermark'] > max_clock:
+            state = self._new_history_state()
+        return state
+
+    def _save_history_state(self, hostid: int, state: Dict):
+        with open(self._history_state_path(hostid), 'w') as f:
+            json.dump(state, f)
+
+    def _get_history_delta(self, hostid: int, state: Dict, deadline: float = None):
+        """ (history rows after the host's watermark, new state) """
+        url = f"{self.base_url}/{self.hosts[hostid]}/history.csv"
+        headers = dict(self.headers)
+        params = {}
+        if state['etag']:
+            headers['If-None-Match'] = state['etag']
+        if state['last_modified']:
+            headers['If-Modified-Since'] = state['last_modified']
+        ranged = False
+        if self.history_since_param and state['watermark'] > 0:
+            params[self.history_since_param] = state['watermark']
+        elif self.history_range and state['offset'] > 0 and state['tail']:
+            # the bytes appended since, starting with the tail already received
+            headers['Range'] = f"bytes={state['offset'] - len(state['tail']) // 2}-"
+            ranged = True
+
+        empty = pd.DataFrame(columns=self.history_fields)
+        if deadline is None:
+            deadline = time.monotonic() + self.fetch_timeout
+        try:
+            response = self._http_get(url, deadline, headers, params)
+        except requests.RequestException as e:
+            log(f"failed to get {url}: {e}", logging.WARNING)
+            return empty, state
+        if response.status_code == 304:
+            return empty, state
+
+        state = dict(state)
+        if ranged and response.status_code != 200:
+            body = self._appended_bytes(response, state)
+            if body is None:
+                # rewritten instead of appended to. get all of it.
+                log(f"{url} was rewritten, getting all of it")
+                new_state = dict(self._new_history_state(), watermark=state['watermark'])
+                return self._get_history_delta(hostid, new_state, deadline)
+            header = None
+        elif response.status_code == 200:
+            body = response.content
+            state['offset'] = 0
+            state['tail'] = ''
+            header = 'infer'
+        else:
+            return empty, state
+        if self.history_range:
+            # a line still being written is received with the next range
+            body = body[:body.rfind(b'\n') + 1]
+        state['offset'] += len(body)
+        state['tail'] = (bytes.fromhex(state['tail']) + body)[-64:].hex()
+        state['etag'] = response.headers.get('ETag', '')
+        state['last_modified'] = response.headers.get('Last-Modified', '')
+
+        if len(body.strip()) == 0:
+            df = empty
+        else:
+            df = pd.read_csv(io.BytesIO(body), header=header)
+            df.columns = self.history_fields
+
+        # skip rows already imported. appended lines are all new, also at the watermark's clock.
+        if header is not None:
+            df = df[df['clock'] > state['watermark']]
+        if len(df) > 0:
+            state['watermark'] = max(state['watermark'], int(df['clock'].max()))
+        return df, state
+
+    def _appended_bytes(self, response: requests.Response, state: Dict) -> bytes:
+        """ the bytes after state['offset'] in the response to the Range request, or None if the file was not appended to """
+        tail = bytes.fromhex(state['tail'])
+        m = re.match(r'bytes (\d+)-\d+/(\d+|\*)', response.headers.get('Content-Range', ''))
+        # 416: shorter than the tail's start
+        if response.status_code != 206 or m is None or int(m.group(1)) != state['offset'] - len(tail):
+            return None
+        if m.group(2) != '*' and int(m.group(2)) < state['offset']:
+            return None
+        body = response.content
+        if not body.startswith(tail):
+            return None
+        return body[len(tail):]
+
+    def _import_host_data(self, hostid: int, host_data: Dict[str, pd.DataFrame]) -> pd.DataFrame:
+        """ register the items of the fetched host_data and return its history """
+        if len(host_data) == 0:
+            return pd.DataFrame(columns=self.history_fields)
+        lgdf = host_data['loggroups']
 
         # get itemids
         itemIds = lgdf['itemid'].tolist()
@@ -180,26 +382,35 @@ class LoganGetter(DataGetter):
             for group_name in group_names:
                 self._load_item_details(lgdf, group_name, hostid)
 
-        self._get_data_by_http(hostid, 'logGroups_last.csv', self.last_loggroups_fields, True)
-
-        
-        # get metrics data
-        df = self._get_data_by_http(hostid, 'history.csv', self.history_fields, False)
+        df = host_data['history']
         itemIds = df['itemid'].tolist()
         itemIds = list(set(itemIds))
         itemIds = self._map_itemIds(hostid, itemIds)
-        df = self._conv_itemIds(df)
-
-        self.ms.history.upsert(df['itemid'].tolist(), df['clock'].tolist(), df['value'].tolist())
-        self.endep = max(self.endep, df['clock'].max())
-        self.startep = self.endep - self.trends_interval * self.trends_retention
-        self.ms.history.remove_old_data(self.startep)
+        return self._conv_itemIds(df)
         
 
     def import_data(self):
         self.data = {}
-        for hostid in self.hosts:
-            self._import_host_data(hostid)
+        hostids = list(self.hosts.keys())
+        if self.history_delta:
+            self.max_clock = self.ms.history.get_max_clock()
+        # import time is bounded by the slowest host instead of the sum of all hosts
+        with ThreadPoolExecutor(max_workers=max(1, min(self.fetch_workers, len(hostids)))) as executor:
+            fetched = list(executor.map(self._fetch_host_data, hostids))
+
+        # items are registered in host order like the one by one import
+        dfs = [self._import_host_data(hostid, host_data) for hostid, host_data in zip(hostids, fetched)]
+        dfs = [df for df in dfs if len(df) > 0]
+        if len(dfs) > 0:
+            df = pd.concat(dfs, ignore_index=True)
+            self.ms.history.upsert(df['itemid'].tolist(), df['clock'].tolist(), df['value'].tolist())
+            self.endep = max(self.endep, df['clock'].max())
+            self.startep = self.endep - self.trends_interval * self.trends_retention
+            self.ms.history.remove_old_data(self.startep)
+        # watermarks move only after their rows are written
+        for hostid, host_data in zip(hostids, fetched):
+            if 'state' in host_data:
+                self._save_history_state(hostid, host_data['state'])
         self.ms.history_updates.upsert_updates(self.startep, self.endep)
 
     
@@ -241,9 +452,17 @@ class LoganGetter(DataGetter):
 
 
     def get_history_data(self, startep: int, endep: int, itemIds: List[int] = []) -> pd.DataFrame:
-        if endep > self.endep:
-            self.import_data()
+        with self.import_lock:
+            if endep > self.endep:
+                self.import_data()
         return self.ms.history.get_data(itemIds, startep, endep)
+
+    def iter_history_data(self, startep: int, endep: int, itemIds: List[int] = [], 
+                          chunksize: int = 0) -> Iterator[pd.DataFrame]:
+        with self.import_lock:
+            if endep > self.endep:
+                self.import_data()
+        return self.ms.history.iter_data(itemIds, startep, endep, chunksize)
     
 
     def get_trends_data(self, startep, endep, itemIds = []):
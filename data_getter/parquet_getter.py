@@ -0,0 +1,134 @@
+"""
+class to get data from Parquet files
+
+data_dir layout:
+    history/YYYYMMDD.parquet    one file per UTC day, sorted by itemid, clock
+    trends/YYYYMMDD.parquet
+    items.csv.gz                same as the csv data source
+
+Day files outside of the time range are skipped by name and row groups
+by their itemid / clock statistics. Files are memory mapped.
+Needs pyarrow.
+"""
+import os
+import time
+import calendar
+from typing import List
+
+import numpy as np
+import pandas as pd # type: ignore
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from data_getter.csv_getter import CsvGetter
+from data_getter.item_index import ItemIndex, get_item_index, item_bounds
+
+DAY_SECS = 86400
+ROW_GROUP_SIZE = 65536
+
+
+def day_file_name(daystart: int) -> str:
+    return time.strftime("%Y%m%d", time.gmtime(daystart)) + ".parquet"
+
+def day_start(file_name: str) -> int:
+    return calendar.timegm(time.strptime(file_name[:8], "%Y%m%d"))
+
+
+def write_partitioned(df: pd.DataFrame, out_dir: str, row_group_size: int = ROW_GROUP_SIZE):
+    """ write df (itemid, clock, ...) as one file per day sorted by itemid, clock """
+    os.makedirs(out_dir, exist_ok=True)
+    if df.empty:
+        return
+    df = df.sort_values(['itemid', 'clock'], kind='stable')
+    days = df['clock'] - df['clock'] % DAY_SECS
+    for daystart, day_df in df.groupby(days.to_numpy(), sort=True):
+        table = pa.Table.from_pandas(day_df.reset_index(drop=True), preserve_index=False)
+        pq.write_table(table, os.path.join(out_dir, day_file_name(int(daystart))),
+                       row_group_size=row_group_size)
+
+
+class ParquetGetter(CsvGetter):
+    history_dirname = 'history'
+    trends_dirname = 'trends'
+
+    def _day_files(self, dirname: str, startep: int, endep: int) -> List[str]:
+        path = os.path.join(self.data_dir, dirname)
+        if not os.path.isdir(path):
+            return []
+        files = []
+        for file_name in sorted(os.listdir(path)):
+            if not file_name.endswith(".parquet"):
+                continue
+            daystart = day_start(file_name)
+            if daystart + DAY_SECS <= startep or daystart > endep:
+                continue
+            files.append(os.path.join(path, file_name))
+        return files
+
+    def _row_groups(self, pf: pq.ParquetFile, startep: int, endep: int,
+                    itemIds: np.ndarray) -> List[int]:
+        """ row groups whose clock and itemid statistics may match """
+        names = pf.schema_arrow.names
+        itemid_col = names.index('itemid')
+        clock_col = names.index('clock')
+        row_groups = []
+        for i in range(pf.metadata.num_row_groups):
+            rg = pf.metadata.row_group(i)
+            clock_stats = rg.column(clock_col).statistics
+            if clock_stats is not None and clock_stats.has_min_max:
+                if clock_stats.max < startep or clock_stats.min > endep:
+                    continue
+            itemid_stats = rg.column(itemid_col).statistics
+            if len(itemIds) > 0 and itemid_stats is not None and itemid_stats.has_min_max:
+                # any of the sorted itemIds within [min, max]
+                lo = np.searchsorted(itemIds, itemid_stats.min, side='left')
+                if lo >= len(itemIds) or itemIds[lo] > itemid_stats.max:
+                    continue
+            row_groups.append(i)
+        return row_groups
+
+    def _read(self, dirname: str, columns: List[str], startep: int, endep: int,
+              itemIds: List[int] = []) -> pd.DataFrame:
+        wanted = np.unique(np.asarray(itemIds, dtype=np.int64))
+        tables = []
+        for path in self._day_files(dirname, startep, endep):
+            pf = pq.ParquetFile(path, memory_map=True)
+            row_groups = self._row_groups(pf, startep, endep, wanted)
+            if len(row_groups) == 0:
+                continue
+            table = pf.read_row_groups(row_groups, columns=columns)
+            mask = pc.and_(pc.greater_equal(table['clock'], startep), pc.less_equal(table['clock'], endep))
+            if len(wanted) > 0:
+                mask = pc.and_(mask, pc.is_in(table['itemid'], value_set=pa.array(wanted)))
+            tables.append(table.filter(mask))
+        if len(tables) == 0:
+            return pd.DataFrame({col: pd.Series(dtype='int64' if col in ['itemid', 'clock'] else 'float64')
+                                 for col in columns})
+        df = pa.concat_tables(tables).to_pandas()
+        df = df.astype({col: ('int64' if col in ['itemid', 'clock'] else 'float64') for col in columns})
+        # days are read in order, each sorted by itemid, clock
+        return df.sort_values(['itemid', 'clock'], kind='stable').reset_index(drop=True)
+
+    def get_history_data(self, startep: int, endep: int, itemIds: List[int] = []) -> pd.DataFrame:
+        return self._read(self.history_dirname, self.fields, startep, endep, itemIds)
+
+    def get_trends_full_data(self, startep: int, endep: int, itemIds: List[int] = []) -> pd.DataFrame:
+        df = self._read(self.trends_dirname, self.fields_full, startep, endep, itemIds)
+        return df.fillna(0)
+
+    def _item_index(self) -> ItemIndex:
+        files = {'items': self.items_filename, 'history': self.history_dirname, 'trends': self.trends_dirname}
+        return get_item_index(self.data_dir, files, {
+            'history': lambda: self._item_bounds_of(self.history_dirname),
+            'trends': lambda: self._item_bounds_of(self.trends_dirname),
+        })
+
+    def _item_bounds_of(self, dirname: str) -> pd.DataFrame:
+        tables = [pq.read_table(path, columns=['itemid', 'clock'], memory_map=True) 
+                  for path in self._day_files(dirname, 0, 2**31)]
+        if len(tables) == 0:
+            return item_bounds(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+        table = pa.concat_tables(tables)
+        bounds = item_bounds(table['itemid'].to_numpy(), table['clock'].to_numpy())
+        return bounds.sort_values('itemid').reset_index(drop=True)
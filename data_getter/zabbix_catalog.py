@@ -0,0 +1,269 @@
+"""
+in-process catalog of Zabbix items, hosts and host groups
+
+Items, hosts and group memberships are loaded once into DataFrames indexed
+by id and shared by every ZabbixGetter on the same database. After ttl seconds
+the next lookup refreshes the catalog. The items table has no change time, so
+the database returns a digest of the items of every block of block_size item
+ids, and only the blocks whose digest changed are reloaded: new, renamed,
+retyped, moved and deleted items alike. Hosts and groups (small tables) are
+reloaded.
+"""
+import re
+import threading
+import time
+import logging
+from typing import List, Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+from db.postgresql import PostgreSqlDB
+
+
+def log(msg, level=logging.INFO):
+    msg = f"[data_getter/zabbix_catalog.py] {msg}"
+    logging.log(level, msg)
+
+
+def like_to_regex(pattern: str) -> str:
+    """ SQL LIKE pattern to a regular expression matching the whole string """
+    regex = ""
+    for c in pattern:
+        if c == "%":
+            regex += ".*"
+        elif c == "_":
+            regex += "."
+        else:
+            regex += re.escape(c)
+    return regex
+
+
+def match_names(names: pd.Series, patterns: List[str]) -> np.ndarray:
+    """
+    names matching any of patterns like ZabbixGetter name conditions:
+    patterns with '*' or '%' are LIKE patterns,
+    others match the name itself and its sub names (<name>/...)
+    """
+    mask = np.zeros(len(names), dtype=bool)
+    names = names.fillna("")
+    for pattern in patterns:
+        if '*' in pattern or '%' in pattern:
+            mask |= names.str.fullmatch(like_to_regex(pattern.replace('*', '%'))).to_numpy()
+        else:
+            mask |= ((names == pattern) | names.str.startswith(pattern + "/")).to_numpy()
+    return mask
+
+
+class ZabbixItemCatalog:
+    block_size = 10000
+
+    def __init__(self, db: PostgreSqlDB, ttl: int = 600):
+        self.db = db
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.loaded = 0
+        # itemid -> hostid, name, key_, value_type
+        self.items = pd.DataFrame()
+        # block (itemid // block_size) -> digest of its items when they were loaded
+        self.digests: pd.Series = None
+        # hostid -> host, name
+        self.hosts = pd.DataFrame()
+        # itemid, hostid, group_name. one row per group of the item's host
+        self.item_groups = pd.DataFrame()
+        self.host_groups = pd.DataFrame()
+        # item_cond -> itemids meeting it
+        self.conds: Dict[str, np.ndarray] = {}
+
+    def _load_items(self, blocks: List[int] = None) -> pd.DataFrame:
+        where = ""
+        if blocks is not None:
+            where = f"WHERE itemid / {self.block_size} = ANY(ARRAY[{','.join(map(str, blocks))}]::bigint[])"
+        sql = f"""SELECT itemid, hostid, name, key_, value_type FROM items
+            {where} ORDER BY itemid"""
+        df = self.db.read_sql(sql)
+        if df.empty:
+            return pd.DataFrame({'hostid': pd.Series(dtype='int64'), 'name': pd.Series(dtype=object),
+                                 'key_': pd.Series(dtype=object), 'value_type': pd.Series(dtype='int64')},
+                                index=pd.Index([], dtype='int64', name='itemid'))
+        df.columns = ['itemid', 'hostid', 'name', 'key_', 'value_type']
+        df = df.astype({'itemid': 'int64', 'hostid': 'int64'})
+        df['value_type'] = df['value_type'].fillna(0).astype('int64')
+        return df.set_index('itemid')
+
+    def _item_digests(self) -> pd.Series:
+        sql = f"""SELECT itemid / {self.block_size}, 
+            md5(string_agg(concat_ws(':', itemid, hostid, name, key_, value_type), ',' ORDER BY itemid))
+            FROM items GROUP BY 1"""
+        df = self.db.read_sql(sql)
+        if df.empty:
+            return pd.Series([], index=pd.Index([], dtype='int64'), dtype=object)
+        return pd.Series(df[1].to_numpy(), index=df[0].astype('int64').to_numpy())
+
+    def _changed_blocks(self, digests: pd.Series) -> List[int]:
+        """ blocks added, changed or emptied since the items were loaded """
+        old = self.digests
+        changed = digests.index[(digests != old.reindex(digests.index)).to_numpy()]
+        emptied = old.index[~old.index.isin(digests.index)]
+        return sorted(int(block) for block in changed.union(emptied))
+
+    def _load_hosts(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        hosts = self.db.read_sql("SELECT hostid, host, name FROM hosts")
+        if hosts.empty:
+            hosts = pd.DataFrame(columns=['hostid', 'host', 'name'])
+        hosts.columns = ['hostid', 'host', 'name']
+        hosts = hosts.astype({'hostid': 'int64'}).set_index('hostid')
+
+        host_groups = self.db.read_sql("""SELECT hosts_groups.hostid, hstgrp.name FROM hosts_groups
+            inner join hstgrp on hstgrp.groupid = hosts_groups.groupid""")
+        if host_groups.empty:
+            host_groups = pd.DataFrame(columns=['hostid', 'group_name'])
+        host_groups.columns = ['hostid', 'group_name']
+        host_groups = host_groups.astype({'hostid': 'int64'})
+        return hosts, host_groups
+
+    def refresh(self, full: bool = False):
+        now = time.time()
+        digests = self._item_digests()
+        if full or self.digests is None:
+            items = self._load_items()
+            changed = None
+        else:
+            changed = self._changed_blocks(digests)
+            items = self.items
+            if len(changed) > 0:
+                kept = items[~np.isin(items.index.to_numpy() // self.block_size, changed)]
+                items = pd.concat([kept, self._load_items(changed)]).sort_index()
+        hosts, host_groups = self._load_hosts()
+        item_groups = pd.merge(items[['hostid']].reset_index(), host_groups, on='hostid', how='inner')
+
+        # swap in the new tables at once for concurrent readers
+        (self.items, self.digests, self.hosts, self.host_groups, self.item_groups, self.conds) = (
+            items, digests, hosts, host_groups, item_groups, {})
+        self.loaded = now
+        log(f"catalog refreshed: {len(items)} items, {len(hosts)} hosts, "
+            f"reloaded blocks={'all' if changed is None else len(changed)}")
+
+    def check(self):
+        if time.time() - self.loaded < self.ttl:
+            return
+        with self.lock:
+            if time.time() - self.loaded >= self.ttl:
+                self.refresh()
+
+    def get_itemIds(self, item_names: List[str] = [],
+                    host_names: List[str] = [],
+                    group_names: List[str] = [],
+                    itemIds: List[int] = [],
+                    max_itemIds = 0) -> List[int]:
+        self.check()
+        df = self.item_groups
+        mask = np.ones(len(df), dtype=bool)
+        if len(item_names) > 0:
+            mask &= match_names(self.items['name'].reindex(df['itemid']).reset_index(drop=True), item_names)
+        if len(host_names) > 0:
+            mask &= match_names(self.hosts['name'].reindex(df['hostid']).reset_index(drop=True), host_names)
+        if len(group_names) > 0:
+            mask &= match_names(df['group_name'], group_names)
+        if len(itemIds) > 0:
+            mask &= df['itemid'].isin(itemIds).to_numpy()
+        result = pd.unique(df['itemid'].to_numpy()[mask])
+        if max_itemIds > 0:
+            result = result[:max_itemIds]
+        return [int(itemId) for itemId in result]
+
+    def get_item_host_dict(self, itemIds: List[int] = []) -> Dict[int, int]:
+        self.check()
+        items = self.items
+        if len(itemIds) > 0:
+            items = items[items.index.isin(itemIds)]
+        return {int(itemId): int(hostId) for itemId, hostId in items['hostid'].items()}
+
+    def get_item_details(self, itemIds: List[int]) -> Dict:
+        self.check()
+        items = self.items[self.items.index.isin(itemIds)]
+        host_names = self.hosts['name'].reindex(items['hostid']).to_numpy()
+        return {int(itemId): {"hostid": int(row.hostid), "host_name": host_names[i], "item_name": row.name}
+                for i, (itemId, row) in enumerate(zip(items.index, items.itertuples(index=False)))}
+
+    def get_items_details(self, itemIds: List[int]) -> pd.DataFrame:
+        self.check()
+        df = self.item_groups[self.item_groups['itemid'].isin(itemIds)]
+        return pd.DataFrame({
+            'group_name': df['group_name'].to_numpy(),
+            'hostid': df['hostid'].to_numpy(),
+            'host_name': self.hosts['host'].reindex(df['hostid']).to_numpy(),
+            'itemid': df['itemid'].to_numpy(),
+            'item_name': self.items['key_'].reindex(df['itemid']).to_numpy(),
+        })
+
+    def get_value_types(self, itemIds: List[int]) -> Dict[int, int]:
+        self.check()
+        items = self.items[self.items.index.isin(itemIds)]
+        return {int(itemId): int(value_type) for itemId, value_type in items['value_type'].items()}
+
+    def get_group_map(self, itemIds: List[int], group_names: List[str]) -> Dict[int, str]:
+        self.check()
+        df = self.item_groups[self.item_groups['itemid'].isin(itemIds)]
+        group_map = {}
+        # later group names win like the per group queries did
+        for group_name in group_names:
+            for itemId in df['itemid'].to_numpy()[match_names(df['group_name'].reset_index(drop=True), [group_name])]:
+                group_map[int(itemId)] = group_name
+        return group_map
+
+    def classify_by_groups(self, itemIds: List[int], group_names: List[str]) -> Dict[str, List[int]]:
+        self.check()
+        df = self.item_groups[self.item_groups['itemid'].isin(itemIds)]
+        groups = {}
+        for group_name in group_names:
+            group_itemIds = pd.unique(df['itemid'].to_numpy()[match_names(df['group_name'].reset_index(drop=True), [group_name])])
+            if len(group_itemIds) > 0:
+                groups[group_name] = [int(itemId) for itemId in group_itemIds]
+        return groups
+
+    def get_item_relations(self, itemIds: List[int], group_names: List[str]) -> pd.DataFrame:
+        self.check()
+        df = self.item_groups
+        if len(itemIds) > 0:
+            df = df[df['itemid'].isin(itemIds)]
+        group_names_col = df['group_name'].reset_index(drop=True)
+        relations = []
+        for group_name in group_names:
+            matched = df[match_names(group_names_col, [group_name])]
+            relations.append(pd.DataFrame({'group_name': group_name,
+                                           'hostid': matched['hostid'].to_numpy(),
+                                           'itemid': matched['itemid'].to_numpy()}))
+        if len(relations) == 0:
+            return pd.DataFrame(columns=['group_name', 'hostid', 'itemid'])
+        return pd.concat(relations, ignore_index=True)
+
+    def get_cond_itemIds(self, item_cond: str) -> np.ndarray:
+        """ itemIds meeting item_cond, a condition on the items table. evaluated once per refresh. """
+        self.check()
+        matched = self.conds.get(item_cond)
+        if matched is None:
+            cur = self.db.exec_sql(f"SELECT itemid FROM items WHERE {item_cond}")
+            matched = np.array([row[0] for row in cur], dtype=np.int64)
+            cur.close()
+            self.conds[item_cond] = matched
+        return matched
+
+    def check_itemId_cond(self, itemIds: List[int], item_cond: str) -> List[int]:
+        matched = np.asarray(itemIds, dtype=np.int64)
+        return matched[np.isin(matched, self.get_cond_itemIds(item_cond))].tolist()
+
+
+_catalogs: Dict[Tuple, ZabbixItemCatalog] = {}
+_catalogs_lock = threading.Lock()
+
+def get_catalog(db: PostgreSqlDB, ttl: int = 600) -> ZabbixItemCatalog:
+    """ the catalog of the Zabbix database of db. one per process and database. """
+    config = db.config
+    key = (config["host"], config.get("port", 5432), config["dbname"], config.get("schema", "public"))
+    with _catalogs_lock:
+        catalog = _catalogs.get(key)
+        if catalog is None:
+            catalog = ZabbixItemCatalog(db, ttl)
+            _catalogs[key] = catalog
+        return catalog
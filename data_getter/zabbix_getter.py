@@ -2,21 +2,39 @@
 class to get data from zabbix postgreSQL database
 """
 from data_getter.data_getter import DataGetter
-from typing import Dict, List
+from typing import Dict, List, Iterator
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd # type: ignore
 
 from db.postgresql import PostgreSqlDB
+from data_getter.data_getter import aggregate_dtypes
+from db.thread_offload import ThreadOffloadDB
+from data_getter.zabbix_catalog import get_catalog
+import utils.config_loader as config_loader
 
 class ZabbixGetter(DataGetter):
     history_tables = ['history', 'history_uint']
     trends_tables = ['trends', 'trends_uint']
+    # value_type of the items stored in each of the tables above. 0: float, 3: unsigned
+    table_value_types = [0, 3]
     fields = ['itemid', 'clock', 'value']
     fields_full = ['itemid', 'clock', 'value_min', 'value_avg', 'value_max']
+    dtypes = {'itemid': 'int64', 'clock': 'int64', 'value': 'float64'}
+    dtypes_full = {'itemid': 'int64', 'clock': 'int64', 
+                   'value_min': 'float64', 'value_avg': 'float64', 'value_max': 'float64'}
     db: PostgreSqlDB = None
 
     def init_data_source(self, data_source: Dict):
         self.db = PostgreSqlDB(data_source)
+        self.db.tag = self.__class__.__name__
+        self.adb = ThreadOffloadDB(self.db)
         self.api_url = data_source['api_url']
+        # items, hosts and groups are looked up in memory and refreshed every catalog_ttl seconds
+        self.catalog = get_catalog(self.db, data_source.get('catalog_ttl', 600))
+        # aggregate the hourly trends to trends_interval in the database
+        self.trends_rebucket = data_source.get('trends_rebucket', False)
+        self.trends_interval = config_loader.conf['trends_interval']
 
     def check_conn(self) -> bool:
         cur = self.db.exec_sql("SELECT version();")
@@ -26,160 +44,179 @@ class ZabbixGetter(DataGetter):
         
         return cnt > 0
 
-    def get_history_data(self, startep: int, endep: int, itemIds: List[int] = []) -> pd.DataFrame:
+    def _where_itemIds(self, itemIds: List[int]) -> str:
         if len(itemIds) > 0:
-            where_itemIds = " AND itemid = ANY(ARRAY[" + ",".join([str(itemid) for itemid in itemIds]) + "])"
+            return " AND itemid = ANY(ARRAY[" + ",".join([str(itemid) for itemid in itemIds]) + "])"
+        return ""
+
+    def _route_itemIds(self, itemIds: List[int]) -> List[List[int]]:
+        """
+        itemIds stored in each of history_tables / trends_tables by their value_type.
+        [] reads the whole table and None skips it.
+        Items not in the catalog yet are read from both tables.
+        """
+        if len(itemIds) == 0:
+            return [[] for _ in self.table_value_types]
+        value_types = self.catalog.get_value_types(itemIds)
+        routes = []
+        for value_type in self.table_value_types:
+            table_itemIds = [itemId for itemId in itemIds if value_types.get(itemId, value_type) == value_type]
+            routes.append(table_itemIds if len(table_itemIds) > 0 else None)
+        return routes
+
+    def _table_sqls(self, tables: List[str], columns: str, startep: int, endep: int, 
+                    itemIds: List[int] = []) -> List[str]:
+        sqls = []
+        for table, table_itemIds in zip(tables, self._route_itemIds(itemIds)):
+            if table_itemIds is None:
+                continue
+            sqls.append(f"""
+            SELECT {columns}
+            FROM {table}
+            WHERE clock >= {startep} AND clock <= {endep}
+            {self._where_itemIds(table_itemIds)}
+        """)
+        if len(sqls) == 0:
+            # none of itemIds is numeric
+            sqls.append(f"SELECT {columns} FROM {tables[0]} WHERE false")
+        return sqls
+
+    def _history_sqls(self, startep: int, endep: int, itemIds: List[int] = []) -> List[str]:
+        return self._table_sqls(self.history_tables, "itemid, clock, value", startep, endep, itemIds)
+
+    def _rebucket_trends(self) -> bool:
+        # Zabbix trends are hourly
+        return self.trends_rebucket and self.trends_interval > 3600
+
+    def _rebucket_sql(self, sql: str, full: bool) -> str:
+        """ hourly trends of sql on the trends_interval grid. avg is weighted by the number of values. """
+        u = self.trends_interval
+        value_avg = "coalesce(sum(value_avg * num) / nullif(sum(num), 0), avg(value_avg))"
+        if full:
+            columns = f"min(value_min) AS value_min, {value_avg} AS value_avg, max(value_max) AS value_max"
         else:
-            where_itemIds = ""
-        
-        # join history and history_uint tables
+            columns = f"{value_avg} AS value"
+        return f"""
+            SELECT itemid, clock - clock % {u} AS clock, {columns}
+            FROM ({sql}) t
+            GROUP BY 1, 2
+        """
+
+    def _trends_sqls(self, startep: int, endep: int, itemIds: List[int] = [], 
+                     rebucket: bool = True) -> List[str]:
+        if rebucket and self._rebucket_trends():
+            return [self._rebucket_sql(sql, False) for sql in self._table_sqls(
+                self.trends_tables, "itemid, clock, num, value_avg", startep, endep, itemIds)]
+        return self._table_sqls(self.trends_tables, "itemid, clock, value_avg as value", startep, endep, itemIds)
+
+    def _trends_full_sqls(self, startep: int, endep: int, itemIds: List[int] = []) -> List[str]:
+        if self._rebucket_trends():
+            return [self._rebucket_sql(sql, True) for sql in self._table_sqls(
+                self.trends_tables, "itemid, clock, num, value_min, value_avg, value_max", startep, endep, itemIds)]
+        return self._table_sqls(self.trends_tables, "itemid, clock, value_min, value_avg, value_max", 
+                                startep, endep, itemIds)
+
+    def _history_sql(self, startep: int, endep: int, itemIds: List[int] = []) -> str:
+        return "UNION ALL".join(self._history_sqls(startep, endep, itemIds))
+
+    def _trends_sql(self, startep: int, endep: int, itemIds: List[int] = []) -> str:
+        # the hourly trends. the trends stats (cnt, mean, std) are over hourly values even when rebucketed.
+        return "UNION ALL".join(self._trends_sqls(startep, endep, itemIds, rebucket=False))
+
+    async def _aread_sqls(self, sqls: List[str], dtypes: Dict[str, str]) -> pd.DataFrame:
+        # one statement per table, running at the same time
+        dfs = await asyncio.gather(*[self.adb.read_sql_columnar(sql, dtypes) for sql in sqls])
+        return pd.concat(dfs, ignore_index=True) if len(dfs) > 1 else dfs[0]
+
+    def _read_sqls(self, sqls: List[str], dtypes: Dict[str, str]) -> pd.DataFrame:
+        if len(sqls) == 1:
+            return self.db.read_sql_columnar(sqls[0], dtypes)
+        # reads the tables of a value type at the same time.
+        # threads rather than an event loop: callers may run inside one
+        with ThreadPoolExecutor(max_workers=len(sqls), thread_name_prefix="zabbix_read") as executor:
+            dfs = list(executor.map(lambda sql: self.db.read_sql_columnar(sql, dtypes), sqls))
+        return pd.concat(dfs, ignore_index=True)
+
+    def _aggregates_sql(self, sql: str) -> str:
+        return f"""
+            SELECT itemid, coalesce(sum(value::float8), 0) AS sum, 
+                coalesce(sum(value::float8 * value::float8), 0) AS sqr_sum, count(value) AS cnt
+            FROM ({sql}) d
+            GROUP BY itemid
+        """
+
+    def get_history_aggregates(self, startep: int, endep: int, itemIds: List[int] = []) -> pd.DataFrame:
+        sql = self._aggregates_sql(self._history_sql(startep, endep, itemIds))
+        return self.db.read_sql_columnar(sql, aggregate_dtypes)
+
+    def get_trends_aggregates(self, startep: int, endep: int, itemIds: List[int] = []) -> pd.DataFrame:
+        sql = self._aggregates_sql(self._trends_sql(startep, endep, itemIds))
+        return self.db.read_sql_columnar(sql, aggregate_dtypes)
+
+    def get_history_buckets(self, startep: int, endep: int, unitsecs: int, 
+                            itemIds: List[int] = []) -> pd.DataFrame:
         sql = f"""
-            SET TRANSACTION ISOLATION LEVEL READ COMMITTED;
-            SELECT itemid, clock, value
-            FROM history
-            WHERE clock BETWEEN {startep} AND {endep}
-            {where_itemIds}
-            UNION ALL
-            SELECT itemid, clock, value
-            FROM history_uint
-            WHERE clock BETWEEN {startep} AND {endep}
-            {where_itemIds}
+            SELECT itemid, clock + (({unitsecs} - clock % {unitsecs}) % {unitsecs}) AS clock, avg(value::float8) AS value
+            FROM ({self._history_sql(startep, endep, itemIds)}) d
+            GROUP BY 1, 2
         """
+        return self.db.read_sql_columnar(sql, self.dtypes)
 
-        df = self.db.read_sql(sql)
-        if len(df) == 0:
-            return pd.DataFrame(columns=self.fields, dtype=object)
-        df.columns = self.fields
+    def get_history_data(self, startep: int, endep: int, itemIds: List[int] = []) -> pd.DataFrame:
+        df = self._read_sqls(self._history_sqls(startep, endep, itemIds), self.dtypes)
         # sort by itemid and clock
         df = df.sort_values(['itemid', 'clock'])
         return df
-    
 
-    def get_trends_data(self, startep: int, endep: int, itemIds: List[int] = []) -> pd.DataFrame:
-        if len(itemIds) > 0:
-            where_itemIds = " AND itemid = ANY(ARRAY[" + ",".join([str(itemid) for itemid in itemIds]) + "])"
-        else:
-            where_itemIds = ""
-        
-        # join trends and trends_uint tables
-        sql = f"""
-            SET TRANSACTION ISOLATION LEVEL READ COMMITTED;
-            SELECT itemid, clock, value_avg as value
-            FROM trends
-            WHERE clock BETWEEN {startep} AND {endep}
-            {where_itemIds}
-            UNION
-            SELECT itemid, clock, value_avg as value
-            FROM trends_uint
-            WHERE clock BETWEEN {startep} AND {endep}
-            {where_itemIds}
-        """
+    def _iter_sqls(self, sqls: List[str], columns: List[str], chunksize: int, 
+                   dtypes: Dict[str, str]) -> Iterator[pd.DataFrame]:
+        # one table after the other, each through a server-side cursor
+        for sql in sqls:
+            yield from self.db.read_sql_chunks(sql, columns, chunksize, dtypes=dtypes)
 
-        df = self.db.read_sql(sql)
-        if len(df) == 0:
-            return pd.DataFrame(columns=self.fields, dtype=object)
-        df.columns = self.fields
+    def iter_history_data(self, startep: int, endep: int, itemIds: List[int] = [], 
+                          chunksize: int = 0) -> Iterator[pd.DataFrame]:
+        return self._iter_sqls(self._history_sqls(startep, endep, itemIds), self.fields, chunksize, self.dtypes)
+
+    def get_trends_data(self, startep: int, endep: int, itemIds: List[int] = []) -> pd.DataFrame:
+        df = self._read_sqls(self._trends_sqls(startep, endep, itemIds), self.dtypes)
         # sort by itemid and clock
         df = df.sort_values(['itemid', 'clock'])
         return df
-    
-    def get_trends_full_data(self, startep: int, endep: int, itemIds: List[int] = []) -> pd.DataFrame:
-        if len(itemIds) > 0:
-            where_itemIds = " AND itemid IN (" + ",".join([str(itemid) for itemid in itemIds]) + ")"
-        else:
-            where_itemIds = ""
-        
-        sql = f"""
-            SET TRANSACTION ISOLATION LEVEL READ COMMITTED;
-            SELECT itemid, clock, value_min, value_avg, value_max
-            FROM trends
-            WHERE clock >= {startep} AND clock <= {endep}
-            {where_itemIds}
-            UNION ALL
-            SELECT itemid, clock, value_min, value_avg, value_max
-            FROM trends_uint
-            WHERE clock >= {startep} AND clock <= {endep}
-            {where_itemIds}
-        """
 
-        df = self.db.read_sql(sql)
-        if len(df) == 0:
-            return pd.DataFrame(columns=['itemid', 'clock', 'value_min', 'value_avg', 'value_max'], dtype=object)
-        df.columns = self.fields_full
+    def iter_trends_data(self, startep: int, endep: int, itemIds: List[int] = [], 
+                         chunksize: int = 0) -> Iterator[pd.DataFrame]:
+        return self._iter_sqls(self._trends_sqls(startep, endep, itemIds), self.fields, chunksize, self.dtypes)
+
+    def get_trends_full_data(self, startep: int, endep: int, itemIds: List[int] = []) -> pd.DataFrame:
+        df = self._read_sqls(self._trends_full_sqls(startep, endep, itemIds), self.dtypes_full)
         # sort by itemid and clock
         df = df.sort_values(['itemid', 'clock'])
         return df
 
 
+    async def aget_history_data(self, startep: int, endep: int, itemIds: List[int] = []) -> pd.DataFrame:
+        df = await self._aread_sqls(self._history_sqls(startep, endep, itemIds), self.dtypes)
+        return df.sort_values(['itemid', 'clock'])
+
+    async def aget_trends_data(self, startep: int, endep: int, itemIds: List[int] = []) -> pd.DataFrame:
+        df = await self._aread_sqls(self._trends_sqls(startep, endep, itemIds), self.dtypes)
+        return df.sort_values(['itemid', 'clock'])
+
+    async def aget_trends_full_data(self, startep: int, endep: int, itemIds: List[int] = []) -> pd.DataFrame:
+        df = await self._aread_sqls(self._trends_full_sqls(startep, endep, itemIds), self.dtypes_full)
+        return df.sort_values(['itemid', 'clock'])
+
+
     def get_itemIds(self, item_names: List[str] = [], 
                     host_names: List[str] = [], 
                     group_names: List[str] = [],
                     itemIds: List[int] = [],
                     max_itemIds = 0) -> List[int]:
-        where_conds = []
-        # if names includes '*', convert them to '%' and use LIKE operator
-        # else use '=' operator
-        names_list = [("items", item_names), ("hosts", host_names), ("hstgrp", group_names)]
-        for (table_name, names) in names_list:
-            if len(names) > 0:
-                name_conds = []
-                for name in names:
-                    if '*' in name or '%' in name:
-                        name_conds.append(f"{table_name}.name LIKE '{name.replace('*', '%')}'")
-                    else:
-                        name_conds.append(f"{table_name}.name = '{name}' OR {table_name}.name LIKE '{name}/%'")
-                where_conds.append("(" + " OR ".join(name_conds) + ")")
-
-        if len(itemIds) > 0:
-            where_conds.append(" itemId IN (%s)" % ",".join(map(str, itemIds)))
-
-        if where_conds:
-            where_itemIds = "WHERE " + " AND ".join(where_conds)
-        else:
-            where_itemIds = ""
-
-        limitcond = ""
-        if max_itemIds > 0:
-            limitcond = f" limit {max_itemIds}"
-        
-        sql = f"""
-            SELECT items.itemid
-            FROM hosts 
-            inner join items on hosts.hostid = items.hostid
-            inner join hosts_groups on hosts_groups.hostid = hosts.hostid
-            inner join hstgrp on hstgrp.groupid = hosts_groups.groupid 
-            {where_itemIds}
-            {limitcond}
-        """
-
-        cur = self.db.exec_sql(sql)
-        rows = cur.fetchall()
-        cur.close()
-        if len(rows) == 0:
-            return []
-        return [row[0] for row in rows]
-    
-
+        return self.catalog.get_itemIds(item_names, host_names, group_names, itemIds, max_itemIds)
 
     def get_item_host_dict(self, itemIds: List[int] = []) -> Dict[int, int]:
-        if len(itemIds) > 0:
-            where_itemIds = "WHERE itemid IN (" + ",".join([str(itemid) for itemid in itemIds]) + ")"
-        else:
-            where_itemIds = ""
-        
-        sql = f"""
-            SELECT itemid, hostid
-            FROM items
-            {where_itemIds}
-        """
-
-        cur = self.db.exec_sql(sql)
-        rows = cur.fetchall()
-        cur.close()
-        if len(rows) == 0:
-            return {}
-        return {row[0]: row[1] for row in rows}
-    
+        return self.catalog.get_item_host_dict(itemIds)
 
     def classify_by_groups(self, itemIds: List[int], group_names: List[str]) -> Dict[str, List[int]]:
         if len(group_names) == 0:
@@ -188,61 +225,11 @@ class ZabbixGetter(DataGetter):
         if len(itemIds) == 0:
             return {"all": []}
         
-        cond_itemIds = "AND itemid IN (" + ",".join([str(itemid) for itemid in itemIds]) + ")"
-
-        
-        # get groupid from given group_names considering sub groups.
-        # ex) app/sim/rp is sub group of app/sim
-        groups = {}
-        for group_name in group_names:
-            sql = f"""
-                SELECT distinct items.itemid
-                FROM items 
-                inner join hosts on hosts.hostid = items.hostid
-                inner join hosts_groups on hosts_groups.hostid = hosts.hostid
-                inner join hstgrp on hstgrp.groupid = hosts_groups.groupid 
-                WHERE (hstgrp.name = '{group_name}' OR hstgrp.name LIKE '{group_name}/%') 
-                {cond_itemIds}
-            """
-
-            cur = self.db.exec_sql(sql)
-            rows = cur.fetchall()
-            cur.close()
-            if len(rows) == 0:
-                continue
-
-            group_info = [row[0] for row in rows]
-            if len(group_info) > 0: 
-                groups[group_name] = group_info
-
-        return groups
-            
+        # sub groups belong to the group. ex) app/sim/rp is sub group of app/sim
+        return self.catalog.classify_by_groups(itemIds, group_names)
 
     def get_item_relations(self, itemIds: List[int], group_names: List[str]) -> pd.DataFrame:
-        df = pd.DataFrame()
-        if len(itemIds) > 0:
-            where_itemIds = "AND items.itemid IN (" + ",".join([str(itemid) for itemid in itemIds]) + ")"
-        for name in group_names:
-            where_cond = ""
-            if '*' in name or '%' in name:
-                where_cond = f"hstgrp.name LIKE '{name.replace('*', '%')}'"
-            else:
-                where_cond = f"hstgrp.name = '{name}' or hstgrp.name LIKE '{name}/%'"
-            sql = f"""select '{name}' as group_name, hosts.hostid, items.itemid
-                from hosts 
-                inner join items on hosts.hostid = items.hostid
-                inner join hosts_groups on hosts_groups.hostid = hosts.hostid
-                inner join hstgrp on hstgrp.groupid = hosts_groups.groupid 
-                where {where_cond}
-                {where_itemIds}
-            """
-            df = pd.concat([df, self.db.read_sql(sql)], ignore_index=True)
-        numeric_cols = df.select_dtypes(include=['float']).columns
-        df[numeric_cols] = df[numeric_cols].astype(int)
-        df.columns = ['group_name', 'hostid', 'itemid']
-        return df
-
-
+        return self.catalog.get_item_relations(itemIds, group_names)
 
     def get_item_details(self, itemIds: List[int]) -> Dict:
         """
@@ -256,53 +243,19 @@ class ZabbixGetter(DataGetter):
         """
         if len(itemIds) == 0:
             return {}
-        
-        where_itemIds = "WHERE itemid IN (" + ",".join([str(itemid) for itemid in itemIds]) + ")"
-        sql = f"""
-            SELECT items.itemid, hosts.hostid, hosts.name as host_name, items.name as item_name
-            FROM items 
-            inner join hosts on hosts.hostid = items.hostid
-            {where_itemIds}
-        """
-
-        cur = self.db.exec_sql(sql)
-        rows = cur.fetchall()
-        cur.close()
-        if len(rows) == 0:
-            return {}
-        return {row[0]: {"hostid": row[1], "host_name": row[2], "item_name": row[3]} for row in rows}
+        return self.catalog.get_item_details(itemIds)
     
     # check if the itemid meets the condition
     def check_itemId_cond(self, itemIds: List[int], item_cond: str) -> bool:
         if item_cond == "":
             return itemIds
-        sql = f"""
-            SELECT itemid
-            FROM items
-            WHERE itemid IN ({",".join(map(str, itemIds))}) AND {item_cond}
-        """
-        cur = self.db.exec_sql(sql)
-        rows = cur.fetchall()
-        cur.close()
-        
-        return [row[0] for row in rows]
-    
+        return self.catalog.check_itemId_cond(itemIds, item_cond)
 
-    def get_items_details(self, itemIds: List[int]) -> pd.DataFrame:
-        sql = f"""
-            select hstgrp.name as group_name, hosts.hostid as hostid, hosts.host as host_name, items.itemid as itemid, items.key_ item_name
-                from hosts 
-                inner join items on hosts.hostid = items.hostid
-                inner join hosts_groups on hosts_groups.hostid = hosts.hostid
-                inner join hstgrp on hstgrp.groupid = hosts_groups.groupid 
-                where itemid IN ({",".join(map(str, itemIds))})
-        """
-
-        df = self.db.read_sql(sql)
-        df.columns = ['group_name', 'hostid', 'host_name', 'itemid', 'item_name']
+    def get_cond_itemIds(self, item_cond: str) -> List[int]:
+        return self.catalog.get_cond_itemIds(item_cond)
 
-        return df
-    
+    def get_items_details(self, itemIds: List[int]) -> pd.DataFrame:
+        return self.catalog.get_items_details(itemIds)
 
     def get_group_map(self, itemIds: List[int], group_names: List[str]) -> Dict[int, str]:
         if len(itemIds) == 0:
@@ -310,29 +263,7 @@ class ZabbixGetter(DataGetter):
         
         if len(group_names) == 0:
             return {}
-        
-        group_map = {}
-        for group_name in group_names:
-            sql = f"""
-                SELECT items.itemid
-                FROM hosts 
-                inner join items on hosts.hostid = items.hostid
-                inner join hosts_groups on hosts_groups.hostid = hosts.hostid
-                inner join hstgrp on hstgrp.groupid = hosts_groups.groupid 
-                WHERE (hstgrp.name = '{group_name}' OR hstgrp.name LIKE '{group_name}/%') 
-                AND items.itemid IN ({",".join(map(str, itemIds))})
-            """
-
-            cur = self.db.exec_sql(sql)
-            rows = cur.fetchall()
-            cur.close()
-            if len(rows) == 0:
-                continue
-
-            for row in rows:
-                group_map[row[0]] = group_name
-
-        return group_map
+        return self.catalog.get_group_map(itemIds, group_names)
     
     def get_item_html_title(self, itemId: int, chart_type="") -> str:
         # link to zabbix chart 
@@ -3,6 +3,9 @@ import numpy as np
 from typing import Dict, List, Tuple
 import logging
 import time
+import asyncio
+import threading
+from collections import deque
 
 
 from utils import normalizer
@@ -10,6 +13,7 @@ import utils.config_loader as config_loader
 import data_getter
 from models.models_set import ModelsSet
 from data_processing.history_stats import HistoryStats
+from data_processing.item_conds import ItemConds
 
 
 
@@ -18,6 +22,14 @@ def log(msg, level=logging.INFO):
     logging.log(level, msg)
 
 
+async def _cancel_tasks():
+    """ cancel the other tasks of the running loop and wait for them """
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
 class Detector:
     def __init__(self, data_source_name, data_source: Dict, 
                  itemIds: List[int] = [], 
@@ -27,6 +39,7 @@ class Detector:
         config = config_loader.conf
         self.skip_history_update = skip_history_update
         self.batch_size = config['batch_size']
+        self.max_inflight_batches = config.get('max_inflight_batches', 2)
         self.detect1_lambda_threshold = config['detect1_lambda_threshold']
         self.detect2_lambda_threshold = config['detect2_lambda_threshold']
         self.detect3_lambda_threshold1 = config['detect3_lambda_threshold1']
@@ -40,13 +53,14 @@ class Detector:
         self.trends_retention = config["trends_retention"]
         self.anomaly_valid_count_rate = config["anomaly_valid_count_rate"]
         self.anomaly_keep_secs = config["anomaly_keep_secs"]
+        self.history_cache = config.get("history_cache", True)
         
         self.data_source = data_source
         self.data_source_name = data_source_name
-        self.item_conds = data_source.get("item_conds", {})
-        self.item_diff_conds = data_source.get("item_diff_conds", {})
-        
         self.dg = data_getter.get_data_getter(data_source)
+        # filters are resolved to item ids on first use, once per run
+        self.item_conds = ItemConds(self.dg, data_source.get("item_conds", []))
+        self.item_diff_conds = ItemConds(self.dg, data_source.get("item_diff_conds", []))
         self.ms = ModelsSet(data_source_name)
         self.max_itemIds = max_itemIds
         
@@ -59,7 +73,8 @@ class Detector:
 
     def initialize_data(self):
         ms = self.ms
-        ms.history.truncate()
+        ms.aligned_history.truncate()
+        ms.history_watermarks.truncate()
         ms.history_stats.truncate()
         ms.history_updates.truncate()
         ms.anomalies.truncate()
@@ -88,7 +103,8 @@ class Detector:
         if oldendep > 0:
             if startep > oldendep + history_interval*2:
                 ms.history_updates.truncate()
-                ms.history.truncate()
+                ms.aligned_history.truncate()
+                ms.history_watermarks.truncate()
                 ms.history_stats.truncate()
                 diff_startep = startep
             else:
@@ -123,29 +139,84 @@ class Detector:
         batch_size = self.batch_size
         for i in range(0, len(itemIds), batch_size):
             batch_itemIds = itemIds[i:i+batch_size]
-            hist_df = dg.get_history_data(startep=base_clocks[0], endep=base_clocks[-1], itemIds=batch_itemIds)
-            if hist_df.empty:
-                return 
-            
-            for itemId in batch_itemIds:
-                item_hist_df = hist_df[hist_df['itemid'] == itemId]
-                if item_hist_df.empty:
+            for fetch_itemIds, fetch_clocks in self._get_history_fetches(batch_itemIds, base_clocks):
+                # mean per item and base clock, computed by the data source.
+                # starts after the base clock before fetch_clocks, so the first bucket is complete.
+                hist_df = dg.get_history_buckets(startep=fetch_clocks[0] - history_interval + 1, 
+                                                 endep=fetch_clocks[-1], unitsecs=history_interval, 
+                                                 itemIds=fetch_itemIds)
+
+                # only the gaps are filled on this side
+                if hist_df.empty:
+                    upsert_itemIds, matrix = [], np.empty((0, len(fetch_clocks)))
+                else:
+                    upsert_itemIds, matrix = normalizer.fill_base_clocks(fetch_clocks, hist_df)
+                if fetch_clocks[0] != base_clocks[0]:
+                    # items that stopped reporting keep their last value, 
+                    # so that all series stay as long as base_clocks
+                    fetched = set(upsert_itemIds)
+                    stalled_itemIds, stalled_matrix = self._fill_stalled(
+                        [itemId for itemId in fetch_itemIds if itemId not in fetched], 
+                        fetch_clocks, base_clocks[0])
+                    upsert_itemIds = upsert_itemIds + stalled_itemIds
+                    matrix = np.vstack([matrix, stalled_matrix])
+                if len(upsert_itemIds) == 0:
                     continue
 
-                # sort by clock
-                item_hist_df = item_hist_df.sort_values(by='clock')
-
-                values = normalizer.fit_to_base_clocks(
-                    base_clocks, 
-                    item_hist_df['clock'].tolist(), 
-                    item_hist_df['value'].tolist())
-                ms.history.upsert([itemId]*len(base_clocks), base_clocks, values)
+                # write the whole batch at once
+                if fetch_clocks[0] == base_clocks[0]:
+                    ms.aligned_history.upsert_matrix(upsert_itemIds, fetch_clocks, matrix)
+                else:
+                    ms.aligned_history.append_matrix(upsert_itemIds, fetch_clocks, matrix)
+                if self.history_cache:
+                    # the rows of all items written reach the last base clock fetched.
+                    # items without any rows stay cold and get the whole window when they report again.
+                    ms.history_watermarks.upsert_watermarks(
+                        {int(itemId): int(fetch_clocks[-1]) for itemId in upsert_itemIds})
 
             if oldep > 0:
                 # delete old history data
-                ms.history.remove_old_data(oldep)
+                ms.aligned_history.remove_old_data(oldep)
 
 
+    def _get_history_fetches(self, itemIds: List[int], base_clocks: List[int]) -> List[Tuple[List[int], List[int]]]:
+        """
+        (itemIds, base clocks to update) to fetch from the data source.
+        Items fetched before within base_clocks only need the base clocks 
+        from the one holding their watermark (the last base clock written).
+        """
+        if not self.history_cache:
+            return [(itemIds, base_clocks)]
+        history_interval = self.history_interval
+        watermarks = self.ms.history_watermarks.get_watermarks(itemIds)
+        cold = [itemId for itemId in itemIds if watermarks.get(itemId, 0) < base_clocks[0]]
+        fetches = []
+        if len(cold) > 0:
+            fetches.append((cold, base_clocks))
+        # one fetch per base clock the watermarks are in.
+        # the base clock at or before the watermark may have been computed with partial data.
+        groups: Dict[int, List[int]] = {}
+        for itemId in itemIds:
+            watermark = watermarks.get(itemId, 0)
+            if watermark >= base_clocks[0]:
+                groups.setdefault(watermark - watermark % history_interval, []).append(itemId)
+        for startep, cached in sorted(groups.items()):
+            fetch_clocks = [clock for clock in base_clocks if clock >= startep]
+            if len(fetch_clocks) > 0:
+                fetches.append((cached, fetch_clocks))
+        return fetches
+
+    def _fill_stalled(self, itemIds: List[int], fetch_clocks: List[int], startep: int) -> Tuple[List[int], np.ndarray]:
+        """ (itemIds, items x fetch_clocks matrix) repeating the last value stored from startep to fetch_clocks[0] """
+        if len(itemIds) == 0:
+            return [], np.empty((0, len(fetch_clocks)))
+        df = self.ms.aligned_history.get_data(itemIds, startep, fetch_clocks[0])
+        if df.empty:
+            return [], np.empty((0, len(fetch_clocks)))
+        last = df.groupby('itemid')['value'].last()
+        return ([int(itemId) for itemId in last.index], 
+                np.repeat(last.to_numpy(dtype=np.float64)[:, None], len(fetch_clocks), axis=1))
+
         
     def detect1(self) -> List[int]:
         batch_size = self.batch_size
@@ -166,25 +237,6 @@ class Detector:
         return anomaly_itemIds
 
 
-    def _evaluate_cond(self, value: float, cond: Dict) -> bool:
-        if "condition" not in cond.keys():
-            return False
-
-        operator = cond["condition"].get("operator", "")
-        threshold = cond["condition"].get("value", "")
-        if operator == ">":
-            return value > threshold
-        elif operator == "<":
-            return value < threshold
-        elif operator == "=":
-            return value == threshold
-        elif operator == ">=":
-            return value >= threshold
-        elif operator == "<=":
-            return value <= threshold
-        return False
-
-
     def detect1_batch(self, itemIds: List[int], 
         t_stats: pd.DataFrame) -> List[int]:
         ms = self.ms
@@ -215,47 +267,16 @@ class Detector:
         if len(h_stats_df) == 0:
             return []
 
-        # get itemIds
-        itemIds = h_stats_df['itemid'].tolist()
-        itemIds = list(set(itemIds))
-
-        dg = self.dg
-
-        # filter by defined conds
-        #log(f"detector.filter_by_cond(itemIds)")
-        item_conds = self.item_conds
-        if len(item_conds) > 0 and len(itemIds) > 0:
-            for cond in item_conds:
-                #if cond['filter'] == "key_ LIKE 'vmware.vm.guest.osuptime%'":
-                #    print("")
-                if len(itemIds) == 0:
-                    break
-                itemIds2 = dg.check_itemId_cond(itemIds, cond["filter"])
-                for itemId in itemIds2:    
-                    value = means[means['itemid'] == itemId].iloc[0]['mean']
-                    if self._evaluate_cond(value, cond) == False:
-                        itemIds.remove(itemId)
-
-
-        if len(itemIds) == 0:
+        # filter by defined conds on the history mean
+        h_stats_df = self.item_conds.filter(h_stats_df, 'mean_h')
+        if len(h_stats_df) == 0:
             return []
 
         # filter by defined diff conds
-        item_diff_conds = self.item_diff_conds
-        h_stats_df['diff'] = abs(h_stats_df['mean_h'] - h_stats_df['mean_t'])
-
-        if len(item_diff_conds) > 0 and len(itemIds) > 0:
-            for cond in item_diff_conds:
-                if len(itemIds) == 0:
-                    break
-                itemIds2 = dg.check_itemId_cond(itemIds, cond['filter'])
-                for itemId in itemIds2:
-                    #if cond['filter'] == "key_ LIKE 'vmware.vm.guest.osuptime%'":
-                    #    print("")
-                    value = h_stats_df[h_stats_df['itemid'] == itemId].iloc[0]['diff']
-                    if self._evaluate_cond(value, cond) == False:
-                        itemIds.remove(itemId)
-        
+        h_stats_df = h_stats_df.assign(diff=abs(h_stats_df['mean_h'] - h_stats_df['mean_t']))
+        h_stats_df = self.item_diff_conds.filter(h_stats_df, 'diff')
+
+        itemIds = list(set(h_stats_df['itemid'].tolist()))
         return itemIds
     
 
@@ -265,12 +286,52 @@ class Detector:
         trends_df = dg.get_trends_full_data(itemIds=itemIds, startep=t_start, endep=h_start)
         if trends_df.empty:
             return pd.DataFrame(),pd.DataFrame()
-        history_df = ms.history.get_data(itemIds, startep=h_start, endep=h_end)
+        history_df = ms.aligned_history.get_data(itemIds, startep=h_start, endep=h_end)
         if history_df.empty:
             return pd.DataFrame(),pd.DataFrame()
 
         return trends_df, history_df
 
+    async def _aget_df(self, itemIds: List[int], t_start: int, h_start: int, h_end: int) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        # trends from the data source and history from admdb at the same time
+        trends_df, history_df = await asyncio.gather(
+            self.dg.aget_trends_full_data(itemIds=itemIds, startep=t_start, endep=h_start),
+            self.ms.aligned_history.aget_data(itemIds, startep=h_start, endep=h_end))
+        if trends_df.empty or history_df.empty:
+            return pd.DataFrame(),pd.DataFrame()
+        return trends_df, history_df
+
+    def _iter_batch_dfs(self, itemIds: List[int], t_start: int, h_start: int, h_end: int):
+        """
+        yields (batch_itemIds, trends_df, history_df) per batch in order.
+        The batches are fetched on an event loop of a background thread, so 
+        the next max_inflight_batches - 1 batches, queries and post processing,
+        keep running while the caller processes the current one.
+        """
+        batch_size = self.batch_size
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, name="batch_fetcher", daemon=True)
+        thread.start()
+        pending = deque()
+        try:
+            for i in range(0, len(itemIds), batch_size):
+                batch_itemIds = itemIds[i:i+batch_size]
+                future = asyncio.run_coroutine_threadsafe(
+                    self._aget_df(batch_itemIds, t_start, h_start, h_end), loop)
+                pending.append((batch_itemIds, future))
+                if len(pending) >= self.max_inflight_batches:
+                    batch_itemIds, future = pending.popleft()
+                    yield (batch_itemIds, *future.result())
+            while len(pending) > 0:
+                batch_itemIds, future = pending.popleft()
+                yield (batch_itemIds, *future.result())
+        finally:
+            if len(pending) > 0:
+                asyncio.run_coroutine_threadsafe(_cancel_tasks(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
 
     def _detect_diff_anomalies(self, itemIds: List[int], 
                             trends_df: pd.DataFrame, recent_stats: pd.DataFrame, 
@@ -346,7 +407,6 @@ class Detector:
 
 
     def detect2(self, itemIds: List[int], endep: int) -> List[int]:
-        batch_size = self.batch_size
         if len(itemIds) == 0:
             itemIds = self.itemIds        
         log(f"detector.detect2: itemIds: {len(itemIds)}")
@@ -356,9 +416,7 @@ class Detector:
         
 
         anomaly_itemIds = []
-        for i in range(0, len(itemIds), batch_size):
-            batch_itemIds = itemIds[i:i+batch_size]
-            trends_df, history_df = self._get_df(batch_itemIds, t_start=t_start, h_start=h_start, h_end=endep)
+        for batch_itemIds, trends_df, history_df in self._iter_batch_dfs(itemIds, t_start=t_start, h_start=h_start, h_end=endep):
             if trends_df.empty or history_df.empty:
                 continue
 
@@ -501,8 +559,8 @@ class Detector:
         trends_min.columns = ['itemid', 'clock', 'value']
 
         
-        # get history data
-        history_df1 = ms.history.get_data(itemIds)
+        # get history data. one fetch for the whole batch
+        history_df1 = ms.aligned_history.get_data(itemIds)
         if history_df1.empty:
             return []
         
@@ -549,7 +607,6 @@ class Detector:
 
     
     def detect3(self, itemIds: List[int], endep: int) -> List[int]:
-        batch_size = self.batch_size
         if len(itemIds) == 0:
             itemIds = self.itemIds
         t_start = endep - self.trends_interval * self.trends_retention
@@ -558,9 +615,7 @@ class Detector:
         log(f"detector.detect3: itemIds: {len(itemIds)}")
 
         anomaly_itemIds = []
-        for i in range(0, len(itemIds), batch_size):
-            batch_itemIds = itemIds[i:i+batch_size]
-            trends_df, history_df = self._get_df(batch_itemIds, t_start=t_start, h_start=h_start, h_end=endep)
+        for batch_itemIds, trends_df, history_df in self._iter_batch_dfs(itemIds, t_start=t_start, h_start=h_start, h_end=endep):
             if trends_df.empty or history_df.empty:
                 continue
 
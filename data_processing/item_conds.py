@@ -0,0 +1,69 @@
+"""
+item_conds / item_diff_conds of a data source
+
+Each condition has a SQL filter on the data source's items and an optional
+threshold (condition: {operator, value}). Items meeting the filter are kept
+only when their value passes the threshold.
+The filters are resolved to item id sets once, then the thresholds are
+applied as masks over all candidates at once.
+"""
+import operator as op
+import logging
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+def log(msg, level=logging.INFO):
+    msg = f"[data_processing/item_conds.py] {msg}"
+    logging.log(level, msg)
+
+
+operators = {
+    ">": op.gt,
+    "<": op.lt,
+    "=": op.eq,
+    ">=": op.ge,
+    "<=": op.le,
+}
+
+
+class ItemConds:
+    def __init__(self, dg, conds: List[Dict]):
+        self.dg = dg
+        self.conds = conds
+        # (cond, itemIds meeting its filter)
+        self.resolved: List[Tuple[Dict, np.ndarray]] = None
+
+    def resolve(self) -> List[Tuple[Dict, np.ndarray]]:
+        if self.resolved is None:
+            self.resolved = []
+            for cond in self.conds:
+                itemIds = np.asarray(self.dg.get_cond_itemIds(cond["filter"]), dtype=np.int64)
+                log(f"{cond.get('name', cond['filter'])}: {len(itemIds)} items")
+                self.resolved.append((cond, itemIds))
+        return self.resolved
+
+    def passes(self, values: np.ndarray, cond: Dict) -> np.ndarray:
+        """ mask of values passing the threshold of cond. no threshold passes nothing. """
+        condition = cond.get("condition")
+        if not condition:
+            return np.zeros(len(values), dtype=bool)
+        func = operators.get(condition.get("operator", ""))
+        threshold = condition.get("value", "")
+        if func is None or threshold == "":
+            return np.zeros(len(values), dtype=bool)
+        return func(values, threshold)
+
+    def filter(self, df: pd.DataFrame, value_col: str) -> pd.DataFrame:
+        """ rows of df (itemid, value_col) whose items meet every condition """
+        if len(self.conds) == 0 or df.empty:
+            return df
+        itemIds = df["itemid"].to_numpy()
+        values = df[value_col].to_numpy(dtype=np.float64)
+        keep = np.ones(len(df), dtype=bool)
+        for cond, cond_itemIds in self.resolve():
+            matched = np.isin(itemIds, cond_itemIds)
+            keep &= ~matched | self.passes(values, cond)
+        return df[keep]
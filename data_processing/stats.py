@@ -4,7 +4,6 @@ import numpy as np
 import utils.config_loader as config_loader
 import data_getter
 from models.models_set import ModelsSet
-import utils
 
 
 class Stats:
@@ -32,11 +31,12 @@ class Stats:
         self.ms = ModelsSet(data_source_name)
         
 
-    def _get_data(self, startep: int, endep: int, itemIds: List[int]):
+    def _aggregate_data(self, startep: int, endep: int, itemIds: List[int]) -> pd.DataFrame:
+        # sum, sqr_sum, count per item, computed by the data source
         if self.data_type == "trends":
-            return self.dg.get_trends_data(startep=startep, endep=endep, itemIds=itemIds)
+            return self.dg.get_trends_aggregates(startep=startep, endep=endep, itemIds=itemIds)
         elif self.data_type == "history":
-            return self.dg.get_history_data(startep=startep, endep=endep, itemIds=itemIds)
+            return self.dg.get_history_aggregates(startep=startep, endep=endep, itemIds=itemIds)
         
     def _get_stats(self, itemIds: List[int]):
         if self.data_type == "trends":
@@ -53,30 +53,17 @@ class Stats:
     def _upsert_stats(self, stats: pd.DataFrame):
         ms = self.ms
         if self.data_type == "trends":
-            for _, row in stats.iterrows():
-                ms.trends_stats.upsert_stats(
-                    row['itemid'], row['sum'], row['sqr_sum'], row['cnt'], 
-                    row['mean'], row['std']
-                )
+            ms.trends_stats.upsert_stats_df(stats)
         elif self.data_type == "history":
-            for _, row in stats.iterrows():
-                ms.history_stats.upsert_stats(
-                    row['itemid'], row['sum'], row['sqr_sum'], row['cnt'], 
-                    row['mean'], row['std']
-                )
+            ms.history_stats.upsert_stats_df(stats)
 
 
     def _update_stats_batch(self, itemIds: List[int], 
                                 startep: int, diff_startep: int, endep: int, oldstartep: int):
         if diff_startep == 0:
             raise ValueError("diff_startep must be given")
-        data = self._get_data(startep=diff_startep, endep=endep, itemIds=itemIds)
         # calculate sum, sqr_sum, count
-        new_stats = data.groupby('itemid').agg(
-            sum=('value', 'sum'),
-            sqr_sum=('value', utils.square_sum),
-            cnt=('value', 'count'),
-        ).reset_index()
+        new_stats = self._aggregate_data(startep=diff_startep, endep=endep, itemIds=itemIds)
 
         if len(new_stats) == 0:
             return
@@ -105,23 +92,16 @@ class Stats:
 
         # get old data
         if oldstartep > 0 and startep != diff_startep:
-            old_data = self._get_data(itemIds=itemIds, startep=oldstartep, endep=startep)
-            if len(old_data) > 0:
-
-                old_stats = old_data.groupby('itemid').agg(
-                    sum=('value', 'sum'),
-                    sqr_sum=('value', utils.square_sum),
-                    cnt=('value', 'count')
-                ).reset_index()
-
-                # subtract old stats from stats
-                if len(old_stats) > 0:
-                    stats = pd.merge(stats, old_stats, on='itemid', how='outer', suffixes=('', '_old'))
-                    stats = stats.fillna(0)
-                    stats['sum'] = stats['sum'] - stats['sum_old']
-                    stats['sqr_sum'] = stats['sqr_sum'] - stats['sqr_sum_old']
-                    stats['cnt'] = stats['cnt'] - stats['cnt_old']
-                    stats = stats[['itemid', 'sum', 'sqr_sum', 'cnt']]
+            old_stats = self._aggregate_data(itemIds=itemIds, startep=oldstartep, endep=startep)
+
+            # subtract old stats from stats
+            if len(old_stats) > 0:
+                stats = pd.merge(stats, old_stats, on='itemid', how='outer', suffixes=('', '_old'))
+                stats = stats.fillna(0)
+                stats['sum'] = stats['sum'] - stats['sum_old']
+                stats['sqr_sum'] = stats['sqr_sum'] - stats['sqr_sum_old']
+                stats['cnt'] = stats['cnt'] - stats['cnt_old']
+                stats = stats[['itemid', 'sum', 'sqr_sum', 'cnt']]
 
         
         # calculate mean and std
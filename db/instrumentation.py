@@ -0,0 +1,123 @@
+"""
+per statement shape instrumentation of PostgreSqlDB
+
+Every statement is recorded under (tag, shape). tag is the model or getter
+which issued it and shape is the SQL text with literals replaced by '?'.
+Bytes are only measured on the COPY paths. Other statements report n/a.
+Statements slower than query_stats.slow_query_secs are written to the slow
+query log.
+"""
+import re
+import threading
+import logging
+from typing import Dict, List
+
+import utils.config_loader as config_loader
+
+# upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, float("inf")]
+
+slow_query_logger = logging.getLogger("anomdec.slow_query")
+
+def log(msg, level=logging.INFO):
+	msg = f"[db/instrumentation.py] {msg}"
+	logging.log(level, msg)
+
+
+_re_string = re.compile(r"'(?:[^']|'')*'")
+_re_number = re.compile(r"\b\d+(?:\.\d+)?\b")
+_re_list = re.compile(r"\?(?:\s*,\s*\?)+")
+_re_space = re.compile(r"\s+")
+
+def get_shape(sql: str) -> str:
+	""" sql text with literals replaced by '?' and lists collapsed """
+	shape = _re_string.sub("?", sql)
+	shape = _re_number.sub("?", shape)
+	shape = _re_list.sub("?", shape)
+	shape = _re_space.sub(" ", shape).strip()
+	return shape[:300]
+
+def format_bytes(nbytes: int) -> str:
+	return "n/a" if nbytes is None else str(nbytes)
+
+
+class QueryStats:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.stats: Dict = {}
+		self.acquire: Dict = {}
+
+	def _conf(self) -> Dict:
+		return config_loader.conf.get("query_stats", {})
+
+	def enabled(self) -> bool:
+		return self._conf().get("enabled", True)
+
+	def record(self, tag: str, sql: str, elapsed: float, rows: int = 0, nbytes: int = None):
+		""" nbytes is None when the bytes transferred are not measured """
+		if not self.enabled():
+			return
+		shape = get_shape(sql)
+		with self.lock:
+			key = (tag, shape)
+			s = self.stats.get(key)
+			if s is None:
+				s = {"calls": 0, "total_secs": 0.0, "max_secs": 0.0, "rows": 0, "bytes": None,
+					"histogram": [0] * len(LATENCY_BUCKETS)}
+				self.stats[key] = s
+			s["calls"] += 1
+			s["total_secs"] += elapsed
+			s["max_secs"] = max(s["max_secs"], elapsed)
+			s["rows"] += rows
+			if nbytes is not None:
+				s["bytes"] = (s["bytes"] or 0) + nbytes
+			for i, upper in enumerate(LATENCY_BUCKETS):
+				if elapsed <= upper:
+					s["histogram"][i] += 1
+					break
+
+		slow_query_secs = self._conf().get("slow_query_secs", 1.0)
+		if slow_query_secs > 0 and elapsed >= slow_query_secs:
+			slow_query_logger.warning(f"slow query {elapsed:.3f}s rows={rows} bytes={format_bytes(nbytes)} [{tag}] {shape}")
+
+	def record_acquire(self, tag: str, elapsed: float):
+		if not self.enabled():
+			return
+		with self.lock:
+			a = self.acquire.setdefault(tag, {"count": 0, "total_secs": 0.0, "max_secs": 0.0})
+			a["count"] += 1
+			a["total_secs"] += elapsed
+			a["max_secs"] = max(a["max_secs"], elapsed)
+
+	def reset(self):
+		with self.lock:
+			self.stats = {}
+			self.acquire = {}
+
+	def summary(self) -> List[Dict]:
+		""" statement shapes ordered by total time """
+		with self.lock:
+			rows = [dict(tag=tag, shape=shape, **{k: (list(v) if k == "histogram" else v) for k, v in s.items()})
+				for (tag, shape), s in self.stats.items()]
+		rows.sort(key=lambda r: r["total_secs"], reverse=True)
+		return rows
+
+	def dump_summary(self, top_n: int = 20):
+		rows = self.summary()
+		if len(rows) == 0:
+			return
+		total = sum([r["total_secs"] for r in rows])
+		calls = sum([r["calls"] for r in rows])
+		log(f"query summary: {calls} statements, {len(rows)} shapes, {total:.3f}s")
+		buckets = ",".join([f"<={b}" for b in LATENCY_BUCKETS])
+		log(f"histogram buckets (secs): {buckets}")
+		for r in rows[:top_n]:
+			log(f"{r['total_secs']:.3f}s calls={r['calls']} max={r['max_secs']:.3f}s "
+				f"rows={r['rows']} bytes={format_bytes(r['bytes'])} hist={r['histogram']} [{r['tag']}] {r['shape'][:150]}")
+		with self.lock:
+			acquire = dict(self.acquire)
+		for tag, a in acquire.items():
+			log(f"connection acquire [{tag}] count={a['count']} total={a['total_secs']:.3f}s max={a['max_secs']:.3f}s")
+
+
+query_stats = QueryStats()
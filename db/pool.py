@@ -0,0 +1,169 @@
+"""
+process-wide connection pools for PostgreSqlDB
+
+One pool is kept per connection config (host, port, dbname, user, schema),
+so every PostgreSqlDB built from the same config shares its connections.
+"""
+import threading
+import time
+from typing import Dict, Tuple
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+
+class PooledConnection(psycopg2.extensions.connection):
+	""" psycopg2 connection carrying the bookkeeping the pool needs """
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.last_used = time.time()
+		self.prepared_statements = set()
+		# temp tables of item id sets loaded on this connection, oldest first
+		self.id_tables = {}
+
+
+class ConnectionPool:
+	def __init__(self, config: Dict):
+		self.config = config
+		self.max_size = config.get("pool_size", 5)
+		self.timeout = config.get("pool_timeout", 30)
+		self.health_check_secs = config.get("pool_health_check_secs", 60)
+		self.schema = config.get("schema", "public")
+		self.idle = []
+		self.size = 0
+		self.lock = threading.Condition()
+		self.hits = 0
+		self.misses = 0
+		self.waits = 0
+		self.discarded = 0
+
+	def _connect(self) -> PooledConnection:
+		config = self.config
+		conn_string = "host=%s dbname=%s user=%s password=%s" % (
+			config["host"],
+			config["dbname"],
+			config["user"],
+			config["password"])
+		conn = psycopg2.connect(conn_string, connection_factory=PooledConnection)
+		conn.autocommit = True
+
+		# Connect to the specified schema
+		cur = conn.cursor()
+		cur.execute(f"SET search_path TO {self.schema};")
+		cur.close()
+		return conn
+
+	def _is_healthy(self, conn: PooledConnection) -> bool:
+		if conn.closed:
+			return False
+		if time.time() - conn.last_used < self.health_check_secs:
+			return True
+		try:
+			cur = conn.cursor()
+			cur.execute("SELECT 1;")
+			cur.close()
+			return True
+		except psycopg2.Error:
+			return False
+
+	def _discard(self, conn: PooledConnection):
+		try:
+			conn.close()
+		except psycopg2.Error:
+			pass
+		self.discarded += 1
+
+	def acquire(self) -> PooledConnection:
+		deadline = time.time() + self.timeout
+		with self.lock:
+			while True:
+				while len(self.idle) > 0:
+					conn = self.idle.pop()
+					if self._is_healthy(conn):
+						self.hits += 1
+						return conn
+					self.size -= 1
+					self._discard(conn)
+
+				if self.size < self.max_size:
+					self.size += 1
+					break
+
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					raise psycopg2.pool.PoolError(
+						f"no connection available in {self.timeout} seconds (pool_size={self.max_size})")
+				self.waits += 1
+				self.lock.wait(remaining)
+
+		# open the new connection outside of the lock
+		try:
+			conn = self._connect()
+		except:
+			with self.lock:
+				self.size -= 1
+				self.lock.notify()
+			raise
+		with self.lock:
+			self.misses += 1
+		return conn
+
+	def release(self, conn: PooledConnection):
+		with self.lock:
+			if conn.closed or conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+				# broken or left inside a transaction. don't hand it out again.
+				self.size -= 1
+				self._discard(conn)
+			else:
+				conn.last_used = time.time()
+				self.idle.append(conn)
+			self.lock.notify()
+
+	def close(self):
+		with self.lock:
+			for conn in self.idle:
+				self.size -= 1
+				self._discard(conn)
+			self.idle = []
+
+	def stats(self) -> Dict[str, int]:
+		with self.lock:
+			return {
+				"size": self.size,
+				"idle": len(self.idle),
+				"max_size": self.max_size,
+				"hits": self.hits,
+				"misses": self.misses,
+				"waits": self.waits,
+				"discarded": self.discarded,
+			}
+
+
+_pools: Dict[Tuple, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+def _pool_key(config: Dict) -> Tuple:
+	return (config["host"], config.get("port", 5432), config["dbname"],
+		 config["user"], config.get("schema", "public"))
+
+def get_pool(config: Dict) -> ConnectionPool:
+	key = _pool_key(config)
+	with _pools_lock:
+		pool = _pools.get(key)
+		if pool is None:
+			pool = ConnectionPool(config)
+			_pools[key] = pool
+		return pool
+
+def get_pool_stats() -> Dict[Tuple, Dict[str, int]]:
+	with _pools_lock:
+		pools = dict(_pools)
+	return {key: pool.stats() for key, pool in pools.items()}
+
+def close_all():
+	with _pools_lock:
+		pools = list(_pools.values())
+		_pools.clear()
+	for pool in pools:
+		pool.close()
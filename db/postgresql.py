@@ -1,42 +1,88 @@
 import psycopg2
 import time
+import io
+import itertools
+import hashlib
+from contextlib import contextmanager
+from typing import List, Dict, Iterator
 from utils.config_loader import *
 from jinja2 import Template
 import pandas as pd
+import numpy as np
+
+from db.pool import get_pool
+from db.instrumentation import query_stats
 
 class PostgreSqlDB:
 	def __init__(self, config):
-		self.conn = None
 		self.config = config
 		self.retries = config.get('retries', 1)
 		self.delay = config.get('delay', 3)
+		self.fetch_chunksize = config.get('fetch_chunksize', 50000)
+		self.max_prepared_statements = config.get('max_prepared_statements', 200)
+		# item id sets of this size or more are joined from a temp table instead of a bigint[] parameter
+		self.id_table_threshold = config.get('id_table_threshold', 10000)
+		self.max_id_tables = config.get('max_id_tables', 8)
+		# connections are shared by every PostgreSqlDB with the same config
+		self.pool = get_pool(config)
+		# the model or getter issuing the statements. used by the query stats.
+		self.tag = config.get('name', config.get('dbname', ''))
 
-	def connect(self):
-		config = self.config
-		conn_string = "host=%s dbname=%s user=%s password=%s" % (
-			config["host"],
-			config["dbname"],
-			config["user"],
-			config["password"])
-		conn = psycopg2.connect(conn_string)
-		conn.autocommit = True
-
-		# Connect to the specified schema
-		schema = config.get("schema", "public")
-		cur = conn.cursor()
-		cur.execute(f"SET search_path TO {schema};")
+	def _record(self, sql, startep: float, rows: int = 0, nbytes: int = None):
+		query_stats.record(self.tag, sql, time.time() - startep, rows, nbytes)
 
-		return conn
-	
+	@contextmanager
+	def connection(self):
+		startep = time.time()
+		conn = self.pool.acquire()
+		query_stats.record_acquire(self.tag, time.time() - startep)
+		try:
+			yield conn
+		finally:
+			self.pool.release(conn)
+
+	@contextmanager
+	def cursor(self):
+		with self.connection() as conn:
+			cur = conn.cursor()
+			try:
+				yield cur
+			finally:
+				cur.close()
+
+	@contextmanager
+	def transaction(self):
+		""" cursor on a pooled connection running in a single transaction """
+		with self.connection() as conn:
+			conn.autocommit = False
+			cur = conn.cursor()
+			try:
+				yield cur
+				conn.commit()
+			except:
+				conn.rollback()
+				raise
+			finally:
+				cur.close()
+				conn.autocommit = True
 
 	def exec_sql(self, sql):
+		"""
+		Execute sql and return the cursor.
+		The connection goes back to the pool right after the execution.
+		Rows are already buffered on the client side, so the returned cursor 
+		can still be iterated or fetched.
+		"""
 		retries = self.retries
 		delay = self.delay
 		cur = None
 		for i in range(retries):
 			try:
-				cur = self.connect().cursor()
-				cur.execute(sql)
+				startep = time.time()
+				with self.connection() as conn:
+					cur = conn.cursor()
+					cur.execute(sql)
+				self._record(sql, startep, max(cur.rowcount, 0))
 				return cur
 			except psycopg2.errors.SerializationFailure:
 				if i < retries - 1:
@@ -46,6 +92,100 @@ class PostgreSqlDB:
 		raise Exception("SQL failed after max tries")
 	
 
+	def _execute_prepared(self, conn, cur, sql, params: List = [], param_types: List[str] = []):
+		name = "stmt_" + hashlib.md5(sql.encode()).hexdigest()[:16]
+		if name not in conn.prepared_statements:
+			if len(conn.prepared_statements) >= self.max_prepared_statements:
+				cur.execute("DEALLOCATE ALL;")
+				conn.prepared_statements.clear()
+			types = ""
+			if len(param_types) > 0:
+				types = f"({', '.join(param_types)})"
+			cur.execute(f"PREPARE {name}{types} AS {sql}")
+			conn.prepared_statements.add(name)
+		if len(params) > 0:
+			cur.execute(f"EXECUTE {name}({', '.join(['%s'] * len(params))})", params)
+		else:
+			cur.execute(f"EXECUTE {name}")
+
+	def exec_prepared(self, sql, params: List = [], param_types: List[str] = []):
+		"""
+		Execute sql with bound parameters ($1, $2, ...) as a server side prepared statement.
+		Every pooled connection prepares a statement once and reuses its plan afterwards,
+		so the statement text does not grow with the parameters.
+		Returns the cursor like exec_sql.
+		"""
+		startep = time.time()
+		with self.connection() as conn:
+			cur = conn.cursor()
+			self._execute_prepared(conn, cur, sql, params, param_types)
+		self._record(sql, startep, max(cur.rowcount, 0))
+		return cur
+
+	def _id_table(self, conn, itemIds) -> str:
+		""" temp table of conn holding itemIds. loaded with COPY once per connection. """
+		ids = np.unique(np.asarray(itemIds, dtype=np.int64))
+		name = "tmp_ids_" + hashlib.md5(ids.tobytes()).hexdigest()[:16]
+		if name in conn.id_tables:
+			# most recently used last
+			conn.id_tables[name] = conn.id_tables.pop(name)
+			return name
+		cur = conn.cursor()
+		try:
+			if len(conn.id_tables) >= self.max_id_tables:
+				oldest = next(iter(conn.id_tables))
+				cur.execute(f"DROP TABLE IF EXISTS {oldest};")
+				del conn.id_tables[oldest]
+			cur.execute(f"CREATE TEMP TABLE {name} (itemid bigint PRIMARY KEY);")
+			buf = io.StringIO("\n".join(map(str, ids.tolist())) + "\n")
+			cur.copy_expert(f"COPY {name} (itemid) FROM STDIN", buf)
+			cur.execute(f"ANALYZE {name};")
+		finally:
+			cur.close()
+		conn.id_tables[name] = len(ids)
+		return name
+
+	def exec_itemIds(self, sql, itemIds, params: List = [], param_types: List[str] = []):
+		"""
+		exec_prepared with {itemIds} in sql standing for the set of itemIds, 
+		as in "itemid = ANY({itemIds})".
+		Sets smaller than id_table_threshold are bound as one more bigint[] parameter.
+		Larger ones are copied once into a temp table of the pooled connection and 
+		read from there, so the statement text and its planning stay small.
+		"""
+		if self.id_table_threshold <= 0 or len(itemIds) < self.id_table_threshold:
+			sql = sql.replace("{itemIds}", f"${len(params) + 1}")
+			return self.exec_prepared(sql, params + [int_array(itemIds)], param_types + ["bigint[]"])
+
+		startep = time.time()
+		with self.connection() as conn:
+			table = self._id_table(conn, itemIds)
+			sql = sql.replace("{itemIds}", f"SELECT itemid FROM {table}")
+			cur = conn.cursor()
+			self._execute_prepared(conn, cur, sql, params, param_types)
+		self._record(sql, startep, max(cur.rowcount, 0))
+		return cur
+
+	def read_itemIds(self, sql, columns: List[str], itemIds, params: List = [], param_types: List[str] = [],
+				   dtypes: Dict[str, str] = None) -> pd.DataFrame:
+		cur = self.exec_itemIds(sql, itemIds, params, param_types)
+		rows = cur.fetchall()
+		cur.close()
+		df = pd.DataFrame(rows, columns=columns)
+		if dtypes:
+			df = df.astype(dtypes)
+		return df
+
+	def read_prepared(self, sql, columns: List[str], params: List = [], param_types: List[str] = [],
+				   dtypes: Dict[str, str] = None) -> pd.DataFrame:
+		cur = self.exec_prepared(sql, params, param_types)
+		rows = cur.fetchall()
+		cur.close()
+		df = pd.DataFrame(rows, columns=columns)
+		if dtypes:
+			df = df.astype(dtypes)
+		return df
+
 	def truncate_table(self, tablename):
 		sql = "truncate table %s;" % tablename
 		return self.exec_sql(sql)
@@ -63,8 +203,8 @@ class PostgreSqlDB:
 		return row[0]
 
 	def close(self):
-		if self.conn != None:
-			self.conn.close()
+		# close idle connections of the shared pool
+		self.pool.close()
 
 	def _create_table_from_template(self, sqlFile, tableName, context={}):
 		try:
@@ -103,9 +243,11 @@ class PostgreSqlDB:
 		self.exec_sql("drop table if exists %s;" % tableName)
 
 	def select1rec(self, sql):
-		cur = self.exec_sql(sql)
-		row = cur.fetchone()
-		cur.close()
+		startep = time.time()
+		with self.cursor() as cur:
+			cur.execute(sql)
+			row = cur.fetchone()
+		self._record(sql, startep, 1)
 		if row:
 			return row
 		return None
@@ -121,16 +263,218 @@ class PostgreSqlDB:
 		return None
 
 	def read_sql(self, sql) -> pd.DataFrame:
-		cur = self.exec_sql(sql)
-		rows = cur.fetchall()
-		cur.close()
+		startep = time.time()
+		with self.cursor() as cur:
+			cur.execute(sql)
+			rows = cur.fetchall()
+		self._record(sql, startep, len(rows))
 		return pd.DataFrame(rows)
+
+	_cursor_ids = itertools.count()
+
+	def read_sql_chunks(self, sql, columns: List[str], chunksize: int = 0, 
+					 dtypes: Dict[str, str] = None, itemIds = None) -> Iterator[pd.DataFrame]:
+		"""
+		Stream the result of a single SELECT through a server-side (named) cursor.
+		Yields DataFrames of at most chunksize rows with the given columns and dtypes, 
+		so the whole result set is never held in memory at once.
+		With itemIds, {itemIds} in sql stands for them, read from a temp table as in exec_itemIds.
+		"""
+		if chunksize <= 0:
+			chunksize = self.fetch_chunksize
+		# time spent on the database only, not in the consumer
+		elapsed = 0.0
+		n_rows = 0
+		startep = time.time()
+		with self.connection() as conn:
+			if itemIds is not None:
+				sql = sql.replace("{itemIds}", f"SELECT itemid FROM {self._id_table(conn, itemIds)}")
+			# named cursors only live inside a transaction
+			conn.autocommit = False
+			cur = conn.cursor(name=f"chunk_cursor_{next(self._cursor_ids)}")
+			cur.itersize = chunksize
+			try:
+				cur.execute(sql)
+				while True:
+					rows = cur.fetchmany(chunksize)
+					elapsed += time.time() - startep
+					if len(rows) == 0:
+						break
+					n_rows += len(rows)
+					df = pd.DataFrame(rows, columns=columns)
+					del rows
+					if dtypes:
+						df = df.astype(dtypes)
+					yield df
+					startep = time.time()
+				cur.close()
+				conn.commit()
+				query_stats.record(self.tag, sql, elapsed, n_rows)
+			except:
+				# also reached when the consumer stops early (GeneratorExit)
+				conn.rollback()
+				raise
+			finally:
+				conn.autocommit = True
+
+	def read_sql_chunked(self, sql, columns: List[str], chunksize: int = 0, 
+					  dtypes: Dict[str, str] = None) -> pd.DataFrame:
+		""" read_sql built chunk by chunk from typed DataFrames instead of one list of tuples """
+		chunks = list(self.read_sql_chunks(sql, columns, chunksize, dtypes))
+		if len(chunks) == 0:
+			df = pd.DataFrame(columns=columns)
+			return df.astype(dtypes) if dtypes else df
+		if len(chunks) == 1:
+			return chunks[0]
+		return pd.concat(chunks, ignore_index=True)
 	
 	
+	# COPY binary format. https://www.postgresql.org/docs/current/sql-copy.html
+	_copy_signature = b"PGCOPY\n\xff\r\n\x00"
+	_columnar_types = {"int64": ("bigint", ">i8"), "float64": ("float8", ">f8")}
+
+	def read_sql_columnar(self, sql, dtypes: Dict[str, str]) -> pd.DataFrame:
+		"""
+		Run sql with COPY (...) TO STDOUT in binary format and decode the rows 
+		into NumPy arrays as they arrive, without building Python tuples
+		or holding the whole COPY output.
+		dtypes maps each selected column, in order, to "int64" or "float64".
+		NULL floats become NaN. Falls back to read_sql_chunked when the rows 
+		are not fixed width (NULL integers).
+		"""
+		columns = list(dtypes.keys())
+		select = []
+		row_dtype = [("nfields", ">i2")]
+		for col in columns:
+			sqltype, npytype = self._columnar_types[dtypes[col]]
+			if sqltype == "float8":
+				select.append(f"COALESCE(q.{col}::float8, 'NaN') AS {col}")
+			else:
+				select.append(f"q.{col}::bigint AS {col}")
+			row_dtype += [(f"{col}_len", ">i4"), (col, npytype)]
+		row_dtype = np.dtype(row_dtype)
+		sql = sql.strip().rstrip(";")
+		copy_sql = f"COPY (SELECT {', '.join(select)} FROM ({sql}) q) TO STDOUT WITH (FORMAT binary)"
+
+		decoder = _CopyDecoder(columns, dtypes, row_dtype, self.fetch_chunksize)
+		startep = time.time()
+		with self.cursor() as cur:
+			cur.copy_expert(copy_sql, decoder)
+		df = decoder.finish()
+		if df is None:
+			return self.read_sql_chunked(sql, columns, dtypes=dtypes)
+		self._record(sql, startep, len(df), decoder.nbytes)
+		return df
+
+	def copy_df(self, cur, tableName: str, df: pd.DataFrame, fields: List[str]):
+		""" stream df into tableName with COPY ... FROM STDIN """
+		buf = io.StringIO()
+		df.to_csv(buf, columns=fields, header=False, index=False)
+		nbytes = buf.tell()
+		buf.seek(0)
+		cur.copy_expert(f"COPY {tableName} ({','.join(fields)}) FROM STDIN WITH (FORMAT csv)", buf)
+		return nbytes
+
+	def bulk_upsert(self, tableName: str, df: pd.DataFrame, fields: List[str], 
+				 conflict_fields: List[str], update_fields: List[str] = None):
+		"""
+		COPY df into a temp staging table and merge it into tableName 
+		with a single INSERT ... ON CONFLICT.
+		"""
+		if update_fields is None:
+			update_fields = [f for f in fields if f not in conflict_fields]
+		# ON CONFLICT cannot update the same row twice in one statement
+		df = df.drop_duplicates(subset=conflict_fields, keep="last")
+		staging = "stg_" + tableName.replace(".", "_")
+		if len(update_fields) > 0:
+			on_conflict = "DO UPDATE SET " + ", ".join([f"{f} = EXCLUDED.{f}" for f in update_fields])
+		else:
+			on_conflict = "DO NOTHING"
+
+		startep = time.time()
+		with self.transaction() as cur:
+			cur.execute(f"CREATE TEMP TABLE {staging} (LIKE {tableName} INCLUDING DEFAULTS) ON COMMIT DROP;")
+			nbytes = self.copy_df(cur, staging, df, fields)
+			sql = f"""INSERT INTO {tableName} ({','.join(fields)})
+	SELECT {','.join(fields)} FROM {staging}
+	ON CONFLICT ({','.join(conflict_fields)}) {on_conflict};"""
+			cur.execute(sql)
+		self._record(f"COPY {staging}; {sql}", startep, len(df), nbytes)
+
 	# create schema if not exists
 	def create_schema(self, schema_name):
 		sql = f"CREATE SCHEMA IF NOT EXISTS {schema_name};"
 		self.exec_sql(sql)
 
+class _CopyDecoder:
+	"""
+	File object COPY ... TO STDOUT (FORMAT binary) writes to.
+	Rows of row_dtype are decoded into column arrays every chunksize rows.
+	"""
+	def __init__(self, columns: List[str], dtypes: Dict[str, str], row_dtype: np.dtype, chunksize: int):
+		self.columns = columns
+		self.dtypes = dtypes
+		self.row_dtype = row_dtype
+		self.chunk_bytes = max(1, chunksize) * row_dtype.itemsize
+		self.pending = bytearray()
+		self.header = False
+		# False once a row is not fixed width. the rest of the output is only counted.
+		self.fixed = True
+		self.parts = {col: [] for col in columns}
+		self.nbytes = 0
+
+	def write(self, data):
+		self.nbytes += len(data)
+		if not self.fixed:
+			return
+		self.pending += data
+		if len(self.pending) >= self.chunk_bytes:
+			self._decode()
+
+	def _decode(self):
+		pending = self.pending
+		if not self.header:
+			# signature, flags(int32), extension length(int32) + extension
+			if len(pending) < 19:
+				return
+			if bytes(pending[:11]) != PostgreSqlDB._copy_signature:
+				raise Exception("unexpected COPY binary header")
+			ext_len = int(np.frombuffer(pending[15:19], dtype=">i4")[0])
+			if len(pending) < 19 + ext_len:
+				return
+			del pending[:19 + ext_len]
+			self.header = True
+		n = len(pending) // self.row_dtype.itemsize
+		if n == 0:
+			return
+		rows = np.frombuffer(pending, dtype=self.row_dtype, count=n)
+		if not (rows["nfields"] == len(self.columns)).all() or \
+			any([not (rows[f"{col}_len"] == 8).all() for col in self.columns]):
+			self.fixed = False
+			self.pending = bytearray()
+			return
+		for col in self.columns:
+			self.parts[col].append(rows[col].astype(self.dtypes[col]))
+		del rows
+		del pending[:n * self.row_dtype.itemsize]
+
+	def finish(self) -> pd.DataFrame:
+		""" the decoded DataFrame, or None when the rows are not fixed width """
+		if self.fixed:
+			self._decode()
+		# trailer: int16 -1
+		if not self.fixed or not self.header or bytes(self.pending) != b"\xff\xff":
+			return None
+		arrays = {}
+		for col in self.columns:
+			parts = self.parts.pop(col)
+			arrays[col] = np.concatenate(parts) if len(parts) > 0 else np.empty(0, dtype=self.dtypes[col])
+		return pd.DataFrame(arrays, copy=False)
+
+
+def int_array(values) -> List[int]:
+	""" itemids as a plain list of ints to bind to a bigint[] parameter """
+	return [int(v) for v in values]
+
 def exec_sql(sql):
 	return PostgreSqlDB().exec_sql(sql)
\ No newline at end of file
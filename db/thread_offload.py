@@ -0,0 +1,53 @@
+"""
+awaitable front end of PostgreSqlDB that offloads its blocking calls to threads
+
+This is not an async driver. Every statement runs the psycopg2 code of 
+PostgreSqlDB in a worker thread (asyncio.to_thread) on a connection from the 
+shared pool, at most pool max_size at a time. Coroutines on the same event loop 
+can then keep queries on several databases (admdb, Zabbix) in flight at once, 
+with the pool, COPY decoding, prepared statements and query stats of PostgreSqlDB.
+"""
+import asyncio
+from typing import Dict, List
+
+import pandas as pd
+
+from db.postgresql import PostgreSqlDB
+
+
+class ThreadOffloadDB:
+	def __init__(self, db: PostgreSqlDB):
+		self.db = db
+		# never start more statements than the pool can serve.
+		# a semaphore belongs to one event loop.
+		self.loop = None
+		self.semaphore = None
+
+	async def _run(self, func, *args, **kwargs):
+		loop = asyncio.get_running_loop()
+		if self.loop is not loop:
+			self.loop = loop
+			self.semaphore = asyncio.Semaphore(self.db.pool.max_size)
+		async with self.semaphore:
+			return await asyncio.to_thread(func, *args, **kwargs)
+
+	async def exec_sql(self, sql):
+		return await self._run(self.db.exec_sql, sql)
+
+	async def read_sql(self, sql) -> pd.DataFrame:
+		return await self._run(self.db.read_sql, sql)
+
+	async def read_sql_chunked(self, sql, columns: List[str], chunksize: int = 0,
+							dtypes: Dict[str, str] = None) -> pd.DataFrame:
+		return await self._run(self.db.read_sql_chunked, sql, columns, chunksize, dtypes)
+
+	async def read_sql_columnar(self, sql, dtypes: Dict[str, str]) -> pd.DataFrame:
+		return await self._run(self.db.read_sql_columnar, sql, dtypes)
+
+	async def read_prepared(self, sql, columns: List[str], params: List = [], param_types: List[str] = [],
+						 dtypes: Dict[str, str] = None) -> pd.DataFrame:
+		return await self._run(self.db.read_prepared, sql, columns, params, param_types, dtypes)
+
+	async def read_itemIds(self, sql, columns: List[str], itemIds, params: List = [], param_types: List[str] = [],
+						dtypes: Dict[str, str] = None) -> pd.DataFrame:
+		return await self._run(self.db.read_itemIds, sql, columns, itemIds, params, param_types, dtypes)
@@ -7,6 +7,7 @@ import data_getter
 from data_processing.detector import Detector
 import classifiers.dbscan as dbscan
 from models.models_set import ModelsSet
+from db.instrumentation import query_stats
 
 STAGE_DETECT1 = 1
 STAGE_DETECT2 = 2
@@ -123,7 +124,9 @@ def classify_charts(endep: int):
     if len(classified_itemIds) > 1:
         log("classifying charts")
         clusters, _, _ = dbscan.classify_charts(conf, classified_itemIds, endep=endep)
-        ModelsSet(data_source_name).anomalies.update_clusterid(clusters)
+        # the clustered itemIds come from all data sources
+        for data_source_name in data_sources:
+            ModelsSet(data_source_name).anomalies.update_clusterid(clusters)
     else:
         log("no anomalies")
 
@@ -162,4 +165,5 @@ if __name__ == "__main__":
         itemIds=args.itemids,
         skip_history_update=args.skip_history_update,
     )
-    classify_charts(args.end)
\ No newline at end of file
+    classify_charts(args.end)
+    query_stats.dump_summary()
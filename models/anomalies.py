@@ -2,11 +2,18 @@ import pandas as pd
 from typing import List, Dict
 
 from models.model import Model
+from db.postgresql import int_array
 
 class AnomaliesModel(Model):
     sql_template = "anomalies"
     name = sql_template
     fields = ["itemid", "created", "group_name", "hostid", "clusterid", "host_name", "item_name", "trend_mean", "trend_std"]
+    primary_keys = ["itemid", "created", "group_name"]
+    indexes = [
+        # get_data, delete_old_entries and filter_itemIds filter on created.
+        # update_clusterid looks up itemid, created, which the primary key covers.
+        ('created_itemid', ['created', 'itemid'], []),
+    ]
 
     def get_data(self, where_conds: List[str] = []) -> pd.DataFrame:
         sql = f"SELECT * FROM {self.table_name}"
@@ -57,31 +64,26 @@ class AnomaliesModel(Model):
 
 
     def insert_data(self, data: pd.DataFrame):
-        for _, row in data.iterrows():
-            item_name = row.item_name.replace("'", "")
-            trend_mean = 0 if pd.isna(row.trend_mean) else row.trend_mean
-            trend_std = 0 if pd.isna(row.trend_std) else row.trend_std
-            sql = f"""INSERT INTO {self.table_name} 
-    (itemid, created, hostid, clusterid, group_name, host_name, item_name, trend_mean, trend_std) 
-    VALUES 
-    ({row.itemid}, {row.created}, 
-     {row.hostid}, {row.clusterid}, 
-     '{row.group_name[:255]}', '{row.host_name[:255]}', '{item_name[:255]}', {trend_mean}, 
-     {trend_std})
-    ON CONFLICT (itemid, created, group_name) DO UPDATE SET
-        hostid = EXCLUDED.hostid,
-        clusterid = EXCLUDED.clusterid,
-        host_name = EXCLUDED.host_name,
-        item_name = EXCLUDED.item_name,
-        trend_mean = EXCLUDED.trend_mean,
-        trend_std = EXCLUDED.trend_std
-    """
-            self.db.exec_sql(sql)
+        if data is None or len(data) == 0:
+            return
+        data = data[self.fields].copy()
+        for field in ["group_name", "host_name", "item_name"]:
+            data[field] = data[field].astype(str).str[:255]
+        data["trend_mean"] = data["trend_mean"].fillna(0)
+        data["trend_std"] = data["trend_std"].fillna(0)
+        self.bulk_upsert(data)
 
-    def update_clusterid(self, clusters: Dict):
-        for itemId, clusterId in clusters.items():
-            sql = f"update {self.table_name} set clusterid = {clusterId} where itemid = {itemId};"
-            self.db.exec_sql(sql)
+    def update_clusterid(self, clusters: Dict[int, int]):
+        """ set clusterid of the latest created row of each itemid in one statement """
+        if len(clusters) == 0:
+            return
+        sql = f"""UPDATE {self.table_name} t SET clusterid = u.clusterid
+    FROM unnest($1, $2) AS u(itemid, clusterid)
+    WHERE t.itemid = u.itemid
+    AND t.created = (SELECT max(created) FROM {self.table_name} WHERE itemid = u.itemid)"""
+        self.db.exec_prepared(sql, 
+                              [int_array(clusters.keys()), int_array(clusters.values())], 
+                              ["bigint[]", "integer[]"]).close()
 
     def delete_old_entries(self, oldep: int):
         sql = f"delete from {self.table_name} WHERE created < {oldep};"
@@ -89,8 +91,8 @@ class AnomaliesModel(Model):
 
     
     def filter_itemIds(self, itemIds: List[int], created: int):
-        sql = f"select itemid from {self.table_name} where created >= {created} and itemid in (%s);" % ",".join(map(str, itemIds))
-        cur = self.db.exec_sql(sql)
+        sql = f"select itemid from {self.table_name} where created >= $1 and itemid = ANY($2)"
+        cur = self.db.exec_prepared(sql, [created, int_array(itemIds)], ["integer", "bigint[]"])
         ex_itemIds = []
         for (itemId,) in cur:
             ex_itemIds.append(itemId)
@@ -104,8 +106,9 @@ class AnomaliesModel(Model):
     def get_stats_per_itemId(self, itemIds: List[int] = []) -> Dict[int, Dict[str, float]]:
         if len(itemIds) == 0:
             itemIds = self.get_itemids()
-        sql = f"SELECT itemid, trend_mean, trend_std FROM {self.table_name} WHERE itemid in (%s);" % ",".join(map(str, itemIds))
-        df = self.db.read_sql(sql)
+        sql = f"SELECT itemid, trend_mean, trend_std FROM {self.table_name} WHERE itemid = ANY($1)"
+        df = self.db.read_prepared(sql, ["itemid", "trend_mean", "trend_std"], 
+                                   [int_array(itemIds)], ["bigint[]"])
         if df.empty:
             return {}
         
@@ -1,33 +1,175 @@
+import re
+import threading
+import psycopg2
 import pandas as pd
-from typing import List, Dict
+import numpy as np
+from typing import List, Dict, Iterator, Tuple
 
 from models.model import Model
 import utils.normalizer as normalizer
+import utils.config_loader as config_loader
+
+# known partitions of each history table: {table key: {start clock: end clock}}
+_partitions: Dict[Tuple, Dict[int, int]] = {}
+_partitions_lock = threading.Lock()
+
+_re_bound = re.compile(r"FROM \('?(-?\d+)'?\) TO \('?(-?\d+)'?\)")
 
 class HistoryModel(Model):
     sql_template = "history"
     name = "history"
     fields = ['itemid', 'clock', 'value']
+    primary_keys = ['itemid', 'clock']
+    dtypes = {'itemid': 'int64', 'clock': 'int64', 'value': 'float64'}
+    # get_data and get_charts scan the primary key, which includes value. see _migrate_primary_key.
+    indexes = [
+        # remove_old_data of plain tables. partitioned tables drop whole partitions.
+        ('clock', ['clock'], []),
+    ]
 
-    def get_data(self, itemIds: List[int]=[], startep: int = 0, endep: int = 0) -> pd.DataFrame:
-        sql = f"SELECT * FROM {self.table_name}"
+    def __init__(self, data_source_name=""):
+        # the table is range partitioned on clock, one partition per partition_secs
+        self.partition_secs = config_loader.conf.get("history_partition_secs", 86400)
+        self.partitions_ahead = config_loader.conf.get("history_partitions_ahead", 2)
+        # known before migrate runs in create_table
+        self.partitioned = None
+        super().__init__(data_source_name)
+
+    def migrate(self):
+        super().migrate()
+        self._migrate_primary_key()
+
+    def index_applies(self, name: str) -> bool:
+        if name == 'clock':
+            return not self.is_partitioned()
+        return True
+
+    def _migrate_primary_key(self):
+        """ rebuild the primary key of tables created before it included value """
+        sql = f"""SELECT c.conname, x.indnatts > x.indnkeyatts FROM pg_catalog.pg_constraint c
+    JOIN pg_catalog.pg_index x ON x.indexrelid = c.conindid
+    WHERE c.conrelid = '{self.schema_name}.{self.table_name.lower()}'::regclass AND c.contype = 'p';"""
+        row = self.db.select1rec(sql)
+        if row is None or row[1]:
+            return
+        self.db.exec_sql(f"""ALTER TABLE {self.table_name} DROP CONSTRAINT {row[0]}, 
+    ADD PRIMARY KEY (itemid, clock) INCLUDE (value);""")
+
+    def drop(self):
+        super().drop()
+        self._forget_partitions()
+        self.partitioned = None
+
+    def _forget_partitions(self):
+        # other processes add and drop partitions too. the next get_partitions reads them again.
+        with _partitions_lock:
+            _partitions.pop(self._table_key(), None)
+
+    def is_partitioned(self) -> bool:
+        # tables created before partitioning was introduced are plain tables
+        if self.partitioned is None:
+            sql = f"""SELECT EXISTS (SELECT FROM pg_catalog.pg_partitioned_table pt
+    JOIN pg_catalog.pg_class c ON c.oid = pt.partrelid
+    JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relname = '{self.table_name.lower()}' AND n.nspname = '{self.schema_name}');"""
+            (self.partitioned,) = self.db.select1rec(sql)
+        return self.partitioned
+
+    def get_partitions(self) -> Dict[int, int]:
+        """ {start clock: end clock} of the partitions of the table """
+        key = self._table_key()
+        with _partitions_lock:
+            if key in _partitions:
+                return _partitions[key]
+        sql = f"""SELECT pg_get_expr(c.relpartbound, c.oid) FROM pg_catalog.pg_inherits i
+    JOIN pg_catalog.pg_class c ON c.oid = i.inhrelid
+    JOIN pg_catalog.pg_class p ON p.oid = i.inhparent
+    JOIN pg_catalog.pg_namespace n ON n.oid = p.relnamespace
+    WHERE p.relname = '{self.table_name.lower()}' AND n.nspname = '{self.schema_name}';"""
+        partitions = {}
+        for (bound,) in self.db.exec_sql(sql):
+            m = _re_bound.search(bound)
+            if m:
+                partitions[int(m.group(1))] = int(m.group(2))
+        with _partitions_lock:
+            _partitions[key] = partitions
+        return partitions
+
+    def ensure_partitions(self, clocks):
+        """ create the partitions holding clocks and partitions_ahead more after the last one """
+        if len(clocks) == 0 or not self.is_partitioned():
+            return
+        secs = self.partition_secs
+        starts = np.unique(np.asarray(clocks, dtype=np.int64) // secs * secs).tolist()
+        starts += [starts[-1] + secs * (i + 1) for i in range(self.partitions_ahead)]
+        partitions = self.get_partitions()
+        for start in starts:
+            if any(s <= start < e for s, e in partitions.items()):
+                continue
+            self.db.exec_sql(f"""CREATE TABLE IF NOT EXISTS {self.table_name}_p{start}
+    PARTITION OF {self.table_name} FOR VALUES FROM ({start}) TO ({start + secs});""")
+            with _partitions_lock:
+                partitions[start] = start + secs
+
+    def _get_data_sql(self, startep: int = 0, endep: int = 0, filtered: bool = False, 
+                      bind: bool = True) -> Tuple[str, List, List[str]]:
+        """ (sql, params, param_types). {itemIds} stands for the item filter, see PostgreSqlDB.exec_itemIds """
+        sql = f"SELECT itemid, clock, value FROM {self.table_name}"
         where = []
-        if len(itemIds) > 0:
-            where.append(f"itemid IN ({','.join(map(str, itemIds))})")
-        if startep > 0:
-            where.append(f"clock >= {startep}")
-        if endep > 0:
-            where.append(f"clock <= {endep}")
+        params = []
+        for cond, clock in [("clock >=", startep), ("clock <=", endep)]:
+            if clock <= 0:
+                continue
+            if bind:
+                params.append(int(clock))
+                where.append(f"{cond} ${len(params)}")
+            else:
+                where.append(f"{cond} {int(clock)}")
+        if filtered:
+            where.append("itemid = ANY({itemIds})")
         if len(where) > 0:
             sql += " WHERE " + " AND ".join(where)
-        sql += " ORDER BY itemid, clock;"
-        
-        df = self.db.read_sql(sql)
-        if df.empty:
-            return pd.DataFrame(columns=self.fields, dtype=object)
-        df.columns = self.fields
-        return df
+        sql += " ORDER BY itemid, clock"
+        return sql, params, ["integer"] * len(params)
+
+    def get_data(self, itemIds: List[int]=[], startep: int = 0, endep: int = 0) -> pd.DataFrame:
+        sql, params, param_types = self._get_data_sql(startep, endep, len(itemIds) > 0)
+        if len(itemIds) == 0:
+            return self.db.read_prepared(sql, self.fields, params, param_types, dtypes=self.dtypes)
+        return self.db.read_itemIds(sql, self.fields, itemIds, params, param_types, dtypes=self.dtypes)
 
+    async def aget_data(self, itemIds: List[int]=[], startep: int = 0, endep: int = 0) -> pd.DataFrame:
+        sql, params, param_types = self._get_data_sql(startep, endep, len(itemIds) > 0)
+        if len(itemIds) == 0:
+            return await self.adb.read_prepared(sql, self.fields, params, param_types, dtypes=self.dtypes)
+        return await self.adb.read_itemIds(sql, self.fields, itemIds, params, param_types, dtypes=self.dtypes)
+
+    def iter_data(self, itemIds: List[int]=[], startep: int = 0, endep: int = 0, 
+                  chunksize: int = 0) -> Iterator[pd.DataFrame]:
+        # same as get_data but yields chunks of rows ordered by itemid, clock.
+        # server-side cursors take no bound parameters. itemIds are joined from a temp table.
+        sql, _, _ = self._get_data_sql(startep, endep, len(itemIds) > 0, bind=False)
+        return self.db.read_sql_chunks(sql, self.fields, chunksize, dtypes=self.dtypes, 
+                                       itemIds=itemIds if len(itemIds) > 0 else None)
+
+    def get_max_clock(self) -> int:
+        cur = self.db.exec_sql(f"SELECT max(clock) FROM {self.table_name};")
+        row = cur.fetchone()
+        cur.close()
+        return int(row[0]) if row is not None and row[0] is not None else 0
+
+    def _write(self, clocks, write):
+        """ write() after creating the partitions of clocks """
+        self.ensure_partitions(clocks)
+        try:
+            write()
+        except psycopg2.errors.CheckViolation as e:
+            # no partition of relation found for row: a partition known here was dropped by another process
+            if not self.is_partitioned() or "no partition" not in str(e):
+                raise
+            self._forget_partitions()
+            self.ensure_partitions(clocks)
+            write()
 
     def insert(self, itemids: List[int], clocks: List[int], values: List[float]):
         # prepare sql
@@ -36,54 +178,78 @@ class HistoryModel(Model):
             sql += f"({itemids[i]}, {clocks[i]}, {values[i]}),"
         sql = sql[:-1] + ";"
 
-        self.db.exec_sql(sql)
+        self._write(clocks, lambda: self.db.exec_sql(sql))
 
-    # buggy
     def upsert(self, itemids: List[int], clocks: List[int], values: List[float]):
-        # prepare sql
-        sql = f"INSERT INTO {self.table_name} (itemid, clock, value) VALUES "
-        for i in range(len(itemids)):
-            sql += f"({itemids[i]}, {clocks[i]}, {values[i]}),"
-        sql = sql[:-1] + " ON CONFLICT (itemid, clock) DO UPDATE SET value = EXCLUDED.value;"
-
-        self.db.exec_sql(sql)
+        clocks = np.asarray(clocks, dtype=np.int64)
+        data = {
+            'itemid': np.asarray(itemids, dtype=np.int64),
+            'clock': clocks,
+            'value': np.asarray(values, dtype=np.float64),
+        }
+        self._write(clocks, lambda: self.bulk_upsert(data))
         
+    def upsert_matrix(self, itemIds: List[int], base_clocks: List[int], matrix: np.ndarray):
+        """ matrix is items x base_clocks """
+        if len(itemIds) == 0:
+            return
+        self.upsert(np.repeat(np.asarray(itemIds, dtype=np.int64), len(base_clocks)), 
+                    np.tile(np.asarray(base_clocks, dtype=np.int64), len(itemIds)), 
+                    np.asarray(matrix, dtype=np.float64).ravel())
+
+    def append_matrix(self, itemIds: List[int], base_clocks: List[int], matrix: np.ndarray):
+        """ like upsert_matrix, keeping the values of itemIds before base_clocks """
+        self.upsert_matrix(itemIds, base_clocks, matrix)
+
     def remove_old_data(self, clock: int):
-        sql = f"DELETE FROM {self.table_name} WHERE clock < {clock};"
-        self.db.exec_sql(sql)        
+        if not self.is_partitioned():
+            self.db.exec_sql(f"DELETE FROM {self.table_name} WHERE clock < {clock};")
+            return
+        # drop the partitions entirely older than clock.
+        # only the rows of the partition holding clock are deleted.
+        self._forget_partitions()
+        partitions = self.get_partitions()
+        for start, end in sorted(partitions.items()):
+            if start > clock:
+                break
+            if end <= clock:
+                self.db.exec_sql(f"DROP TABLE IF EXISTS {self.table_name}_p{start};")
+                with _partitions_lock:
+                    partitions.pop(start, None)
+            else:
+                self.db.exec_sql(f"DELETE FROM {self.table_name}_p{start} WHERE clock < {clock};")
         
 
     def import_history(self, hist_df: pd.DataFrame, base_clocks: List[int]):
-        itemids = hist_df['itemid'].tolist()
+        itemids = hist_df['itemid'].unique().tolist()
         
+        all_itemids = []
+        all_values = []
         for itemid in itemids:
             idx = hist_df[hist_df['itemid'] == itemid].index
             clocks = hist_df.loc[idx, 'clock'].tolist()
             values = hist_df.loc[idx, 'value'].tolist()
-            values = normalizer.fit_to_base_clocks(base_clocks, clocks, values)
-            self.upsert([itemid]*len(base_clocks), base_clocks, values)
+            all_values.extend(normalizer.fit_to_base_clocks(base_clocks, clocks, values))
+            all_itemids.extend([itemid]*len(base_clocks))
+        self.upsert(all_itemids, base_clocks*len(itemids), all_values)
 
     def remove_itemIds_not_in(self, itemIds: List[int]):
-        sql = f"DELETE FROM {self.table_name} WHERE itemid NOT IN ({','.join(map(str, itemIds))});"
-        self.db.exec_sql(sql)
+        sql = f"DELETE FROM {self.table_name} WHERE NOT (itemid = ANY({{itemIds}}))"
+        self.db.exec_itemIds(sql, itemIds)
+
+    def get_matrix(self, itemIds: List[int] = [], startep: int = 0, endep: int = 0
+                   ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ (itemIds, clocks, items x clocks matrix). missing values are NaN """
+        df = self.get_data(itemIds, startep, endep)
+        pivot = df.pivot(index='itemid', columns='clock', values='value')
+        return (pivot.index.to_numpy(dtype=np.int64), pivot.columns.to_numpy(dtype=np.int64), 
+                pivot.to_numpy(dtype=np.float64))
 
     def get_charts(self, itemIds: List[int], startep: int, endep: int) -> Dict[int, pd.Series]:
-        sql = f"SELECT itemid, clock, value FROM {self.table_name} WHERE itemid IN ({','.join(map(str, itemIds))}) AND clock >= {startep} AND clock <= {endep} ORDER BY itemid, clock;"
-        df = self.db.read_sql(sql)
-        if df.empty:
+        if len(itemIds) == 0:
             return {}
-        
-        df.columns = self.fields
-        
+        df = self.get_data(itemIds, startep, endep)
         charts = {}
-        for _, row in df.iterrows():
-            itemId = row.itemid
-            if itemId not in charts:
-                charts[itemId] = []
-            charts[itemId].append(row["value"])
-        
-        # convert to series
-        for itemId in charts:
-            charts[itemId] = pd.Series(charts[itemId])
-        
+        for itemId, values in df.groupby('itemid', sort=False)['value']:
+            charts[int(itemId)] = pd.Series(values.to_numpy())
         return charts
\ No newline at end of file
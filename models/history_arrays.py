@@ -0,0 +1,146 @@
+import pandas as pd
+import numpy as np
+from typing import List, Dict, Tuple
+
+from models.model import Model
+from db.postgresql import int_array
+import utils.config_loader as config_loader
+
+class HistoryArraysModel(Model):
+    """ history aligned to history_interval, one row per item
+        itemid: BIGINT
+        startep: INT    clock of the first value
+        step: INT       seconds between values
+        vals: BYTEA     float64 values packed little endian
+    """
+    sql_template = "history_arrays"
+    name = sql_template
+    fields = ['itemid', 'startep', 'step', 'vals']
+    primary_keys = ['itemid']
+    dtypes = {'itemid': 'int64', 'startep': 'int64', 'step': 'int64'}
+
+    def __init__(self, data_source_name=""):
+        super().__init__(data_source_name)
+        self.step = config_loader.conf["history_interval"]
+
+    def upsert_matrix(self, itemIds: List[int], base_clocks: List[int], matrix: np.ndarray):
+        """ replace the series of itemIds. matrix is items x base_clocks """
+        if len(itemIds) == 0:
+            return
+        matrix = np.ascontiguousarray(matrix, dtype='<f8')
+        self.bulk_upsert({
+            'itemid': np.asarray(itemIds, dtype=np.int64),
+            'startep': np.full(len(itemIds), base_clocks[0], dtype=np.int64),
+            'step': np.full(len(itemIds), self.step, dtype=np.int64),
+            'vals': ["\\x" + row.tobytes().hex() for row in matrix],
+        })
+
+    def append_matrix(self, itemIds: List[int], base_clocks: List[int], matrix: np.ndarray):
+        """ like upsert_matrix, keeping the values of itemIds before base_clocks """
+        if len(itemIds) == 0:
+            return
+        old_itemIds, old_clocks, old_matrix = self.get_matrix(itemIds, endep=base_clocks[0] - self.step)
+        if len(old_itemIds) == 0 or len(old_clocks) == 0:
+            return self.upsert_matrix(itemIds, base_clocks, matrix)
+        clocks = list(range(int(old_clocks[0]), int(base_clocks[-1]) + self.step, self.step))
+        new_matrix = np.full((len(itemIds), len(clocks)), np.nan)
+        rows = {int(itemId): i for i, itemId in enumerate(old_itemIds)}
+        for i, itemId in enumerate(itemIds):
+            if int(itemId) in rows:
+                new_matrix[i, :len(old_clocks)] = old_matrix[rows[int(itemId)]]
+        offset = (base_clocks[0] - clocks[0]) // self.step
+        new_matrix[:, offset:offset + len(base_clocks)] = matrix
+        self.upsert_matrix(itemIds, clocks, new_matrix)
+
+    def upsert(self, itemids: List[int], clocks: List[int], values: List[float]):
+        # long format on the history_interval grid, as written to HistoryModel
+        df = pd.DataFrame({'itemid': itemids, 'clock': clocks, 'value': values})
+        if df.empty:
+            return
+        df = df.astype({'itemid': 'int64', 'clock': 'int64', 'value': 'float64'})
+        pivot = df.pivot_table(index='itemid', columns='clock', values='value', aggfunc='last')
+        base_clocks = list(range(int(pivot.columns[0]), int(pivot.columns[-1]) + self.step, self.step))
+        pivot = pivot.reindex(columns=base_clocks)
+        self.upsert_matrix(pivot.index.tolist(), base_clocks, pivot.to_numpy())
+
+    def _read_sql(self, itemIds: List[int] = []) -> Tuple[str, List, List[str]]:
+        sql = f"SELECT {','.join(self.fields)} FROM {self.table_name}"
+        if len(itemIds) > 0:
+            sql += " WHERE itemid = ANY($1)"
+            return sql, [int_array(itemIds)], ["bigint[]"]
+        return sql, [], []
+
+    def _to_matrix(self, rows: pd.DataFrame, startep: int = 0, endep: int = 0
+                   ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        step = self.step
+        if rows.empty:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty((0, 0))
+        series = [np.frombuffer(v, dtype='<f8') for v in rows['vals']]
+        starts = rows['startep'].to_numpy()
+        ends = starts + np.array([len(s) for s in series]) * step
+        if startep == 0:
+            startep = starts.min()
+        if endep == 0:
+            endep = ends.max() - step
+        # clocks on the grid within startep <= clock <= endep
+        clocks = np.arange(startep + (-startep) % step, endep - endep % step + step, step, dtype=np.int64)
+
+        matrix = np.full((len(rows), len(clocks)), np.nan)
+        for i, s in enumerate(series):
+            # position of the item's first value on the clocks grid
+            offset = (starts[i] - clocks[0]) // step
+            lo = max(0, -offset)
+            hi = min(len(s), len(clocks) - offset)
+            if lo < hi:
+                matrix[i, offset + lo:offset + hi] = s[lo:hi]
+        itemIds = rows['itemid'].to_numpy()
+        order = np.argsort(itemIds, kind='stable')
+        return itemIds[order], clocks, matrix[order]
+
+    def get_matrix(self, itemIds: List[int] = [], startep: int = 0, endep: int = 0
+                   ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ (itemIds, clocks, items x clocks matrix). missing values are NaN """
+        sql, params, param_types = self._read_sql(itemIds)
+        rows = self.db.read_prepared(sql, self.fields, params, param_types, dtypes=self.dtypes)
+        return self._to_matrix(rows, startep, endep)
+
+    async def aget_matrix(self, itemIds: List[int] = [], startep: int = 0, endep: int = 0
+                          ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        sql, params, param_types = self._read_sql(itemIds)
+        rows = await self.adb.read_prepared(sql, self.fields, params, param_types, dtypes=self.dtypes)
+        return self._to_matrix(rows, startep, endep)
+
+    def _to_df(self, itemIds: np.ndarray, clocks: np.ndarray, matrix: np.ndarray) -> pd.DataFrame:
+        # long format ordered by itemid, clock like HistoryModel.get_data
+        mask = ~np.isnan(matrix)
+        rows, cols = np.nonzero(mask)
+        return pd.DataFrame({
+            'itemid': itemIds[rows].astype(np.int64),
+            'clock': clocks[cols].astype(np.int64),
+            'value': matrix[mask],
+        })
+
+    def get_data(self, itemIds: List[int]=[], startep: int = 0, endep: int = 0) -> pd.DataFrame:
+        return self._to_df(*self.get_matrix(itemIds, startep, endep))
+
+    async def aget_data(self, itemIds: List[int]=[], startep: int = 0, endep: int = 0) -> pd.DataFrame:
+        return self._to_df(*await self.aget_matrix(itemIds, startep, endep))
+
+    def get_charts(self, itemIds: List[int], startep: int, endep: int) -> Dict[int, pd.Series]:
+        itemIds, _, matrix = self.get_matrix(itemIds, startep, endep)
+        charts = {}
+        for i, itemId in enumerate(itemIds):
+            values = matrix[i][~np.isnan(matrix[i])]
+            if len(values) > 0:
+                charts[int(itemId)] = pd.Series(values)
+        return charts
+
+    def remove_old_data(self, clock: int):
+        # series whose last value is older than clock
+        sql = f"DELETE FROM {self.table_name} WHERE startep + step * (octet_length(vals) / 8 - 1) < {clock};"
+        self.db.exec_sql(sql)
+        # cut the values older than clock from the others
+        sql = f"""UPDATE {self.table_name} t SET vals = substring(t.vals FROM d.n * 8 + 1), startep = t.startep + d.n * t.step
+    FROM (SELECT itemid, ({clock} - startep + step - 1) / step AS n FROM {self.table_name} WHERE startep < {clock}) d
+    WHERE t.itemid = d.itemid;"""
+        self.db.exec_sql(sql)
@@ -0,0 +1,30 @@
+import numpy as np
+from typing import List, Dict
+
+from models.model import Model
+from db.postgresql import int_array
+
+class HistoryWatermarksModel(Model):
+    """ last base clock of the aligned history fetched from the data source per item
+        itemid: BIGINT
+        clock: INT
+    """
+    sql_template = "watermarks"
+    name = "history_watermarks"
+    fields = ['itemid', 'clock']
+    primary_keys = ['itemid']
+
+    def get_watermarks(self, itemIds: List[int]) -> Dict[int, int]:
+        if len(itemIds) == 0:
+            return {}
+        sql = f"SELECT itemid, clock FROM {self.table_name} WHERE itemid = ANY($1)"
+        cur = self.db.exec_prepared(sql, [int_array(itemIds)], ["bigint[]"])
+        watermarks = {int(itemId): int(clock) for (itemId, clock) in cur}
+        cur.close()
+        return watermarks
+
+    def upsert_watermarks(self, watermarks: Dict[int, int]):
+        self.bulk_upsert({
+            'itemid': np.asarray(list(watermarks.keys()), dtype=np.int64),
+            'clock': np.asarray(list(watermarks.values()), dtype=np.int64),
+        })
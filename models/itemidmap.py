@@ -9,13 +9,11 @@ class ItemIdMapModel(Model):
 
     def get_data(self, itemIds: List[int] = []) -> pd.DataFrame:
         sql = f"SELECT * FROM {self.table_name}"
-        where = []
         if len(itemIds) > 0:
-            where.append(f"itemid IN ({','.join(map(str, itemIds))})")
-        if len(where) > 0:
-            sql += " WHERE " + " AND ".join(where)
-        
-        df = self.db.read_sql(sql)
+            sql += " WHERE itemid = ANY({itemIds})"
+            df = self.db.read_itemIds(sql, self.fields, itemIds)
+        else:
+            df = self.db.read_sql(sql)
         if df.empty:
             return pd.DataFrame(columns=self.fields, dtype=object)
         df.columns = self.fields
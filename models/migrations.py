@@ -0,0 +1,25 @@
+from models.model import Model
+
+class MigrationsModel(Model):
+    """ migration version applied to each admdb table
+        table_name: VARCHAR
+        version: INT    number of Model.indexes created on the table
+        applied: TIMESTAMP
+    """
+    sql_template = "migrations"
+    name = sql_template
+
+    def get_version(self, table_name: str) -> int:
+        val = self.db.select1value(self.table_name, "version", [f"table_name = '{table_name}'"])
+        if val is None:
+            return 0
+        return val
+
+    def set_version(self, table_name: str, version: int):
+        self.db.exec_sql(f"""INSERT INTO {self.table_name} (table_name, version, applied)
+    VALUES('{table_name}', {version}, now())
+    ON CONFLICT(table_name) DO UPDATE SET
+    version=excluded.version, applied=excluded.applied;""")
+
+    def delete_version(self, table_name: str):
+        self.db.exec_sql(f"DELETE FROM {self.table_name} WHERE table_name = '{table_name}';")
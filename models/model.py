@@ -1,11 +1,27 @@
-from typing import List, Tuple
+from typing import List, Tuple, Dict, Union
+import threading
+import numpy as np
+import pandas as pd
 
 from db.postgresql import PostgreSqlDB
+from db.thread_offload import ThreadOffloadDB
 import utils.config_loader as config_loader
 
+# tables already created in this process, keyed by (host, dbname, schema, table)
+_created_tables = set()
+# reentrant: creating a table also creates the migrations table
+_created_tables_lock = threading.RLock()
+
 class Model:
     name = ""
     sql_template = ""
+    fields: List[str] = []
+    primary_keys: List[str] = []
+    # indexes the queries of the model need: (name, columns, include columns).
+    # columns None drops the index of that name again.
+    # append only. the number of entries is the migration version of the table.
+    # index_applies can leave an index out depending on the table.
+    indexes: List[Tuple[str, List[str], List[str]]] = []
 
     def __init__(self, data_source_name=""):
         self.schema_name = config_loader.conf["admdb"]["schema"]
@@ -15,6 +31,8 @@ class Model:
         else:
             self.table_name = f"{data_source_name}_{self.name}"
         self.db = PostgreSqlDB(config_loader.conf['admdb'])
+        self.db.tag = self.__class__.__name__
+        self.adb = ThreadOffloadDB(self.db)
         self.batch_size = config_loader.conf["batch_size"]
         self.create_table()
 
@@ -23,12 +41,89 @@ class Model:
         
     def drop(self):
         self.db.exec_sql(f"DROP TABLE IF EXISTS {self.table_name};")
+        with _created_tables_lock:
+            _created_tables.discard(self._table_key())
+        if len(self.indexes) > 0:
+            # the indexes went with the table
+            from models.migrations import MigrationsModel
+            MigrationsModel().delete_version(self.table_name)
+
+    def _table_key(self) -> Tuple:
+        conf = config_loader.conf['admdb']
+        return (conf['host'], conf['dbname'], self.schema_name, self.table_name)
     
     def create_table(self):
-        table_name = f"{self.schema_name}.{self.table_name}"
-        if self.db.table_exists(table_name):
+        # CREATE TABLE IF NOT EXISTS once per process and table
+        key = self._table_key()
+        if key in _created_tables:
+            return
+        with _created_tables_lock:
+            if key in _created_tables:
+                return
+            table_name = f"{self.schema_name}.{self.table_name}"
+            self.db.create_table(table_name, self.sql_template)
+            self.migrate()
+            _created_tables.add(key)
+
+    def get_index_name(self, name: str) -> str:
+        return f"{self.table_name}_{name}_idx"
+
+    def index_applies(self, name: str) -> bool:
+        return True
+
+    def declared_indexes(self) -> List[Tuple[str, List[str], List[str]]]:
+        """ the indexes left after applying every entry of indexes """
+        declared = {}
+        for (name, columns, include) in self.indexes:
+            if columns is None or not self.index_applies(name):
+                declared.pop(name, None)
+            else:
+                declared[name] = (name, columns, include)
+        return list(declared.values())
+
+    def migrate(self):
+        """ apply the entries of indexes after the version applied to the table """
+        if len(self.indexes) == 0:
+            return
+        from models.migrations import MigrationsModel
+        migrations = MigrationsModel()
+        version = migrations.get_version(self.table_name)
+        if version >= len(self.indexes):
             return
-        self.db.create_table(table_name, self.sql_template)
+        # a table without any applied entry only needs the indexes left at the end
+        entries = self.declared_indexes() if version == 0 else self.indexes[version:]
+        for (name, columns, include) in entries:
+            if columns is None or not self.index_applies(name):
+                self.db.exec_sql(f"DROP INDEX IF EXISTS {self.get_index_name(name)};")
+                continue
+            sql = f"CREATE INDEX IF NOT EXISTS {self.get_index_name(name)} ON {self.table_name} ({','.join(columns)})"
+            if len(include) > 0:
+                # covering index for index-only scans
+                sql += f" INCLUDE ({','.join(include)})"
+            self.db.exec_sql(sql + ";")
+        migrations.set_version(self.table_name, len(self.indexes))
+
+    def index_report(self) -> Dict[str, List]:
+        """
+        missing: declared indexes which do not exist on the table
+        unused: non unique indexes of the table never scanned since the stats reset, 
+                summed over the partitions of partitioned tables
+        """
+        sql = f"""SELECT indexname FROM pg_catalog.pg_indexes 
+    WHERE schemaname = '{self.schema_name}' AND tablename = '{self.table_name.lower()}';"""
+        existing = [indexname for (indexname,) in self.db.exec_sql(sql)]
+        missing = [self.get_index_name(name) for (name, _, _) in self.declared_indexes() 
+                   if self.get_index_name(name).lower() not in existing]
+
+        sql = f"""SELECT coalesce(pg_partition_root(s.indexrelid), s.indexrelid)::regclass::text, sum(s.idx_scan)
+    FROM pg_catalog.pg_stat_user_indexes s
+    JOIN pg_catalog.pg_index x ON x.indexrelid = s.indexrelid
+    WHERE (s.relid = '{self.schema_name}.{self.table_name}'::regclass 
+        OR s.relid IN (SELECT relid FROM pg_partition_tree('{self.schema_name}.{self.table_name}')))
+    AND NOT x.indisunique
+    GROUP BY 1;"""
+        unused = [indexname.split(".")[-1] for (indexname, scans) in self.db.exec_sql(sql) if scans == 0]
+        return {"missing": missing, "unused": unused}
         
 
     def initialize(self):
@@ -43,21 +138,32 @@ class Model:
     
     def separate_existing_itemIds(self, itemIds: List[int]) -> Tuple[List[int],List[int]]:
         sql = f"SELECT distinct itemid FROM {self.table_name}"
-        where_conds = ""
         if len(itemIds) > 0:
-            where_conds = f"itemid IN ({','.join(map(str, itemIds))})"
-
-        if where_conds != "":
-            sql += " WHERE " + where_conds
-
-        cur = self.db.exec_sql(sql)
-        existing = []
-        for (itemId,) in cur:
-            existing.append(itemId)
+            sql += " WHERE itemid = ANY({itemIds})"
+            cur = self.db.exec_itemIds(sql, itemIds)
+        else:
+            cur = self.db.exec_prepared(sql)
+        existing = [itemId for (itemId,) in cur]
+        cur.close()
 
-        nonexisting = [item for item in itemIds if item not in existing]
+        existing_set = set(existing)
+        nonexisting = [item for item in itemIds if item not in existing_set]
         return existing, nonexisting
     
+    def bulk_upsert(self, data: Union[pd.DataFrame, Dict[str, np.ndarray]], 
+                    update_fields: List[str] = None):
+        """
+        Write a DataFrame or a dict of NumPy arrays keyed by field name 
+        with COPY into a staging table and one INSERT ... ON CONFLICT on primary_keys.
+        """
+        if data is None:
+            return
+        if isinstance(data, dict):
+            data = pd.DataFrame(data)
+        if len(data) == 0:
+            return
+        self.db.bulk_upsert(self.table_name, data, self.fields, self.primary_keys, update_fields)
+
     def count(self) -> int:
         sql = f"SELECT COUNT(*) FROM {self.table_name}"
         (count,) = self.db.exec_sql(sql).fetchone()
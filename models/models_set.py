@@ -1,4 +1,9 @@
+import threading
+from typing import Dict, List
+
 from models.history import HistoryModel
+from models.history_arrays import HistoryArraysModel
+from models.history_watermarks import HistoryWatermarksModel
 from models.history_stats import HistoryStatsModel
 from models.history_updates import HistoryUpdatesModel
 from models.trends_stats import TrendsStatsModel
@@ -8,8 +13,25 @@ from models.topitems import TopItemsModel
 from db.postgresql import PostgreSqlDB
 import utils.config_loader as config_loader
 
+# schemas already created in this process, keyed by (host, dbname, schema)
+_created_schemas = set()
+_created_schemas_lock = threading.Lock()
+
 
 class ModelsSet:
+    # models are built, and their tables created, on first access
+    model_classes = {
+        "history": HistoryModel,
+        "history_arrays": HistoryArraysModel,
+        "history_watermarks": HistoryWatermarksModel,
+        "history_updates": HistoryUpdatesModel,
+        "history_stats": HistoryStatsModel,
+        "trends_stats": TrendsStatsModel,
+        "trends_updates": TrendsUpdatesModel,
+        "anomalies": AnomaliesModel,
+        "topitems": TopItemsModel,
+    }
+
     def __init__(self, data_source_name):
         self.data_source_name = data_source_name
         self.schema_name = config_loader.conf["admdb"]["schema"]
@@ -18,30 +40,54 @@ class ModelsSet:
 
     # create schema with name of data_source_name 
     def create_schema(self):
-        db = PostgreSqlDB(config_loader.conf["admdb"])
-        db.create_schema(self.schema_name)
+        conf = config_loader.conf["admdb"]
+        key = (conf["host"], conf["dbname"], self.schema_name)
+        if key in _created_schemas:
+            return
+        with _created_schemas_lock:
+            if key in _created_schemas:
+                return
+            db = PostgreSqlDB(conf)
+            db.create_schema(self.schema_name)
+            _created_schemas.add(key)
 
     
     def load_models(self):
-        self.history = HistoryModel(self.data_source_name)
-        self.history_updates = HistoryUpdatesModel(self.data_source_name)
-        self.history_stats = HistoryStatsModel(self.data_source_name)
-        self.trends_stats = TrendsStatsModel(self.data_source_name)
-        self.trends_updates = TrendsUpdatesModel(self.data_source_name)
-        self.anomalies = AnomaliesModel(self.data_source_name)
-        self.topitems = TopItemsModel(self.data_source_name)
-        
-        self.models = [
-            self.history,
-            self.history_updates,
-            self.history_stats,
-            self.trends_stats,
-            self.trends_updates,
-            self.anomalies,
-            self.topitems
-        ]
+        self._models = {}
+
+    def get_model(self, name: str):
+        m = self._models.get(name)
+        if m is None:
+            m = self.model_classes[name](self.data_source_name)
+            self._models[name] = m
+        return m
+
+    def __getattr__(self, name: str):
+        # only called for attributes not found normally, i.e. the models
+        if name in ModelsSet.model_classes and "_models" in self.__dict__:
+            return self.get_model(name)
+        raise AttributeError(name)
+
+    @property
+    def aligned_history(self):
+        """ history on the history_interval grid used by detection. see history_storage in default.yml """
+        if config_loader.conf.get("history_storage", "rows") == "arrays":
+            return self.get_model("history_arrays")
+        return self.get_model("history")
+
+    @property
+    def models(self):
+        return [self.get_model(name) for name in self.model_classes]
         
 
+    def migrate(self):
+        # the tables are migrated when they are created
+        for m in self.models:
+            m.create_table()
+
+    def index_report(self) -> Dict[str, Dict[str, List]]:
+        return {m.table_name: m.index_report() for m in self.models}
+
     def drop(self):
         for m in self.models:
             try:
@@ -52,7 +98,9 @@ class ModelsSet:
 
     def initialize(self):
         self.drop()
-        self.load_models()
+        # recreate right away. other ModelsSet may hold these models.
+        for m in self.models:
+            m.create_table()
 
     def check_conn(self) -> bool:
         for m in self.models:
@@ -1,4 +1,5 @@
 import pandas as pd
+import numpy as np
 from typing import List
 
 from models.model import Model
@@ -15,6 +16,9 @@ class StatsModel(Model):
     sql_template = "stats"
     name = sql_template
     fields = ['itemid', 'sum', 'sqr_sum', 'cnt', 'mean', 'std']
+    primary_keys = ['itemid']
+    dtypes = {'itemid': 'int64', 'sum': 'float64', 'sqr_sum': 'float64', 'cnt': 'int64', 
+              'mean': 'float64', 'std': 'float64'}
 
 
     
@@ -30,29 +34,27 @@ class StatsModel(Model):
         sql = sql[:-1] + ";"
 
         self.db.exec_sql(sql)
+
+    def upsert_stats_df(self, stats: pd.DataFrame):
+        # stats: DataFrame with columns itemid, sum, sqr_sum, cnt, mean, std
+        stats = stats[self.fields].copy()
+        stats['cnt'] = stats['cnt'].astype(np.int64)
+        self.bulk_upsert(stats)
         
     def read_stats(self, itemids: List[int] = []) -> pd.DataFrame:
-        sql = f"SELECT * FROM {self.table_name}"
-        where = []
+        sql = f"SELECT {','.join(self.fields)} FROM {self.table_name}"
         if len(itemids) > 0:
-            where.append(f"itemid IN ({','.join(map(str, itemids))})")
-        if len(where) > 0:
-            sql += " WHERE " + " AND ".join(where)
-
-        df = self.db.read_sql(sql)
-        if len(df) == 0:
-            return pd.DataFrame(columns=self.fields, dtype=object)
-        df.columns = self.fields
-        return df
+            sql += " WHERE itemid = ANY({itemIds})"
+            return self.db.read_itemIds(sql, self.fields, itemids, dtypes=self.dtypes)
+        return self.db.read_prepared(sql, self.fields, dtypes=self.dtypes)
 
     def get_stats_per_itemId(self, itemIds: List[int] = []) -> dict:
         stats = {}
         df = self.read_stats(itemIds)
-        for _, row in df.iterrows():
-            itemId = row.itemid
-            stats[itemId] = {
-                'cnt': int(row["cnt"]),
-                'mean': float(row["mean"]),
-                'std': float(row["std"])
+        for row in df.itertuples(index=False):
+            stats[int(row.itemid)] = {
+                'cnt': int(row.cnt),
+                'mean': float(row.mean),
+                'std': float(row.std)
             }
         return stats
\ No newline at end of file
@@ -46,6 +46,13 @@ class TestAnomaliesModel(unittest.TestCase):
         last_updated = anomalies.get_last_updated()
         self.assertGreater(last_updated, 0)
 
+        # Test update_clusterid: only the latest created row of each item is updated
+        data["created"] = [1234567900, 1234567901]
+        anomalies.insert_data(data)
+        anomalies.update_clusterid({1: 5, 2: 6, 3: 7})
+        df = anomalies.get_data().sort_values(["itemid", "created"])
+        self.assertEqual(df["clusterid"].tolist(), [201, 5, 202, 6])
+
 
 
 if __name__ == "__main__":
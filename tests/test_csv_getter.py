@@ -4,8 +4,11 @@ unit tests for sample_getter.py
 import unittest, os
 import time
 
+import numpy as np
+
 import __init__
 
+import utils
 from data_getter.csv_getter import CsvGetter
 
 
@@ -66,6 +69,41 @@ class TestCsvGetter(unittest.TestCase):
         self.assertEqual(len(groups['hw/nw']), 3)
         self.assertEqual(len(groups['hw/pc']), 5)
 
+    def test_csv_cache(self):
+        import tempfile, shutil
+        with tempfile.TemporaryDirectory() as data_dir:
+            for filename in ['history.csv.gz', 'trends.csv.gz', 'items.csv.gz']:
+                shutil.copy(os.path.join('testdata/csv/20250214_1100', filename), data_dir)
+            csv_getter = CsvGetter({'type': 'csv', 'data_dir': data_dir})
+            df = csv_getter.get_history_data(0, 2**31, [59888])
+            self.assertGreater(len(df), 0)
+            self.assertTrue((df['clock'].diff().dropna() > 0).all())
+            # the item index is written next to the data
+            self.assertTrue(os.path.exists(os.path.join(data_dir, 'item_index.json')))
+            self.assertEqual(csv_getter.get_item_host_dict([59888]), {59888: 10769})
+
+            # parsed again when the file changes
+            df.iloc[:3].to_csv(os.path.join(data_dir, 'history.csv.gz'), index=False)
+            self.assertEqual(len(csv_getter.get_history_data(0, 2**31, [59888])), 3)
+            self.assertEqual(csv_getter.get_itemIds(), [59888])
+
+    def test_aggregates(self):
+        csv_getter = CsvGetter({'type': 'csv', 'data_dir': 'testdata/csv/20250214_1100'})
+        endep = 1739505557
+        itemIds = [59888, 93281, 217822, 267903]
+        for get_data, get_aggregates, startep in [
+                (csv_getter.get_history_data, csv_getter.get_history_aggregates, endep - 3600 * 3),
+                (csv_getter.get_trends_data, csv_getter.get_trends_aggregates, endep - 3600 * 24 * 7)]:
+            # same as the per item groupby with utils.square_sum they replace
+            data = get_data(startep, endep, itemIds)
+            expected = data.groupby('itemid').agg(
+                sum=('value', 'sum'), sqr_sum=('value', utils.square_sum), cnt=('value', 'count')).reset_index()
+            df = get_aggregates(startep, endep, itemIds).sort_values('itemid').reset_index(drop=True)
+            self.assertEqual(df['itemid'].tolist(), expected['itemid'].tolist())
+            self.assertEqual(df['cnt'].tolist(), expected['cnt'].tolist())
+            np.testing.assert_allclose(df['sum'], expected['sum'], rtol=1e-12)
+            np.testing.assert_allclose(df['sqr_sum'], expected['sqr_sum'], rtol=1e-12)
+
         
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
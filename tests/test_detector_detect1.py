@@ -5,6 +5,8 @@ from models.models_set import ModelsSet
 import utils.config_loader as config_loader
 from data_processing.detector import Detector
 import trends_stats
+import pandas as pd
+from data_processing.item_conds import ItemConds
 
 class TestDetector(unittest.TestCase):
     def run_update_test(self, name, n_expected_items, config, endep, itemIds, initialize):
@@ -60,6 +62,19 @@ class TestDetector(unittest.TestCase):
         self.assertGreater(len(anomaly_itemIds), 0)
 
 
+    def test_item_conds(self):
+        class CondsGetter:
+            def get_cond_itemIds(self, item_cond):
+                return {"big": [1, 2, 3], "ignore": [4]}[item_cond]
+
+        conds = ItemConds(CondsGetter(), [
+            {"filter": "big", "condition": {"operator": ">", "value": 10}},
+            {"filter": "ignore"},
+        ])
+        df = pd.DataFrame({'itemid': [1, 2, 4, 5], 'mean_h': [20.0, 5.0, 100.0, 1.0]})
+        self.assertEqual(conds.filter(df, 'mean_h')['itemid'].tolist(), [1, 5])
+
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,6 +1,10 @@
 import unittest
+import asyncio
+import time
+import pandas as pd
 
 import __init__
+from data_processing.detector import Detector
 from models.models_set import ModelsSet
 import utils.config_loader as config_loader
 import detect_anomalies
@@ -35,6 +39,40 @@ class TestDetector(unittest.TestCase):
 
         self.assertGreater(len(itemIds), 0, "No itemIds detected")
 
+    def test_iter_batch_dfs(self):
+        d = Detector.__new__(Detector)
+        d.batch_size = 2
+        d.max_inflight_batches = 3
+        started = []
+        finished = []
+
+        async def aget_df(itemIds, t_start, h_start, h_end):
+            started.append(itemIds[0])
+            # still running when the previous batch is yielded
+            await asyncio.sleep(0.01 * itemIds[0])
+            finished.append(itemIds[0])
+            return pd.DataFrame({'itemid': itemIds}), pd.DataFrame()
+        d._aget_df = aget_df
+
+        itemIds = list(range(1, 11))
+        batches = []
+        for batch_itemIds, trends_df, _ in d._iter_batch_dfs(itemIds, 0, 0, 0):
+            self.assertEqual(trends_df['itemid'].tolist(), batch_itemIds)
+            batches.append(batch_itemIds)
+            # the next batches are fetched completely while this one is processed,
+            # but never more than max_inflight_batches - 1 of them
+            time.sleep(0.1)
+            ahead = min(d.max_inflight_batches - 1, 5 - len(batches))
+            self.assertEqual(len(started), len(batches) + ahead)
+            self.assertEqual(len(finished), len(batches) + ahead)
+        self.assertEqual(batches, [itemIds[i:i+2] for i in range(0, 10, 2)])
+
+        # stopping early cancels the batches in flight
+        started.clear()
+        for _ in d._iter_batch_dfs(itemIds, 0, 0, 0):
+            break
+        self.assertEqual(len(started), d.max_inflight_batches)
+
 
         
         
@@ -1,4 +1,5 @@
 import unittest
+import pandas as pd
 
 import __init__
 from models.models_set import ModelsSet
@@ -55,6 +56,58 @@ class TestDetector(unittest.TestCase):
         endep = 1739505598
         self.run_update_test(name, config, endep, itemIds, 59888)
         
+        # the second run only fetched the data after the watermarks
+        watermarks = ms.history_watermarks.get_watermarks(itemIds)
+        self.assertEqual(sorted(watermarks.keys()), sorted(itemIds))
+        self.assertTrue(all([endep - 1800 < clock <= endep for clock in watermarks.values()]))
+        d = Detector(name, config['data_sources'][name], itemIds)
+        fetches = d._get_history_fetches(itemIds, normalizer.get_base_clocks(endep + 600 - 86400, endep + 600, 600))
+        self.assertEqual(len(fetches), 1)
+        self.assertLessEqual(len(fetches[0][1]), 3)
+
+    def test_update_history_stalled(self):
+        # item 2 stops reporting after the first run
+        name = 'test_update_history_stalled'
+        ms = ModelsSet(name)
+        ms.initialize()
+        interval = config_loader.conf['history_interval']
+        endep1 = 1739505600 - 1739505600 % interval
+        endep2 = endep1 + interval * 6
+        fetched = []
+
+        class Getter:
+            def get_history_buckets(self, startep, endep, unitsecs, itemIds=[]):
+                fetched.append((startep, sorted(itemIds)))
+                clocks = [clock for clock in normalizer.get_base_clocks(startep, endep, unitsecs) if clock >= startep]
+                rows = [(1, clock, clock / unitsecs) for clock in clocks if 1 in itemIds]
+                rows += [(2, clock, 7.0) for clock in clocks if 2 in itemIds and clock <= endep1]
+                return pd.DataFrame(rows, columns=['itemid', 'clock', 'value'])
+
+        d = Detector.__new__(Detector)
+        d.dg = Getter()
+        d.ms = ms
+        d.itemIds = [1, 2]
+        d.batch_size = 10
+        d.history_interval = interval
+        d.anomaly_keep_secs = interval * 24
+        d.history_cache = True
+
+        d.update_history(endep1)
+        fetched.clear()
+        d.update_history(endep2)
+        # one fetch from the last base clock of the first run
+        self.assertEqual(fetched, [(endep1 - interval + 1, [1, 2])])
+
+        base_clocks = normalizer.get_base_clocks(endep2 - d.anomaly_keep_secs, endep2, interval)
+        charts = ms.aligned_history.get_charts([1, 2], base_clocks[0], endep2)
+        self.assertEqual(len(charts[1]), len(base_clocks))
+        self.assertEqual(len(charts[2]), len(base_clocks))
+        self.assertTrue((charts[2] == 7.0).all())
+        self.assertEqual(ms.history_watermarks.get_watermarks([1, 2]), {1: base_clocks[-1], 2: base_clocks[-1]})
+
+        # the stalled item does not hold the fetch window back
+        fetches = d._get_history_fetches([1, 2], normalizer.get_base_clocks(endep2 + interval - d.anomaly_keep_secs, endep2 + interval, interval))
+        self.assertEqual(fetches, [([1, 2], [endep2, endep2 + interval])])
 
 
 if __name__ == '__main__':
@@ -1,11 +1,47 @@
 import unittest, os
 import time
+import threading
+import functools
+import collections
+import http.server
+import flask
+import werkzeug.serving
 
 import __init__
 
 from data_getter.logan_getter import LoganGetter
 from models.models_set import ModelsSet
 
+class FetchHandler(http.server.SimpleHTTPRequestHandler):
+    """ serves testdata/loganal plus a host sending slowly and a host with broken csv """
+    requests = collections.Counter()
+
+    def do_GET(self):
+        FetchHandler.requests[self.path] += 1
+        if self.path.startswith('/SLOW/'):
+            self.send_response(200)
+            self.send_header('Content-Length', '1000')
+            self.end_headers()
+            try:
+                for _ in range(1000):
+                    self.wfile.write(b'1')
+                    self.wfile.flush()
+                    time.sleep(0.05)
+            except OSError:
+                pass
+        elif self.path == '/BROKEN/logGroups.csv':
+            body = b'itemid,count\n1,20000\n'
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
 class TestLoganGetter(unittest.TestCase):
     
     def test_logan_getter(self):
@@ -61,6 +97,11 @@ class TestLoganGetter(unittest.TestCase):
         for itemId in itemIds:
             self.assertGreater(len(history[history["itemid"] == itemId]), 0)
 
+        # aggregated from the history streamed in chunks
+        logan_getter.ms.history.db.fetch_chunksize = 100
+        aggregates = logan_getter.get_history_aggregates(startep, endep, itemIds).set_index('itemid')
+        self.assertEqual(aggregates['cnt'].to_dict(), history.groupby('itemid')['value'].count().to_dict())
+
 
         # get trends
         startep = endep - 3600 * 24 * 3
@@ -90,9 +131,142 @@ class TestLoganGetter(unittest.TestCase):
         self.assertEqual(row["group_name"].values[0], "firewall")
         self.assertEqual(row["hostid"].values[0], 4)
         self.assertEqual(row["host_name"].values[0], "NFPFW003")
+
+        # delta import: unchanged files are not downloaded again
+        state = logan_getter._load_history_state(4, logan_getter.ms.history.get_max_clock())
+        self.assertGreater(state['watermark'], 0)
+        df, _ = logan_getter._get_history_delta(4, state)
+        self.assertEqual(len(df), 0)
+        # rows at or before the watermark are skipped
+        state = dict(logan_getter._new_history_state(), watermark=state['watermark'] - 3600)
+        df, new_state = logan_getter._get_history_delta(4, state)
+        self.assertGreater(len(df), 0)
+        self.assertGreater(df['clock'].min(), state['watermark'])
+        self.assertGreater(new_state['watermark'], state['watermark'])
         
         os.system('pkill -f http.server')
 
+    def test_fetch_failures(self):
+        # a slow host and a broken host do not stop the others
+        server = http.server.ThreadingHTTPServer(('localhost', 0),
+            functools.partial(FetchHandler, directory='testdata/loganal'))
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        FetchHandler.requests.clear()
+        data_source = {
+            'name': 'test_logan_fetch',
+            'type': 'logan',
+            'data_dir': '/tmp/anomdec_test_fetch',
+            'base_url': f'http://localhost:{server.server_address[1]}',
+            'groups': {
+                'proxy': {1: 'SOPHOS-01', 2: 'SLOW'},
+                'firewall': {3: 'BROKEN', 4: 'NFPFW003'},
+            },
+            'minimal_group_size': 10000,
+            'fetch_timeout': 2,
+        }
+        ModelsSet(data_source['name']).initialize()
+        os.system('rm -rf %s' % data_source['data_dir'])
+        try:
+            logan_getter = LoganGetter(data_source)
+            start = time.time()
+            logan_getter.import_data()
+            # SLOW takes 50 seconds to send logGroups.csv
+            self.assertLess(time.time() - start, 20)
+
+            self.assertEqual(set(logan_getter.item_details['hostid']), {1, 4})
+            history = logan_getter.ms.history.get_data(logan_getter.itemIds, 0, 2000000000)
+            self.assertEqual(set(history['itemid'].astype(str).str[0]), {'1', '4'})
+            for host in ['SOPHOS-01', 'NFPFW003']:
+                self.assertTrue(os.path.exists(f"{data_source['data_dir']}/{host}_history_state.json"))
+            for host in ['SLOW', 'BROKEN']:
+                self.assertFalse(os.path.exists(f"{data_source['data_dir']}/{host}_history_state.json"))
+
+            # each file is downloaded once
+            self.assertEqual(dict(FetchHandler.requests), {
+                '/SOPHOS-01/logGroups.csv': 1, '/SOPHOS-01/logGroups_last.csv': 1, '/SOPHOS-01/history.csv': 1,
+                '/NFPFW003/logGroups.csv': 1, '/NFPFW003/logGroups_last.csv': 1, '/NFPFW003/history.csv': 1,
+                '/SLOW/logGroups.csv': 1, '/BROKEN/logGroups.csv': 1,
+            })
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_history_range(self):
+        # werkzeug answers Range, If-None-Match and If-Range requests like a static file server
+        www = '/tmp/anomdec_test_range_www'
+        os.system('rm -rf %s' % www)
+        os.makedirs(f'{www}/HOST')
+        app = flask.Flask(__name__)
+        statuses = []
+
+        @app.route('/<host>/<name>')
+        def get_file(host, name):
+            return flask.send_from_directory(f'{www}/{host}', name, conditional=True, etag=True)
+
+        @app.after_request
+        def record(response):
+            statuses.append(response.status_code)
+            return response
+
+        server = werkzeug.serving.make_server('localhost', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        data_source = {
+            'name': 'test_logan_range',
+            'type': 'logan',
+            'data_dir': '/tmp/anomdec_test_range',
+            'base_url': f'http://localhost:{server.server_port}',
+            'groups': {'firewall': {4: 'HOST'}},
+            'history_range': True,
+        }
+        with open('testdata/loganal/NFPFW003/history.csv', 'rb') as f:
+            header = f.readline()
+            lines = sorted(f.readlines(), key=lambda line: int(line.split(b',')[1]))
+        path = f'{www}/HOST/history.csv'
+        def write(data, mode='wb'):
+            with open(path, mode) as f:
+                f.write(data)
+            # a new ETag even within the same second
+            os.utime(path, ns=(time.time_ns(), time.time_ns() + len(statuses) * 10**9))
+        try:
+            logan_getter = LoganGetter(data_source)
+            write(header + b''.join(lines[:100]))
+            df, state = logan_getter._get_history_delta(4, logan_getter._new_history_state())
+            self.assertEqual((statuses[-1], len(df)), (200, 100))
+            self.assertEqual(state['offset'], os.path.getsize(path))
+
+            # unchanged. werkzeug answers the Range before If-None-Match with the tail only
+            df, state2 = logan_getter._get_history_delta(4, state)
+            self.assertIn(statuses[-1], [304, 206])
+            self.assertEqual((len(df), state2), (0, state))
+
+            # appended rows and a line still being written
+            write(b''.join(lines[100:150]) + lines[150][:5], 'ab')
+            df, state = logan_getter._get_history_delta(4, state)
+            self.assertEqual((statuses[-1], len(df)), (206, 50))
+            self.assertEqual(state['offset'], os.path.getsize(path) - 5)
+            self.assertEqual(df['clock'].tolist(), [int(line.split(b',')[1]) for line in lines[100:150]])
+            write(lines[150][5:], 'ab')
+            df, state = logan_getter._get_history_delta(4, state)
+            self.assertEqual((statuses[-1], len(df), int(df['clock'].iloc[0])), (206, 1, int(lines[150].split(b',')[1])))
+
+            # rewritten shorter or longer: all of it with the rows after the watermark
+            for rows, status in [(lines[100:120], 416), (lines[200:400], 206)]:
+                write(header + b''.join(rows))
+                watermark = state['watermark']
+                df, state = logan_getter._get_history_delta(4, state)
+                self.assertEqual(statuses[-2:], [status, 200])
+                self.assertEqual(state['offset'], os.path.getsize(path))
+                self.assertEqual(len(df), len([line for line in rows if int(line.split(b',')[1]) > watermark]))
+            self.assertGreater(len(df), 0)
+
+            # an empty file
+            write(b'')
+            df, state = logan_getter._get_history_delta(4, logan_getter._new_history_state())
+            self.assertEqual((statuses[-1], len(df), state['offset']), (200, 0, 0))
+        finally:
+            server.shutdown()
+            server.server_close()
 
 
 if __name__ == '__main__':
@@ -26,7 +26,14 @@ class TestFormatter(unittest.TestCase):
         new_values = fit_to_base_clocks(base_clocks, clocks, values)
         self.assertEqual(new_values, expected_values)
 
-        
+    def test_fill_base_clocks(self):
+        clocks = np.array([1, 10, 11, 20, 21])
+        self.assertEqual(get_bucket_clocks(clocks, 10).tolist(), [10, 10, 20, 20, 30])
+
+        df = pd.DataFrame({"itemid": [1, 1, 2, 2], "clock": [20, 40, 10, 30], "value": [1.0, 2.0, 3.0, 4.0]})
+        itemIds, matrix = fill_base_clocks([10, 20, 30, 40, 50], df)
+        self.assertEqual(itemIds, [1, 2])
+        self.assertEqual(matrix.tolist(), [[1, 1, 2, 2, 2], [3, 4, 4, 4, 4]])
         
         
 
@@ -0,0 +1,53 @@
+"""
+unit tests for parquet_getter.py
+"""
+import unittest, os, shutil, tempfile
+
+import __init__
+
+from data_getter.csv_getter import CsvGetter
+
+try:
+    from data_getter.parquet_getter import ParquetGetter, write_partitioned
+    has_pyarrow = True
+except ImportError:
+    has_pyarrow = False
+
+
+@unittest.skipUnless(has_pyarrow, "pyarrow is not installed")
+class TestParquetGetter(unittest.TestCase):
+    def test_parquet_getter(self):
+        csv_dir = 'testdata/csv/20250214_1100'
+        csv_getter = CsvGetter({'type': 'csv', 'data_dir': csv_dir})
+        with tempfile.TemporaryDirectory() as data_dir:
+            # small row groups so that the statistics skip some of them
+            write_partitioned(csv_getter.get_history_data(0, 2**31), os.path.join(data_dir, 'history'), 500)
+            write_partitioned(csv_getter.get_trends_full_data(0, 2**31), os.path.join(data_dir, 'trends'), 500)
+            shutil.copy(os.path.join(csv_dir, 'items.csv.gz'), data_dir)
+            parquet_getter = ParquetGetter({'type': 'parquet', 'data_dir': data_dir})
+
+            self.assertEqual(parquet_getter.get_itemIds(), sorted(csv_getter.get_itemIds()))
+            endep = 1739505557
+            itemIds = [59888, 93281, 270797]
+            for startep, ids in [(endep - 3600 * 3, itemIds), (endep - 3600 * 3, []), (0, [1])]:
+                df = parquet_getter.get_history_data(startep, endep, ids)
+                self.assertTrue(df.equals(csv_getter.get_history_data(startep, endep, ids)))
+                df = parquet_getter.get_trends_full_data(startep - 3600 * 24 * 3, endep, ids)
+                self.assertTrue(df.equals(csv_getter.get_trends_full_data(startep - 3600 * 24 * 3, endep, ids)))
+            self.assertTrue(parquet_getter.get_items_details(itemIds).equals(csv_getter.get_items_details(itemIds)))
+
+            # a day file rewritten in place, leaving the directory mtime as it was
+            history_dir = os.path.join(data_dir, 'history')
+            dir_stat = os.stat(history_dir)
+            day_files = sorted(os.listdir(history_dir))
+            df = csv_getter.get_history_data(0, 2**31, [59888])
+            for day_file in day_files:
+                os.remove(os.path.join(history_dir, day_file))
+            write_partitioned(df, history_dir)
+            os.utime(history_dir, ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+            self.assertEqual(sorted(os.listdir(history_dir)), day_files)
+            self.assertEqual(parquet_getter.get_itemIds(), [59888])
+
+
+if __name__ == '__main__':
+    unittest.main()
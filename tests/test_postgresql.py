@@ -1,6 +1,7 @@
 import __init__
 import unittest
 import os
+import pandas as pd
 
 import utils.config_loader as config_loader
 import db.postgresql as pg
@@ -28,6 +29,138 @@ class TestPgSQL(unittest.TestCase):
         db.exec_sql(sql)
 
 
+    def test_pool(self):
+        config_loader.load_config()
+        db1 = pg.PostgreSqlDB(config_loader.conf["admdb"])
+        db2 = pg.PostgreSqlDB(config_loader.conf["admdb"])
+        # same config shares the same pool
+        self.assertIs(db1.pool, db2.pool)
+
+        db1.select1rec("select 1;")
+        before = db1.pool.stats()
+        for _ in range(10):
+            db2.select1rec("select 1;")
+            db1.exec_sql("select 1;").close()
+        after = db1.pool.stats()
+        self.assertEqual(after["misses"], before["misses"])
+        self.assertEqual(after["hits"], before["hits"] + 20)
+        self.assertLessEqual(after["size"], after["max_size"])
+
+        # a cursor returned by exec_sql is readable after the connection is released
+        cur = db1.exec_sql("select generate_series(1, 3);")
+        self.assertEqual([row[0] for row in cur], [1, 2, 3])
+
+    def test_read_sql_chunks(self):
+        config_loader.load_config()
+        db = pg.PostgreSqlDB(config_loader.conf["admdb"])
+        sql = "select i as itemid, i * 0.5 as value from generate_series(1, 25) i"
+        chunks = list(db.read_sql_chunks(sql, ["itemid", "value"], chunksize=10, 
+                                         dtypes={"itemid": "int64", "value": "float64"}))
+        self.assertEqual([len(c) for c in chunks], [10, 10, 5])
+        self.assertEqual(str(chunks[0]["value"].dtype), "float64")
+
+        df = db.read_sql_chunked(sql, ["itemid", "value"], chunksize=10)
+        self.assertEqual(df["itemid"].tolist(), list(range(1, 26)))
+
+        # stopping early releases the connection without leaving a transaction open
+        for chunk in db.read_sql_chunks(sql, ["itemid", "value"], chunksize=10):
+            break
+        self.assertEqual(db.select1rec("select 1;")[0], 1)
+
+    def test_read_sql_columnar(self):
+        config_loader.load_config()
+        db = pg.PostgreSqlDB(config_loader.conf["admdb"])
+        sql = """select i as itemid, 1700000000 + i as clock, 
+            case when i = 3 then null else i * 0.5 end as value 
+            from generate_series(1, 5) i order by i;"""
+        dtypes = {"itemid": "int64", "clock": "int64", "value": "float64"}
+        df = db.read_sql_columnar(sql, dtypes)
+        self.assertEqual(df["itemid"].tolist(), [1, 2, 3, 4, 5])
+        self.assertEqual(df["clock"].tolist(), [1700000001, 1700000002, 1700000003, 1700000004, 1700000005])
+        self.assertEqual(df["value"].isna().tolist(), [False, False, True, False, False])
+        self.assertEqual(df["value"].iloc[3], 2.0)
+        self.assertEqual(str(df["itemid"].dtype), "int64")
+
+        # decoded in chunks of rows as the COPY output arrives
+        db.fetch_chunksize = 2
+        pd.testing.assert_frame_equal(db.read_sql_columnar(sql, dtypes), df)
+
+        # empty result
+        df = db.read_sql_columnar("select 1 as itemid, 1 as clock, 1.0 as value where false", dtypes)
+        self.assertEqual(len(df), 0)
+        self.assertEqual(list(df.columns), ["itemid", "clock", "value"])
+
+    def test_exec_prepared(self):
+        config_loader.load_config()
+        db = pg.PostgreSqlDB(config_loader.conf["admdb"])
+        sql = "select i from generate_series(1, 10) i where i = ANY($1) and i > $2 order by i"
+        for _ in range(3):
+            cur = db.exec_prepared(sql, [pg.int_array([1, 5, 7, 9]), 5], ["bigint[]", "integer"])
+            self.assertEqual([row[0] for row in cur], [7, 9])
+
+        df = db.read_prepared(sql, ["itemid"], [[2, 3], 0], ["bigint[]", "integer"], 
+                              dtypes={"itemid": "int64"})
+        self.assertEqual(df["itemid"].tolist(), [2, 3])
+
+    def test_exec_itemIds(self):
+        config_loader.load_config()
+        db = pg.PostgreSqlDB(config_loader.conf["admdb"])
+        sql = "select i from generate_series(1, 100) i where i = ANY({itemIds}) and i > $1 order by i"
+        itemIds = list(range(0, 100, 10))
+        for threshold in [0, 5]:
+            db.id_table_threshold = threshold
+            for _ in range(2):
+                df = db.read_itemIds(sql, ["itemid"], itemIds, [50], ["integer"])
+                self.assertEqual(df["itemid"].tolist(), [60, 70, 80, 90])
+
+    def test_thread_offload_db(self):
+        import asyncio
+        import time
+        from db.thread_offload import ThreadOffloadDB
+        config_loader.load_config()
+        db = pg.PostgreSqlDB(config_loader.conf["admdb"])
+        adb = ThreadOffloadDB(db)
+        dtypes = {"itemid": "int64", "value": "float64"}
+        n = db.pool.max_size * 2
+
+        async def read_all():
+            return await asyncio.gather(*[adb.read_sql_columnar(
+                f"select {i} as itemid, 0.5 as value from pg_sleep(0.1)", dtypes) for i in range(n)])
+
+        # a new event loop per run, as in Detector
+        for _ in range(2):
+            startep = time.time()
+            dfs = asyncio.run(read_all())
+            elapsed = time.time() - startep
+            self.assertEqual([int(df["itemid"].iloc[0]) for df in dfs], list(range(n)))
+            # never more statements than connections, and pool_size of them at once
+            self.assertGreaterEqual(elapsed, 0.2)
+            self.assertLess(elapsed, 0.1 * n)
+            self.assertLessEqual(db.pool.stats()["size"], db.pool.max_size)
+
+    def test_query_stats(self):
+        from db.instrumentation import query_stats, get_shape
+        config_loader.load_config()
+        db = pg.PostgreSqlDB(config_loader.conf["admdb"])
+        db.tag = "TestPgSQL"
+        self.assertEqual(get_shape("select * from t where id in (1, 2, 3) and name = 'a'"), 
+                         "select * from t where id in (?) and name = ?")
+
+        query_stats.reset()
+        for i in range(3):
+            db.read_sql(f"select generate_series(1, {i + 2});")
+        rows = [r for r in query_stats.summary() if r["tag"] == "TestPgSQL"]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["calls"], 3)
+        self.assertEqual(rows[0]["rows"], 2 + 3 + 4)
+        self.assertEqual(sum(rows[0]["histogram"]), 3)
+        # bytes are only measured on the COPY paths
+        self.assertIsNone(rows[0]["bytes"])
+        self.assertEqual(query_stats.acquire["TestPgSQL"]["count"], 3)
+        db.read_sql_columnar("select 1 as itemid", {"itemid": "int64"})
+        rows = [r for r in query_stats.summary() if r["tag"] == "TestPgSQL" and r["shape"].startswith("select ? as")]
+        self.assertGreater(rows[0]["bytes"], 0)
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,339 @@
+"""
+unit tests for zabbix_getter.py on Zabbix shaped tables in the test database
+"""
+import unittest
+import copy
+import asyncio
+import threading
+
+import numpy as np
+import pandas as pd
+
+import __init__
+
+import utils
+import utils.config_loader as config_loader
+from db.postgresql import PostgreSqlDB
+from data_getter.zabbix_getter import ZabbixGetter
+from data_getter.zabbix_catalog import ZabbixItemCatalog, like_to_regex, match_names
+
+schema = "zabbix_test"
+# day aligned
+startep = 1739059200
+days = 20
+
+hosts = [(1, 'web01', 'Web 01'), (2, 'db01', 'DB 01'), (3, 'app_x', 'App X')]
+groups = [(10, 'app'), (11, 'app/sim'), (12, 'app/sim/rp'), (13, 'apple'), (14, 'db')]
+hosts_groups = [(1, 11), (1, 13), (2, 14), (3, 12), (3, 10)]
+# itemid, hostid, name, key_, value_type. 0: float, 3: unsigned, 1: character
+items = [
+    (101, 1, 'cpu load', 'system.cpu.load', 0),
+    (102, 1, 'memory used', 'vm.memory.used', 3),
+    (103, 2, 'cpu load', 'system.cpu.load', 0),
+    (104, 2, 'db size', 'db.size', 3),
+    (105, 3, 'cpu_util', 'system.cpu.util', 0),
+    (106, 3, 'version', 'app.version', 1),
+]
+
+
+def data_source():
+    ds = copy.deepcopy(config_loader.conf['admdb'])
+    ds.update({'type': 'zabbix', 'schema': schema, 'api_url': 'http://localhost/zabbix'})
+    return ds
+
+
+def _rows(rows, columns):
+    return pd.DataFrame(rows, columns=columns)
+
+
+def setup_zabbix_db() -> PostgreSqlDB:
+    """ Zabbix tables with hourly trends of days days and 10 minute history of the last day """
+    PostgreSqlDB(config_loader.conf['admdb']).exec_sql(
+        f"DROP SCHEMA IF EXISTS {schema} CASCADE; CREATE SCHEMA {schema};")
+    db = PostgreSqlDB(data_source())
+    db.exec_sql("""
+        CREATE TABLE hosts (hostid bigint PRIMARY KEY, host varchar(128), name varchar(128));
+        CREATE TABLE hstgrp (groupid bigint PRIMARY KEY, name varchar(255));
+        CREATE TABLE hosts_groups (hostid bigint, groupid bigint);
+        CREATE TABLE items (itemid bigint PRIMARY KEY, hostid bigint, name varchar(255),
+            key_ varchar(2048), value_type integer);
+        CREATE TABLE history (itemid bigint, clock integer, value double precision, ns integer);
+        CREATE TABLE history_uint (itemid bigint, clock integer, value numeric(20,0), ns integer);
+        CREATE TABLE trends (itemid bigint, clock integer, num integer,
+            value_min double precision, value_avg double precision, value_max double precision);
+        CREATE TABLE trends_uint (itemid bigint, clock integer, num integer,
+            value_min numeric(20,0), value_avg numeric(20,0), value_max numeric(20,0));
+    """)
+
+    rng = np.random.default_rng(1)
+    tables = {
+        'hosts': _rows(hosts, ['hostid', 'host', 'name']),
+        'hstgrp': _rows(groups, ['groupid', 'name']),
+        'hosts_groups': _rows(hosts_groups, ['hostid', 'groupid']),
+        'items': _rows(items, ['itemid', 'hostid', 'name', 'key_', 'value_type']),
+    }
+    endep = startep + days * 86400
+    for value_type, suffix in [(0, ''), (3, '_uint')]:
+        itemIds = [item[0] for item in items if item[4] == value_type]
+        clocks = np.arange(endep - 86400, endep, 600)
+        values = rng.normal(100, 20, (len(itemIds), len(clocks)))
+        trend_clocks = np.arange(startep, endep, 3600)
+        avgs = rng.normal(100, 20, (len(itemIds), len(trend_clocks)))
+        if value_type == 3:
+            values, avgs = np.round(values), np.round(avgs)
+        tables['history' + suffix] = pd.DataFrame({
+            'itemid': np.repeat(itemIds, len(clocks)), 'clock': np.tile(clocks, len(itemIds)),
+            'value': values.ravel(), 'ns': 0})
+        tables['trends' + suffix] = pd.DataFrame({
+            'itemid': np.repeat(itemIds, len(trend_clocks)), 'clock': np.tile(trend_clocks, len(itemIds)),
+            'num': rng.integers(50, 61, avgs.size),
+            'value_min': avgs.ravel() - 10, 'value_avg': avgs.ravel(), 'value_max': avgs.ravel() + 10})
+    with db.transaction() as cur:
+        for table, df in tables.items():
+            db.copy_df(cur, table, df, list(df.columns))
+    return db
+
+
+# the joins the catalog replaces
+join_sql = """FROM hosts 
+    inner join items on hosts.hostid = items.hostid
+    inner join hosts_groups on hosts_groups.hostid = hosts.hostid
+    inner join hstgrp on hstgrp.groupid = hosts_groups.groupid"""
+
+def old_name_cond(table_name, names):
+    name_conds = []
+    for name in names:
+        if '*' in name or '%' in name:
+            name_conds.append(f"{table_name}.name LIKE '{name.replace('*', '%')}'")
+        else:
+            name_conds.append(f"{table_name}.name = '{name}' OR {table_name}.name LIKE '{name}/%'")
+    return "(" + " OR ".join(name_conds) + ")"
+
+def old_itemIds(db, item_names, host_names, group_names, itemIds):
+    where_conds = [old_name_cond(table_name, names) for (table_name, names) in 
+                   [("items", item_names), ("hosts", host_names), ("hstgrp", group_names)] if len(names) > 0]
+    if len(itemIds) > 0:
+        where_conds.append("items.itemid IN (%s)" % ",".join(map(str, itemIds)))
+    where = "WHERE " + " AND ".join(where_conds) if where_conds else ""
+    return [row[0] for row in db.exec_sql(f"SELECT items.itemid {join_sql} {where}")]
+
+
+class TestZabbixGetter(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.db = setup_zabbix_db()
+        cls.endep = startep + days * 86400 - 1
+
+    def test_aggregates(self):
+        dg = ZabbixGetter(data_source())
+        endep = self.endep
+        for get_data, get_aggregates, iter_data, s in [
+                (dg.get_history_data, dg.get_history_aggregates, dg.iter_history_data, endep - 3600 * 6),
+                (dg.get_trends_data, dg.get_trends_aggregates, dg.iter_trends_data, endep - 86400 * 7)]:
+            # same as the per item groupby with utils.square_sum they replace
+            data = get_data(s, endep)
+            expected = data.groupby('itemid').agg(
+                sum=('value', 'sum'), sqr_sum=('value', utils.square_sum), cnt=('value', 'count')).reset_index()
+            df = get_aggregates(s, endep).sort_values('itemid').reset_index(drop=True)
+            self.assertEqual(df['itemid'].tolist(), [101, 102, 103, 104, 105])
+            self.assertEqual(df['itemid'].tolist(), expected['itemid'].tolist())
+            self.assertEqual(df['cnt'].tolist(), expected['cnt'].tolist())
+            np.testing.assert_allclose(df['sum'], expected['sum'], rtol=1e-12)
+            np.testing.assert_allclose(df['sqr_sum'], expected['sqr_sum'], rtol=1e-12)
+
+            # the same rows streamed in chunks
+            chunks = list(iter_data(s, endep, chunksize=100))
+            self.assertGreater(len(chunks), 2)
+            self.assertTrue(all([len(chunk) <= 100 for chunk in chunks]))
+            pd.testing.assert_frame_equal(
+                pd.concat(chunks).sort_values(['itemid', 'clock']).reset_index(drop=True), 
+                data.reset_index(drop=True))
+
+    def test_trends_rebucket(self):
+        dg = ZabbixGetter(data_source())
+        dg.trends_interval = 86400
+        s, e = startep, self.endep
+
+        def stats(df):
+            df = df.sort_values('itemid').set_index('itemid')
+            mean = df['sum'] / df['cnt']
+            std = np.sqrt((df['sqr_sum'] - np.square(df['sum']) / df['cnt']) / (df['cnt'] - 1))
+            return df['cnt'], mean, std
+
+        dg.trends_rebucket = False
+        hourly = dg.get_trends_full_data(s, e)
+        cnt, mean, std = stats(dg.get_trends_aggregates(s, e))
+        self.assertEqual(cnt.tolist(), [days * 24] * 5)
+
+        dg.trends_rebucket = True
+        daily = dg.get_trends_full_data(s, e).reset_index(drop=True)
+        self.assertEqual(len(daily), days * 5)
+        # the trends stats stay over the hourly trends
+        rebucketed_cnt, rebucketed_mean, rebucketed_std = stats(dg.get_trends_aggregates(s, e))
+        self.assertEqual(rebucketed_cnt.tolist(), cnt.tolist())
+        np.testing.assert_allclose(rebucketed_mean, mean, rtol=1e-12)
+        np.testing.assert_allclose(rebucketed_std, std, rtol=1e-12)
+
+        # one row per day: min, max and the average weighted by num
+        trends = self.db.read_sql("SELECT itemid, clock, num, value_avg FROM trends UNION ALL "
+                                  "SELECT itemid, clock, num, value_avg FROM trends_uint")
+        trends.columns = ['itemid', 'clock', 'num', 'value_avg']
+        trends = trends.astype(float)
+        trends['clock'] = trends['clock'] - trends['clock'] % 86400
+        trends['weighted'] = trends['num'] * trends['value_avg']
+        expected = trends.groupby(['itemid', 'clock']).sum().reset_index()
+        self.assertEqual(daily['clock'].tolist(), expected['clock'].astype('int64').tolist())
+        np.testing.assert_allclose(daily['value_avg'], expected['weighted'] / expected['num'], rtol=1e-12)
+        hourly['clock'] = hourly['clock'] - hourly['clock'] % 86400
+        grouped = hourly.groupby(['itemid', 'clock'])
+        np.testing.assert_allclose(daily['value_min'], grouped['value_min'].min().to_numpy())
+        np.testing.assert_allclose(daily['value_max'], grouped['value_max'].max().to_numpy())
+
+    def test_route_itemIds(self):
+        dg = ZabbixGetter(data_source())
+        s, e = self.endep - 3600 * 6, self.endep
+        # 101, 103 float, 102 unsigned, 106 character, 999 not in the catalog yet
+        self.assertEqual(dg._route_itemIds([]), [[], []])
+        self.assertEqual(dg._route_itemIds([101, 102, 103]), [[101, 103], [102]])
+        self.assertEqual(dg._route_itemIds([101, 103]), [[101, 103], None])
+        self.assertEqual(dg._route_itemIds([101, 999]), [[101, 999], [999]])
+        self.assertEqual(dg._route_itemIds([106]), [None, None])
+
+        # nothing numeric to read
+        sqls = dg._history_sqls(s, e, [106])
+        self.assertEqual(len(sqls), 1)
+        self.assertIn("WHERE false", sqls[0])
+        df = dg.get_history_data(s, e, [106])
+        self.assertTrue(df.empty)
+        self.assertEqual(list(df.columns), dg.fields)
+
+        self.assertEqual(len(dg._history_sqls(s, e, [101, 102])), 2)
+        df = dg.get_history_data(s, e, [101, 102, 106, 999])
+        self.assertEqual(sorted(df['itemid'].unique()), [101, 102])
+        self.assertEqual(len(df), 2 * 36)
+        # the reader threads end with the read
+        self.assertFalse(any(t.name.startswith("zabbix_read") for t in threading.enumerate()))
+
+        # the blocking readers also work inside a running event loop
+        async def read():
+            return dg.get_trends_full_data(s, e, [101, 102]), await dg.aget_trends_full_data(s, e, [101, 102])
+        df, adf = asyncio.run(read())
+        self.assertEqual(sorted(df['itemid'].unique()), [101, 102])
+        pd.testing.assert_frame_equal(df.reset_index(drop=True), adf.reset_index(drop=True))
+
+    def test_match_names(self):
+        self.assertEqual(like_to_regex("a_b%.c"), r"a.b.*\.c")
+        names = pd.Series(['app', 'app/sim', 'app/sim/rp', 'apple', 'a_p', 'axp', None])
+        self.assertEqual(match_names(names, ['app']).tolist(), [True, True, True, False, False, False, False])
+        self.assertEqual(match_names(names, ['app/sim']).tolist(), [False, True, True, False, False, False, False])
+        self.assertEqual(match_names(names, ['ap*']).tolist(), [True, True, True, True, False, False, False])
+        # LIKE wildcards only in patterns with * or %
+        self.assertEqual(match_names(names, ['a_p%']).tolist(), [True, True, True, True, True, True, False])
+        self.assertEqual(match_names(names, ['a_p']).tolist(), [False, False, False, False, True, False, False])
+
+    def test_catalog_get_itemIds(self):
+        dg = ZabbixGetter(data_source())
+        cases = [
+            ([], [], [], []),
+            (['cpu load'], [], [], []),
+            (['cpu%'], [], [], []),
+            (['mem*'], ['Web 01'], [], []),
+            ([], ['Web%'], [], []),
+            ([], ['A_p%'], [], []),
+            ([], [], ['app'], []),
+            ([], [], ['app/sim'], []),
+            ([], [], ['ap*'], []),
+            ([], [], ['db', 'app/sim/rp'], []),
+            (['cpu%'], [], ['app'], [101, 103, 105, 106]),
+        ]
+        for (item_names, host_names, group_names, itemIds) in cases:
+            expected = sorted(set(old_itemIds(self.db, item_names, host_names, group_names, itemIds)))
+            result = dg.get_itemIds(item_names, host_names, group_names, itemIds)
+            self.assertEqual(sorted(result), expected, (item_names, host_names, group_names, itemIds))
+            # one entry per item even when its host is in several matching groups
+            self.assertEqual(len(result), len(set(result)))
+
+        # max_itemIds keeps the first items
+        all_itemIds = dg.get_itemIds(group_names=['ap*'])
+        self.assertEqual(dg.get_itemIds(group_names=['ap*'], max_itemIds=2), all_itemIds[:2])
+
+    def test_catalog_lookups(self):
+        dg = ZabbixGetter(data_source())
+        itemIds = [101, 102, 103, 105, 106]
+        in_itemIds = ",".join(map(str, itemIds))
+        group_names = ['app', 'app/sim', 'db', 'ap*']
+
+        rows = self.db.exec_sql(f"SELECT itemid, hostid FROM items WHERE itemid IN ({in_itemIds})")
+        self.assertEqual(dg.get_item_host_dict(itemIds), dict(rows.fetchall()))
+
+        rows = self.db.exec_sql(f"""SELECT items.itemid, hosts.hostid, hosts.name, items.name 
+            FROM items inner join hosts on hosts.hostid = items.hostid WHERE itemid IN ({in_itemIds})""")
+        self.assertEqual(dg.get_item_details(itemIds), 
+                         {row[0]: {"hostid": row[1], "host_name": row[2], "item_name": row[3]} for row in rows})
+
+        df = self.db.read_sql(f"""SELECT hstgrp.name, hosts.hostid, hosts.host, items.itemid, items.key_ 
+            {join_sql} WHERE itemid IN ({in_itemIds})""")
+        df.columns = ['group_name', 'hostid', 'host_name', 'itemid', 'item_name']
+        sort = lambda d: d.sort_values(['itemid', 'group_name']).reset_index(drop=True)
+        pd.testing.assert_frame_equal(sort(dg.get_items_details(itemIds)), sort(df), check_dtype=False)
+
+        groups = {}
+        group_map = {}
+        relations = []
+        for group_name in group_names:
+            # the former per group queries. sub groups belong to the group.
+            where = f"{old_name_cond('hstgrp', [group_name])} AND items.itemid IN ({in_itemIds})"
+            rows = self.db.exec_sql(f"SELECT DISTINCT items.itemid {join_sql} WHERE {where}").fetchall()
+            if len(rows) > 0:
+                groups[group_name] = sorted(row[0] for row in rows)
+            for (itemId,) in rows:
+                group_map[itemId] = group_name
+            relations += [(group_name, hostId, itemId) for (hostId, itemId) in 
+                          self.db.exec_sql(f"SELECT hosts.hostid, items.itemid {join_sql} WHERE {where}")]
+        self.assertEqual({k: sorted(v) for k, v in dg.classify_by_groups(itemIds, group_names).items()}, groups)
+        self.assertEqual(dg.get_group_map(itemIds, group_names), group_map)
+        self.assertEqual(sorted(dg.get_item_relations(itemIds, group_names).itertuples(index=False, name=None)), 
+                         sorted(relations))
+
+        rows = self.db.exec_sql("SELECT itemid FROM items WHERE value_type = 0")
+        self.assertEqual(sorted(dg.get_cond_itemIds("value_type = 0")), sorted(row[0] for row in rows))
+        self.assertEqual(dg.check_itemId_cond([101, 102, 105], "value_type = 0"), [101, 105])
+
+    def test_catalog_refresh(self):
+        catalog = ZabbixItemCatalog(self.db, ttl=3600)
+        catalog.block_size = 2
+        self.assertEqual(catalog.get_value_types([101, 105]), {101: 0, 105: 0})
+
+        loaded_blocks = []
+        load_items = catalog._load_items
+        def spy(blocks=None):
+            loaded_blocks.append(blocks)
+            return load_items(blocks)
+        catalog._load_items = spy
+        try:
+            self.db.exec_sql("""UPDATE items SET name = 'cpu load 1', value_type = 3 WHERE itemid = 101;
+                DELETE FROM items WHERE itemid = 105;
+                INSERT INTO items VALUES (107, 3, 'disk used', 'vfs.fs.used', 3);""")
+            # cached until the ttl is over
+            self.assertEqual(catalog.get_item_details([101])[101]["item_name"], "cpu load")
+            self.assertEqual(catalog.get_itemIds(itemIds=[105, 107]), [105])
+
+            catalog.loaded = 0
+            self.assertEqual(catalog.get_item_details([101])[101]["item_name"], "cpu load 1")
+            self.assertEqual(catalog.get_value_types([101, 105, 107]), {101: 3, 107: 3})
+            self.assertEqual(catalog.get_itemIds(itemIds=[105, 107]), [107])
+            # only the blocks of the changed items are read again
+            self.assertEqual(loaded_blocks, [[50, 52, 53]])
+            self.assertEqual(sorted(catalog.items.index), [101, 102, 103, 104, 106, 107])
+
+            catalog.loaded = 0
+            catalog.get_itemIds()
+            self.assertEqual(loaded_blocks, [[50, 52, 53]])
+        finally:
+            self.db.exec_sql("""UPDATE items SET name = 'cpu load', value_type = 0 WHERE itemid = 101;
+                DELETE FROM items WHERE itemid = 107;
+                INSERT INTO items VALUES (105, 3, 'cpu_util', 'system.cpu.util', 0);""")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,7 +13,11 @@ class ZabbixDataExporter:
     item_details_file_name = "items.csv.gz"
     anom_data_file_name = "anomalies.csv.gz"
 
-    def __init__(self, config: Dict, output_dir: str, history_length: int, trends_length: int):
+    def __init__(self, config: Dict, output_dir: str, history_length: int, trends_length: int, 
+                 format: str = "csv"):
+        # csv: gzipped csv files for the csv data source
+        # parquet: day partitioned parquet files for the parquet data source
+        self.format = format
         self.history_length = history_length
         self.trends_length = trends_length
         self.output_dir = output_dir
@@ -33,18 +37,23 @@ class ZabbixDataExporter:
         self.z = ZabbixGetter(self.data_source_config)
 
 
+    def _write(self, df, file_name: str, dirname: str):
+        if self.format == "parquet":
+            from data_getter.parquet_getter import write_partitioned
+            write_partitioned(df, os.path.join(self.output_dir, dirname))
+            return
+        # Save the DataFrame to a gzipped CSV file
+        file_path = os.path.join(self.output_dir, file_name)
+        df.to_csv(file_path, mode='w', index=False, compression='gzip')
+
     def export_data(self, endep: int, itemIds: List[int]):
         print("exporting trends data")
         df = self.z.get_trends_full_data(endep - self.trends_length, endep, itemIds=itemIds)
-        # Save the DataFrame to a gzipped CSV file
-        file_path = os.path.join(self.output_dir, self.trends_file_name)
-        df.to_csv(file_path, mode='w', index=False, compression='gzip')
+        self._write(df, self.trends_file_name, "trends")
 
         print("exporting history data")
         df = self.z.get_history_data(endep - self.history_length, endep, itemIds=itemIds)
-        # Save the DataFrame to a gzipped CSV file
-        file_path = os.path.join(self.output_dir, self.history_file_name)
-        df.to_csv(file_path, mode='w', index=False, compression='gzip')
+        self._write(df, self.history_file_name, "history")
 
         print("exporting items details")
         df = self.z.get_items_details(itemIds=itemIds)
@@ -80,13 +89,15 @@ if __name__ == '__main__':
     parser.add_argument('-o', '--outdir', type=str, help='output directory')
     parser.add_argument('--history_length', type=int, default=3600 * 24, help='history length in seconds')
     parser.add_argument('--trends_length', type=int, default=3600 * 24 * 14, help='trends length in seconds')
+    parser.add_argument('--format', type=str, default='csv', choices=['csv', 'parquet'], 
+                        help='output format. parquet needs pyarrow')
     args = parser.parse_args()
     
     config = config_loader.load_config(args.config)
     output_dir = args.outdir
     history_length = args.history_length
     trends_length = args.trends_length
-    zabbix_data_exporter = ZabbixDataExporter(config, output_dir, history_length, trends_length)
+    zabbix_data_exporter = ZabbixDataExporter(config, output_dir, history_length, trends_length, args.format)
     zabbix_data_exporter.export_data_from_anomalies()
 
 
@@ -0,0 +1,28 @@
+"""
+This script applies the index migrations of the admdb tables of every data source
+and prints the declared indexes which are missing and the indexes never scanned.
+"""
+import __init__
+import utils.config_loader as config_loader
+from models.models_set import ModelsSet
+
+
+def migrate(conf):
+    for data_source_name in conf["data_sources"]:
+        ms = ModelsSet(data_source_name)
+        ms.migrate()
+        for table_name, report in ms.index_report().items():
+            for indexname in report["missing"]:
+                print(f"{table_name}: missing index {indexname}")
+            for indexname in report["unused"]:
+                print(f"{table_name}: unused index {indexname}")
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Apply admdb index migrations and report index usage.')
+    parser.add_argument('-c', '--config', type=str, help='config yaml file')
+    args = parser.parse_args()
+
+    config = config_loader.load_config(args.config)
+    migrate(config)
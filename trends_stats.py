@@ -5,6 +5,7 @@ import logging
 import utils.config_loader as config_loader
 from data_processing.trends_stats import TrendsStats
 from models.models_set import ModelsSet
+from db.instrumentation import query_stats
 from models.trends_updates import TrendsUpdatesModel
 from models.history_updates import HistoryUpdatesModel
 
@@ -82,3 +83,4 @@ if __name__ == "__main__":
     config = config_loader.load_config(args.config)
     
     update_stats(config, 0, initialize=args.init)
+    query_stats.dump_summary()
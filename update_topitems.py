@@ -67,7 +67,9 @@ def classify_charts(endep: int):
     if len(classified_itemIds) > 1:
         log("classifying charts")
         clusters, _, _ = dbscan.classify_charts(conf, classified_itemIds, endep=endep)
-        ModelsSet(data_source_name).topitems.update_clusterid(clusters)
+        # the clustered itemIds come from all data sources
+        for data_source_name in data_sources:
+            ModelsSet(data_source_name).topitems.update_clusterid(clusters)
     else:
         log("no data to classify")
 
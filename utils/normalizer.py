@@ -71,6 +71,35 @@ def fit_to_base_clocks(base_clocks: List[int], clocks: List[int], values: List[f
 
         return new_values.tolist()
 
+""" get_bucket_clocks:
+Maps clocks to the base clock of their bucket. A base clock holds the clocks since the previous base clock:
+base clock - unitsecs < clock <= base clock
+"""
+def get_bucket_clocks(clocks: np.ndarray, unitsecs: int) -> np.ndarray:
+    return clocks + (-clocks) % unitsecs
+
+
+""" fill_base_clocks:
+Spreads values aggregated per itemid and base clock over the base clocks.
+Like fit_to_base_clocks, a base clock without a value takes the next value 
+and the base clocks after the last value take the last value.
+
+Args:
+    base_clocks (list[int]): The base clocks.
+    df (pd.DataFrame): itemid, clock, value with clock on the base clocks.
+
+Returns:
+    Tuple[list[int], np.ndarray]: itemIds having values and the itemIds x base_clocks matrix.
+"""
+def fill_base_clocks(base_clocks: List[int], df: pd.DataFrame) -> Tuple[List[int], np.ndarray]:
+    df = df[df['clock'].isin(base_clocks)]
+    if df.empty:
+        return [], np.empty((0, len(base_clocks)))
+    pivot = df.pivot_table(index='itemid', columns='clock', values='value', aggfunc='mean')
+    pivot = pivot.reindex(columns=base_clocks).bfill(axis=1).ffill(axis=1)
+    return pivot.index.tolist(), pivot.to_numpy(dtype=np.float64)
+
+
 def normalize_metric_df(data: pd.DataFrame) -> pd.DataFrame:
     """
     Normalize the metric data frame by scaling the values to a range of 0 to 1.